@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 Salvador E. Tropea
+# Copyright (c) 2020 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+BoM generation from the XML netlist.
+
+The XML is read in one pass using iterparse, we stop after the components
+and discard each element once processed. The components are grouped using
+a list of fields and written in the requested formats. The default CSV is
+the same created by KiCad's bom2grouped_csv.xsl, so we don't need xsltproc.
+"""
+import json
+import xml.etree.ElementTree as ET
+
+from kiauto import log
+logger = log.get_logger(__name__)
+
+BOM_FORMATS = ['csv', 'json']
+DEFAULT_GROUP_BY = ['Value', 'Footprint']
+# Fields found as tags in the XML
+STD_FIELDS = ['Value', 'Footprint', 'Datasheet']
+
+
+class BoMError(Exception):
+    pass
+
+
+class BoMComponent(object):
+    def __init__(self, ref):
+        self.ref = ref
+        self.fields = {}
+
+    def get(self, name):
+        """ Field value, the name isn't case sensitive """
+        return self.fields.get(name.lower(), '')
+
+
+class BoMGroup(object):
+    def __init__(self, key, comp):
+        self.key = key
+        self.comps = [comp]
+
+    def get(self, name):
+        return self.comps[0].get(name)
+
+    def refs(self):
+        return [c.ref for c in self.comps]
+
+
+class BoM(object):
+    def __init__(self):
+        self.components = []
+        # User fields, in order of appearance
+        self.field_names = []
+
+    def group(self, group_by=DEFAULT_GROUP_BY):
+        """ Groups the components, keeping the order of the first component of each group """
+        groups = {}
+        for c in self.components:
+            key = tuple(c.get(f) for f in group_by)
+            g = groups.get(key)
+            if g is None:
+                groups[key] = BoMGroup(key, c)
+            else:
+                g.comps.append(c)
+        return list(groups.values())
+
+
+def read_xml(file):
+    """ Collects the components from the XML netlist """
+    bom = BoM()
+    seen = set()
+    try:
+        for _, elem in ET.iterparse(file):
+            tag = elem.tag
+            if tag == 'comp':
+                c = BoMComponent(elem.get('ref'))
+                for name in STD_FIELDS:
+                    c.fields[name.lower()] = elem.findtext(name.lower(), '')
+                for f in elem.iterfind('fields/field'):
+                    name = f.get('name')
+                    c.fields[name.lower()] = f.text or ''
+                    if name not in seen:
+                        seen.add(name)
+                        bom.field_names.append(name)
+                bom.components.append(c)
+                elem.clear()
+            elif tag == 'components':
+                # Nothing else is needed, skip the libparts and nets
+                break
+    except (ET.ParseError, OSError) as e:
+        raise BoMError('Unable to read `{}`: {}'.format(file, e))
+    logger.debug('{} components and {} user fields in {}'.format(len(bom.components), len(bom.field_names), file))
+    return bom
+
+
+def _csv_quote(s):
+    return '"'+s.replace('"', '""')+'"'
+
+
+def write_csv(bom, groups, file):
+    """ Grouped CSV, same as bom2grouped_csv.xsl """
+    with open(file, 'wt') as f:
+        f.write('Reference, Quantity, '+', '.join(STD_FIELDS+bom.field_names))
+        for g in groups:
+            f.write('\n'+''.join([r+' ' for r in g.refs()]))
+            f.write(','+str(len(g.comps)))
+            for name in STD_FIELDS+bom.field_names:
+                f.write(','+_csv_quote(g.get(name)))
+        f.write('\n')
+
+
+def write_json(bom, groups, file):
+    data = []
+    for g in groups:
+        entry = {'references': g.refs(), 'quantity': len(g.comps)}
+        for name in STD_FIELDS:
+            entry[name.lower()] = g.get(name)
+        entry['fields'] = {name: g.get(name) for name in bom.field_names if g.get(name)}
+        data.append(entry)
+    with open(file, 'wt') as f:
+        json.dump(data, f, indent=2)
+        f.write('\n')
+
+
+WRITERS = {'csv': write_csv, 'json': write_json}
+
+
+def write_bom(bom, format, file, group_by=DEFAULT_GROUP_BY):
+    WRITERS[format](bom, bom.group(group_by), file)
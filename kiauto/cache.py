@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 Salvador E. Tropea
+# Copyright (c) 2020 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+On-disk cache helpers.
+
+The cache lives in KIAUS_CACHE_DIR, or $XDG_CACHE_HOME/kiauto (usually
+~/.cache/kiauto). Define KIAUS_CACHE_DIR to an empty string to disable it.
+Entries are written atomically, so concurrent runs can share the cache.
+Any problem with the cache is ignored, it just becomes a miss.
+"""
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+
+from kiauto import log
+logger = log.get_logger(__name__)
+
+CACHE_ENV = 'KIAUS_CACHE_DIR'
+
+
+def cache_dir(section):
+    """ Directory for the `section` entries, None if the cache is disabled """
+    base = os.environ.get(CACHE_ENV)
+    if base is None:
+        base = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'kiauto')
+    elif not base:
+        return None
+    return os.path.join(base, section)
+
+
+def key_for(*items):
+    """ A hash for the items (converted to str) """
+    h = hashlib.sha1()
+    for i in items:
+        h.update(str(i).encode('utf-8', 'surrogateescape')+b'\0')
+    return h.hexdigest()
+
+
+def hash_file(file, size=-1):
+    """ Hash of the first `size` bytes of the file (all if negative) """
+    h = hashlib.sha1()
+    with open(file, 'rb') as f:
+        if size >= 0:
+            h.update(f.read(size))
+        else:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def _json_name(d, key, compress):
+    return os.path.join(d, key+('.json.gz' if compress else '.json'))
+
+
+def load_json(section, key, compress=False):
+    d = cache_dir(section)
+    if d is None:
+        return None
+    name = _json_name(d, key, compress)
+    try:
+        with (gzip.open(name, 'rt') if compress else open(name, 'rt')) as f:
+            data = json.load(f)
+    except (OSError, EOFError, ValueError):
+        return None
+    # Mark it as recently used
+    try:
+        os.utime(name)
+    except OSError:
+        pass
+    return data
+
+
+def save_json(section, key, data, compress=False, max_entries=None):
+    """ Stores the data, if max_entries is specified we remove the least recently used entries """
+    d = cache_dir(section)
+    if d is None:
+        return
+    try:
+        os.makedirs(d, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=d, suffix='.tmp')
+        if compress:
+            os.close(fd)
+        with (gzip.open(tmp, 'wt') if compress else os.fdopen(fd, 'wt')) as f:
+            json.dump(data, f)
+        os.replace(tmp, _json_name(d, key, compress))
+        if max_entries:
+            entries = sorted([os.path.join(d, n) for n in os.listdir(d) if not n.endswith('.tmp')], key=os.path.getmtime)
+            for name in entries[:-max_entries]:
+                os.remove(name)
+    except OSError as e:
+        logger.debug('Unable to write the cache: {}'.format(e))
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 Salvador E. Tropea
+# Copyright (c) 2020 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+Pool of virtual X servers that can be shared by many runs.
+
+A long-lived manager (kiauto_display_pool) starts N Xvfb servers (and
+optionally a window manager on each one) and publishes them in a directory.
+When the KIAUS_DISPLAY_POOL environment variable points to this directory
+eeschema_do and pcbnew_do lease one of the displays, using an exclusive lock
+on its lock file, instead of starting a new Xvfb.
+"""
+import os
+import json
+import time
+import fcntl
+import signal
+from subprocess import (Popen, CalledProcessError, DEVNULL)
+from contextlib import contextmanager
+
+from kiauto import log
+logger = log.get_logger(__name__)
+
+# Environment variable used to indicate the pool directory
+POOL_ENV = 'KIAUS_DISPLAY_POOL'
+# File describing the pool
+POOL_INFO = 'pool.json'
+# How much we wait for a free display before starting our own Xvfb
+LEASE_TIMEOUT = 60
+
+
+def _lock_name(pool_dir, display):
+    return os.path.join(pool_dir, 'display-{}.lock'.format(display.lstrip(':')))
+
+
+def read_pool_info(pool_dir):
+    """ Returns the description of the pool or None if it isn't running """
+    try:
+        with open(os.path.join(pool_dir, POOL_INFO), 'rt') as f:
+            info = json.load(f)
+    except (OSError, ValueError):
+        return None
+    # Make sure the manager is still alive
+    try:
+        os.kill(info['pid'], 0)
+    except (OSError, KeyError):
+        logger.debug('Stale display pool information in '+pool_dir)
+        return None
+    return info
+
+
+def _pool_matches(cfg, info):
+    """ The displays must be equivalent to the one we would create """
+    return (info['width'] == cfg.rec_width and info['height'] == cfg.rec_height and
+            info['colordepth'] == cfg.colordepth and info['use_wm'] == cfg.use_wm)
+
+
+def _try_lock(pool_dir, display):
+    f = open(_lock_name(pool_dir, display), 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+def _visible_windows(xdotool):
+    try:
+        return set(xdotool(['search', '--onlyvisible', '--name', '.+']).split())
+    except CalledProcessError:
+        return set()
+
+
+def reset_display(xdotool, initial_windows):
+    """ Leave the display as we found it: no stuck modifiers and no windows from this job """
+    logger.debug('Resetting display '+os.environ['DISPLAY'])
+    try:
+        xdotool(['keyup', 'ctrl', 'shift', 'alt'])
+    except CalledProcessError:  # pragma: no cover
+        pass
+    for id in _visible_windows(xdotool) - initial_windows:
+        logger.debug('Closing window left by the job: '+id.decode())
+        try:
+            xdotool(['windowkill', id])
+        except CalledProcessError:  # pragma: no cover
+            pass
+
+
+@contextmanager
+def leased_display(cfg, wait_xserver, xdotool):
+    """ Try to get a display from the pool.
+        Yields the display name or None if no pool is available. """
+    pool_dir = os.environ.get(POOL_ENV)
+    info = read_pool_info(pool_dir) if pool_dir else None
+    if info is None:
+        if pool_dir:
+            logger.debug('No display pool running at '+pool_dir)
+        yield None
+        return
+    if not _pool_matches(cfg, info):
+        logger.debug('The display pool uses different options, using a private X server')
+        yield None
+        return
+    lock = None
+    display = None
+    for i in range(int(LEASE_TIMEOUT/0.1)):
+        for display in info['displays']:
+            lock = _try_lock(pool_dir, display)
+            if lock:
+                break
+        if lock:
+            break
+        if i == 0:
+            logger.debug('All pool displays are in use, waiting')
+        time.sleep(0.1)
+    if lock is None:
+        logger.warning('Timed out waiting for a free display in the pool, using a private X server')
+        yield None
+        return
+    old_display = os.environ.get('DISPLAY')
+    os.environ['DISPLAY'] = display
+    logger.debug('Leased display '+display+' from the pool')
+    try:
+        try:
+            wait_xserver(1)
+            working = True
+        except RuntimeError:  # pragma: no cover
+            logger.warning('Display '+display+' from the pool is not working, using a private X server')
+            working = False
+        if not working:  # pragma: no cover
+            yield None
+            return
+        initial_windows = _visible_windows(xdotool)
+        try:
+            yield display
+        finally:
+            reset_display(xdotool, initial_windows)
+    finally:
+        if old_display is None:
+            del os.environ['DISPLAY']
+        else:
+            os.environ['DISPLAY'] = old_display
+        lock.close()
+
+
+class DisplayPool(object):
+    """ Starts and keeps alive a group of Xvfb servers """
+    def __init__(self, pool_dir, size, width, height, colordepth=24, use_wm=False):
+        self.pool_dir = pool_dir
+        self.size = size
+        self.width = width
+        self.height = height
+        self.colordepth = colordepth
+        self.use_wm = use_wm
+        # display name -> [Xvfb, WM process]
+        self.servers = {}
+
+    def _start_server(self):
+        # python3-xvfbwrapper
+        from xvfbwrapper import Xvfb
+        old_display = os.environ.get('DISPLAY')
+        xvfb = Xvfb(width=self.width, height=self.height, colordepth=self.colordepth)
+        xvfb.start()
+        name = ':{}'.format(xvfb.new_display)
+        wm = None
+        if self.use_wm:
+            wm = Popen(['fluxbox'], stdout=DEVNULL, stderr=DEVNULL, close_fds=True, start_new_session=True,
+                       env=dict(os.environ, DISPLAY=name))
+        # Xvfb.start() changes DISPLAY, we don't want it
+        if old_display is None:
+            os.environ.pop('DISPLAY', None)
+        else:
+            os.environ['DISPLAY'] = old_display
+        logger.debug('Pool display {} started'.format(name))
+        self.servers[name] = [xvfb, wm]
+        return name
+
+    def _stop_server(self, name):
+        xvfb, wm = self.servers.pop(name)
+        if wm:
+            wm.kill()
+            wm.wait()
+        xvfb.stop()
+
+    def _write_info(self):
+        info = {'pid': os.getpid(), 'width': self.width, 'height': self.height, 'colordepth': self.colordepth,
+                'use_wm': self.use_wm, 'displays': sorted(self.servers.keys())}
+        tmp_name = os.path.join(self.pool_dir, POOL_INFO+'.tmp')
+        with open(tmp_name, 'wt') as f:
+            json.dump(info, f)
+        os.rename(tmp_name, os.path.join(self.pool_dir, POOL_INFO))
+
+    def start(self):
+        os.makedirs(self.pool_dir, exist_ok=True)
+        for _ in range(self.size):
+            self._start_server()
+        self._write_info()
+        logger.info('Display pool ready at {} ({})'.format(self.pool_dir, ' '.join(sorted(self.servers.keys()))))
+
+    def check(self):
+        """ Restart any dead server """
+        for name, (xvfb, wm) in list(self.servers.items()):
+            if xvfb.proc.poll() is None and (wm is None or wm.poll() is None):
+                continue
+            logger.warning('Pool display {} died, restarting it'.format(name))
+            self._stop_server(name)
+            self._start_server()
+            self._write_info()
+
+    def stop(self):
+        try:
+            os.remove(os.path.join(self.pool_dir, POOL_INFO))
+        except OSError:  # pragma: no cover
+            pass
+        for name in list(self.servers.keys()):
+            self._stop_server(name)
+
+    def run(self):
+        """ Keep the pool alive until we get SIGTERM/SIGINT """
+        running = [True]
+
+        def stop_running(signum, frame):
+            running[0] = False
+
+        signal.signal(signal.SIGTERM, stop_running)
+        signal.signal(signal.SIGINT, stop_running)
+        self.start()
+        try:
+            while running[0]:
+                time.sleep(1)
+                self.check()
+        finally:
+            logger.info('Stopping the display pool')
+            self.stop()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 Salvador E. Tropea
+# Copyright (c) 2020 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+Compiled error filters.
+
+The filters are grouped by error code. The regexes of each group are also
+merged into one alternation, used to discard the errors that don't match
+any filter using only one search. Only when the alternation matches we try
+the regexes one by one, to find the first filter (in file order), as we did
+before. Groups where merging could change the meaning (i.e. back
+references) use the individual regexes.
+So most violations need one dict lookup and one regex search.
+"""
+import re
+
+from kiauto import log
+logger = log.get_logger(__name__)
+
+# Things that depend on the group numbers or must be at the start of the regex
+UNSAFE_TO_MERGE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(|\(\?[aiLmsux]+\)')
+CODE = re.compile(r'^\(([^)]*)\)')
+
+
+class ErrorFilter(object):
+    __slots__ = ('code', 'regex', 'line', 'hits')
+
+    def __init__(self, code, regex, line):
+        self.code = code
+        self.regex = regex
+        self.line = line
+        self.hits = 0
+
+
+class ErrorFilters(object):
+    def __init__(self):
+        self.filters = []
+        # code -> (merged regex or None, [(compiled regex, filter)]), None until compiled
+        self.index = None
+
+    def __len__(self):
+        return len(self.filters)
+
+    def add(self, code, regex, line=0):
+        """ Adds a filter, raises re.error if the regex isn't valid """
+        re.compile(regex)
+        self.filters.append(ErrorFilter(code, regex, line))
+        self.index = None
+
+    def compile(self):
+        """ Groups the filters by error code and merges the regexes of each group """
+        groups = {}
+        for f in self.filters:
+            groups.setdefault(f.code, []).append(f)
+        self.index = {}
+        for code, group in groups.items():
+            merged = None
+            if len(group) > 1 and not any(UNSAFE_TO_MERGE.search(f.regex) for f in group):
+                try:
+                    merged = re.compile('|'.join('(?:{})'.format(f.regex) for f in group))
+                except re.error:
+                    # i.e. the same group name used by two filters
+                    logger.debug('Unable to merge the `{}` filters'.format(code))
+            self.index[code] = (merged, [(re.compile(f.regex), f) for f in group])
+
+    def match(self, err):
+        """ The filter that matches the error (first in file order), or None """
+        if self.index is None:
+            self.compile()
+        m = CODE.match(err)
+        if m is None:
+            return None
+        group = self.index.get(m.group(1))
+        if group is None:
+            return None
+        merged, filters = group
+        if merged is not None and merged.search(err) is None:
+            return None
+        for compiled, f in filters:
+            if compiled.search(err):
+                f.hits += 1
+                return f
+        return None
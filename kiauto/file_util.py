@@ -16,47 +16,147 @@ import os
 import time
 import re
 import shutil
+import tempfile
 import atexit
+import select
+import struct
+import ctypes
+import ctypes.util
 # python3-psutil
 import psutil
 
-from kiauto.misc import (WRONG_ARGUMENTS, KICAD_VERSION_5_99)
+from kiauto.misc import (WRONG_ARGUMENTS, KICAD_VERSION_5_99, WaitTimeout)
 from kiauto import log
+from kiauto import trace
 logger = log.get_logger(__name__)
 
 
-def wait_for_file_created_by_process(pid, file, timeout=15):
-    process = psutil.Process(pid)
+# inotify events (from sys/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
 
-    DELAY = 0.2
-    logger.debug('Waiting for file %s (pid %d)', file, pid)
-    for i in range(int(timeout/DELAY)):
-        kicad_died = False
+
+class Inotify(object):
+    """ Minimal inotify interface using ctypes """
+    libc = None
+
+    def __init__(self, path, mask):
+        if Inotify.libc is None:
+            Inotify.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = Inotify.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+        if Inotify.libc.inotify_add_watch(self.fd, os.fsencode(path), mask) < 0:
+            err = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(err, 'inotify_add_watch')
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """ Returns the names reported by the pending events """
+        names = []
         try:
-            open_files = process.open_files()
-        except psutil.AccessDenied:
-            # Is our child, this access denied is because we are listing
-            # files for other process that took the pid of the old KiCad.
-            kicad_died = True
-        if kicad_died:
-            raise RuntimeError('KiCad unexpectedly died')
-        logger.debug(open_files)
-        if os.path.isfile(file):
-            file_open = False
-            for open_file in open_files:
-                if open_file.path == file:
-                    file_open = True
-            if file_open:
+            data = os.read(self.fd, 64*1024)
+        except BlockingIOError:  # pragma: no cover
+            return names
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, size = INOTIFY_EVENT.unpack_from(data, pos)
+            pos += INOTIFY_EVENT.size
+            names.append(os.fsdecode(data[pos:pos+size].rstrip(b'\0')))
+            pos += size
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _file_ready(process, file):
+    """ True if the file exists and the process doesn't have it open """
+    try:
+        open_files = process.open_files()
+    except psutil.AccessDenied:
+        # Is our child, this access denied is because we are listing
+        # files for other process that took the pid of the old KiCad.
+        raise RuntimeError('KiCad unexpectedly died')
+    logger.debug(open_files)
+    if os.path.isfile(file):
+        for open_file in open_files:
+            if open_file.path == file:
                 logger.debug('Waiting for process to close file')
-            else:
-                return
-        else:
-            logger.debug('Waiting for process to create file')
+                return False
+        return True
+    logger.debug('Waiting for process to create file')
+    return False
+
+
+def _wait_for_file_polling(process, file, timeout):
+    DELAY = 0.2
+    for i in range(int(timeout/DELAY)):
+        if _file_ready(process, file):
+            return
         time.sleep(DELAY)
+    raise WaitTimeout('Timed out waiting for creation of %s' % file)
+
+
+def _pidfd(pid):
+    """ A file descriptor that becomes readable when the process dies (Linux 5.3+ and Python 3.9+) """
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
 
-    raise RuntimeError('Timed out waiting for creation of %s' % file)
 
+def _is_alive(process):
+    try:
+        return process.status() != psutil.STATUS_ZOMBIE
+    except psutil.NoSuchProcess:
+        return False
 
+
+@trace.traced('wait')
+def wait_for_file_created_by_process(pid, file, timeout=15):
+    process = psutil.Process(pid)
+    logger.debug('Waiting for file %s (pid %d)', file, pid)
+    try:
+        watcher = Inotify(os.path.dirname(file), IN_CLOSE_WRITE | IN_MOVED_TO)
+    except (OSError, AttributeError) as e:
+        logger.debug('Unable to use inotify ({}), polling'.format(e))
+        _wait_for_file_polling(process, file, timeout)
+        return
+    name = os.path.basename(file)
+    pidfd = _pidfd(pid)
+    try:
+        # The watch is already installed, so we can't miss the close
+        if _file_ready(process, file):
+            return
+        deadline = time.time()+timeout
+        while True:
+            remaining = deadline-time.time()
+            if remaining <= 0:
+                raise WaitTimeout('Timed out waiting for creation of %s' % file)
+            # Without pidfd we check if KiCad is alive from time to time
+            fds = [watcher] if pidfd is None else [watcher, pidfd]
+            ready = select.select(fds, [], [], remaining if pidfd is not None else min(remaining, 0.2))[0]
+            if watcher in ready and name in watcher.read():
+                logger.debug('File closed after writing')
+                return
+            if pidfd in ready or (pidfd is None and not _is_alive(process)):
+                if os.path.isfile(file):
+                    return
+                raise RuntimeError('KiCad unexpectedly died')
+    finally:
+        watcher.close()
+        if pidfd is not None:
+            os.close(pidfd)
+
+
+@trace.traced('report')
 def load_filters(cfg, file):
     """ Load errors filters """
     if not os.path.isfile(file):
@@ -71,65 +171,65 @@ def load_filters(cfg, file):
             if len(line) > 0 and line[0] != '#':
                 m = re.search(r'^(\S+)\s*,(.*)$', line)
                 if m:
-                    cfg.err_filters.append([m.group(1), m.group(2)])
+                    try:
+                        cfg.err_filters.add(m.group(1), m.group(2), ln)
+                    except re.error as e:
+                        logger.error('Wrong regex at line {} in filter file `{}`: `{}` ({})'.format(ln, file, line, e))
+                        exit(WRONG_ARGUMENTS)
                     fl = fl+1
                 else:
                     logger.error('Syntax error at line {} in filter file `{}`: `{}`'.format(ln, file, line))
                     logger.error('Use `ERROR_NUMBER,REGEX` format')
                     exit(WRONG_ARGUMENTS)
             ln = ln+1
+        cfg.err_filters.compile()
         logger.info('Loaded {} error filters from `{}`'.format(fl, file))
 
 
+@trace.traced('report')
 def apply_filters(cfg, err_name, wrn_name):
-    """ Apply the error filters to the list of errors and unconnecteds """
+    """ Apply the error filters to the list of errors and unconnecteds.
+        The violations that match a filter get it in their `filter` member. """
     if len(cfg.err_filters) == 0:
         return (0, 0)
+    filters = cfg.err_filters
     skip_err = 0
-    for i, err in enumerate(cfg.errs):
-        for f in cfg.err_filters:
-            if err.startswith('({})'.format(f[0])):
-                m = re.search(f[1], err)
-                if m:
-                    skip_err += 1
-                    logger.warning('Ignoring '+err)
-                    logger.debug('Matched regex `{}`'.format(f[1]))
-                    cfg.errs[i] = None
-                    break
+    for err in cfg.errs:
+        text = str(err)
+        f = filters.match(text)
+        if f:
+            skip_err += 1
+            logger.warning('Ignoring '+text)
+            logger.debug('Matched regex `{}`'.format(f.regex))
+            err.filter = f
     if skip_err:
         logger.info('Ignoring {} {}'.format(skip_err, err_name))
     skip_wrn = 0
-    for i, wrn in enumerate(cfg.wrns):
-        for f in cfg.err_filters:
-            if wrn.startswith('({})'.format(f[0])):
-                m = re.search(f[1], wrn)
-                if m:
-                    skip_wrn += 1
-                    logger.info('Ignoring '+wrn)
-                    logger.debug('Matched regex `{}`'.format(f[1]))
-                    cfg.wrns[i] = None
-                    break
+    for wrn in cfg.wrns:
+        text = str(wrn)
+        f = filters.match(text)
+        if f:
+            skip_wrn += 1
+            logger.info('Ignoring '+text)
+            logger.debug('Matched regex `{}`'.format(f.regex))
+            wrn.filter = f
     if skip_wrn:
         logger.info('Ignoring {} {}'.format(skip_wrn, wrn_name))
+    for f in filters.filters:
+        logger.debug('Filter at line {} (`{},{}`) matched {} time/s'.format(f.line, f.code, f.regex, f.hits))
     return skip_err, skip_wrn
 
 
 def list_errors(cfg):
     for err in cfg.errs:
-        if err:
-            logger.error(err)
+        if err.filter is None:
+            logger.error(str(err))
 
 
 def list_warnings(cfg):
     for wrn in cfg.wrns:
-        if wrn:
-            logger.warning(wrn)
-
-
-def check_kicad_config_dir(cfg):
-    if not os.path.isdir(cfg.kicad_conf_path):
-        logger.debug('Creating KiCad config dir')
-        os.makedirs(cfg.kicad_conf_path, exist_ok=True)
+        if wrn.filter is None:
+            logger.warning(str(wrn))
 
 
 def check_lib_table(fuser, fsys):
@@ -143,41 +243,34 @@ def check_lib_table(fuser, fsys):
                        ' KiCad will most probably fail')  # pragma: no cover
 
 
-def restore_one_config(name, fname, fbkp):
-    if fbkp and os.path.exists(fbkp):
-        if os.path.exists(fname):
-            os.remove(fname)
-        os.rename(fbkp, fname)
-        logger.debug('Restoring old %s config', name)
-        return None
-    return fbkp
-
-
-def restore_config(cfg):
-    """ Restore original user configuration """
-    cfg.conf_eeschema_bkp = restore_one_config('eeschema', cfg.conf_eeschema, cfg.conf_eeschema_bkp)
-    cfg.conf_kicad_bkp = restore_one_config('KiCad common', cfg.conf_kicad, cfg.conf_kicad_bkp)
-    cfg.conf_hotkeys_bkp = restore_one_config('user hotkeys', cfg.conf_hotkeys, cfg.conf_hotkeys_bkp)
-    cfg.conf_pcbnew_bkp = restore_one_config('pcbnew', cfg.conf_pcbnew, cfg.conf_pcbnew_bkp)
-
-
-def backup_config(name, file, err, cfg):
-    config_file = file
-    old_config_file = file+'.pre_script'
-    logger.debug(name+' config: '+config_file)
-    # If we have an old back-up ask for the user to solve it
-    if os.path.isfile(old_config_file):
-        logger.error(name+' config back-up found (%s)', old_config_file)
-        logger.error('It could contain your %s configuration, rename it to %s or discard it.', name.lower(), config_file)
-        exit(err)
-    if os.path.isfile(config_file):
-        logger.debug('Moving current config to '+old_config_file)
-        os.rename(config_file, old_config_file)
-        atexit.register(restore_config, cfg)
-        return old_config_file
-    return None
-
-
+@trace.traced('config')
+def create_config_home(cfg):
+    """ Creates a private KiCad config for this run, the user config is never modified.
+        KiCad runs with HOME, XDG_CONFIG_HOME and KICAD_CONFIG_HOME pointing to it (cfg.env).
+        The KiCad common config (environment vars) and the libs tables are copied from the user config. """
+    user_conf_path = cfg.user_conf_path
+    cfg.config_home = tempfile.mkdtemp(prefix='kiauto-home-')
+    atexit.register(remove_config_home, cfg)
+    config_dir = os.path.join(cfg.config_home, '.config')
+    cfg.set_config_path(os.path.join(config_dir, cfg.kicad_conf_dir))
+    logger.debug('Using a private KiCad config: '+cfg.kicad_conf_path)
+    os.makedirs(cfg.kicad_conf_path)
+    for file in [cfg.conf_kicad, cfg.user_sym_lib_table, cfg.user_fp_lib_table]:
+        user_file = os.path.join(user_conf_path, os.path.basename(file))
+        if os.path.isfile(user_file):
+            logger.debug('Copying '+user_file)
+            shutil.copy2(user_file, file)
+    cfg.env = dict(os.environ, HOME=cfg.config_home, XDG_CONFIG_HOME=config_dir, KICAD_CONFIG_HOME=cfg.kicad_conf_path)
+
+
+def remove_config_home(cfg):
+    if cfg.config_home:
+        logger.debug('Removing the private KiCad config')
+        shutil.rmtree(cfg.config_home, ignore_errors=True)
+        cfg.config_home = None
+
+
+@trace.traced('config')
 def create_user_hotkeys(cfg):
     logger.debug('Creating a user hotkeys config')
     with open(cfg.conf_hotkeys, "wt") as text_file:
@@ -205,13 +298,10 @@ def check_input_file(cfg, no_file, no_ext):
         logger.warning('Using old format files is not recommended. Convert them first.')
 
 
+@trace.traced('project')
 def memorize_project(cfg):
-    """ Detect the .pro filename and try to read it and its mtime.
-        If KiCad changes it then we'll try to revert the changes """
-    cfg.pro_stat = None
-    cfg.pro_content = None
-    cfg.prl_stat = None
-    cfg.prl_content = None
+    """ Detect the .pro filename. The project files are protected by cfg.project_lock (taken when creating cfg),
+        if KiCad changes them we'll revert the changes """
     name_no_ext = os.path.splitext(cfg.input_file)[0]
     cfg.pro_name = name_no_ext+'.'+cfg.pro_ext
     if not os.path.isfile(cfg.pro_name):
@@ -221,41 +311,10 @@ def memorize_project(cfg):
             return
         if cfg.kicad_version >= KICAD_VERSION_5_99:
             logger.warning('Using old format projects is not recommended. Convert them first.')
-    if cfg.pro_name[-4:] == '.pro':
-        cfg.pro_stat = cfg.start_pro_stat
-    else:
-        cfg.pro_stat = cfg.start_kicad_pro_stat
-    with open(cfg.pro_name) as f:
-        cfg.pro_content = f.read()
     atexit.register(restore_project, cfg)
-    if cfg.prl_ext:
-        cfg.prl_name = name_no_ext+'.'+cfg.prl_ext
-        if not os.path.isfile(cfg.prl_name):
-            return
-        cfg.prl_stat = cfg.start_kicad_prl_stat
-        with open(cfg.prl_name) as f:
-            cfg.prl_content = f.read()
-
-
-def _restore_project(name, stat_v, content):
-    logger.debug('Checking if %s was modified', name)
-    if stat_v and content:
-        pro_found = False
-        if os.path.isfile(name):
-            new_stat = os.stat(name)
-            pro_found = True
-        else:  # pragma: no cover
-            logger.warning('Project file lost')
-        if not pro_found or new_stat.st_mtime != stat_v.st_mtime:
-            logger.debug('Restoring the project file')
-            os.rename(name, name+'-bak')
-            with open(name, 'wt') as f:
-                f.write(content)
-            os.utime(name, times=(stat_v.st_atime, stat_v.st_mtime))
 
 
+@trace.traced('project')
 def restore_project(cfg):
-    """ If the .pro was modified try to restore it """
-    _restore_project(cfg.pro_name, cfg.pro_stat, cfg.pro_content)
-    if cfg.prl_ext and cfg.prl_stat:
-        _restore_project(cfg.prl_name, cfg.prl_stat, cfg.prl_content)
+    """ Release the project, if we are the last job using it the modified files are restored """
+    cfg.project_lock.release()
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 Salvador E. Tropea
+# Copyright (c) 2020 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+Prometheus metrics in the node_exporter textfile collector format.
+
+Enabled when KIAUS_METRICS_FILE points to a *.prom file. We get the spans
+recorded by kiauto.trace and, at exit, add our values to the ones already
+in the file. The file is locked while merging and replaced atomically, so
+many jobs can share it.
+"""
+import atexit
+import fcntl
+import os
+import re
+import tempfile
+import time
+
+from kiauto import trace
+from kiauto import log
+from kiauto.misc import WaitTimeout
+logger = log.get_logger(__name__)
+
+# Environment variable used to indicate the file
+METRICS_ENV = 'KIAUS_METRICS_FILE'
+# Upper bounds for the duration histograms (seconds)
+BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120, 300]
+JOB = 'kiauto_job_duration_seconds'
+PHASE = 'kiauto_phase_duration_seconds'
+TIMEOUTS = 'kiauto_wait_timeouts_total'
+RETRIES = 'kiauto_retries_total'
+KILLS = 'kiauto_process_kills_total'
+FAMILIES = [(JOB, 'histogram', 'Duration of the jobs'),
+            (PHASE, 'histogram', 'Duration of each phase (waits, commands, processes, etc.)'),
+            (TIMEOUTS, 'counter', 'Waits that timed out'),
+            (RETRIES, 'counter', 'Retries while waiting for KiCad'),
+            (KILLS, 'counter', 'Processes that ignored SIGTERM and were killed')]
+# The spans we don't want as phases, too many and too short
+SKIP_CATEGORIES = {'xdotool', 'clipboard'}
+SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})? (\S+)$')
+
+
+def _escape(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _family(name):
+    for suffix in ['_bucket', '_sum', '_count']:
+        if name.endswith(suffix) and name[:-len(suffix)] in (JOB, PHASE):
+            return name[:-len(suffix)]
+    return name
+
+
+class Metrics(object):
+    def __init__(self, file, script, command):
+        self.file = file
+        self.start = time.time()
+        self.labels = {'script': script, 'command': command or 'none', 'kicad_version': 'unknown'}
+        # (family, value, labels) for the histograms, (family, labels) for the counters
+        self.observations = []
+        self.counts = []
+        self.result = 'error'
+
+    def _labels(self, extra=None):
+        labels = dict(self.labels)
+        if extra:
+            labels.update(extra)
+        return ','.join('{}="{}"'.format(k, _escape(v)) for k, v in labels.items())
+
+    # Sink interface (kiauto.trace)
+
+    def span(self, name, cat, dur, args):
+        if cat in SKIP_CATEGORIES:
+            return
+        self.observations.append((PHASE, dur/1000000, {'phase': name, 'category': cat}))
+        if cat == 'wait' and args.get('error') == WaitTimeout.__name__:
+            self.counts.append((TIMEOUTS, {'wait': name}))
+
+    def event(self, name, cat, args):
+        if name == 'retry':
+            self.counts.append((RETRIES, {'wait': args.get('wait', 'unknown')}))
+        elif name == 'SIGKILL':
+            self.counts.append((KILLS, {'process': args.get('process', 'unknown')}))
+
+    def _samples(self):
+        """ Our values, as {sample: increment} """
+        samples = {}
+
+        def add(key, value):
+            samples[key] = samples.get(key, 0)+value
+
+        observations = self.observations+[(JOB, time.time()-self.start, {'result': self.result})]
+        for family, value, extra in observations:
+            labels = self._labels(extra)
+            # Cumulative buckets, all of them must be present
+            for b in BUCKETS:
+                add('{}_bucket{{{},le="{}"}}'.format(family, labels, b), int(value <= b))
+            add('{}_bucket{{{},le="+Inf"}}'.format(family, labels), 1)
+            add('{}_sum{{{}}}'.format(family, labels), value)
+            add('{}_count{{{}}}'.format(family, labels), 1)
+        for family, extra in self.counts:
+            add('{}{{{}}}'.format(family, self._labels(extra)), 1)
+        return samples
+
+    def _read(self):
+        """ Values already in the file, as {sample: value} """
+        samples = {}
+        try:
+            with open(self.file, 'rt') as f:
+                for line in f:
+                    m = SAMPLE.match(line.strip())
+                    if m:
+                        samples[m.group(1)+(m.group(2) or '')] = float(m.group(3))
+        except (OSError, ValueError, UnicodeDecodeError) as e:
+            if os.path.isfile(self.file):
+                logger.warning('Discarding the metrics in {} ({})'.format(self.file, e))
+        return samples
+
+    def write(self):
+        """ Adds our values to the file """
+        try:
+            with open(self.file+'.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                samples = self._read()
+                for key, value in self._samples().items():
+                    samples[key] = samples.get(key, 0)+value
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.file)), suffix='.tmp')
+                with os.fdopen(fd, 'wt') as f:
+                    for family, kind, help in FAMILIES:
+                        lines = ['{} {}\n'.format(k, repr(v) if isinstance(v, float) and not v.is_integer() else int(v))
+                                 for k, v in samples.items() if _family(k.split('{')[0]) == family]
+                        if lines:
+                            f.write('# HELP {} {}\n# TYPE {} {}\n'.format(family, help, family, kind))
+                            f.writelines(lines)
+                # node_exporter needs to read it
+                os.chmod(tmp, 0o644)
+                os.replace(tmp, self.file)
+        except OSError as e:
+            logger.warning('Unable to write the metrics to {} ({})'.format(self.file, e))
+
+
+_metrics = None
+
+
+def start(script, command):
+    """ Starts collecting metrics if METRICS_ENV is defined """
+    global _metrics
+    file = os.environ.get(METRICS_ENV)
+    if not file:
+        return
+    _metrics = Metrics(file, script, command)
+    trace.set_sink(_metrics)
+    atexit.register(_metrics.write)
+
+
+def set_kicad_version(cfg):
+    if _metrics is not None:
+        _metrics.labels['kicad_version'] = '{}.{}.{}'.format(cfg.kicad_version_major, cfg.kicad_version_minor,
+                                                             cfg.kicad_version_patch)
+
+
+def set_result(error_level):
+    """ The job finished, error_level is the exit code (negative for ERC/DRC violations) """
+    if _metrics is not None:
+        _metrics.result = 'ok' if error_level == 0 else 'violations'
@@ -5,7 +5,15 @@
 # Project: KiAuto (formerly kicad-automation-scripts)
 import os
 import re
+from glob import glob
+from importlib.util import find_spec
 from sys import exit, path
+from time import perf_counter
+
+from kiauto import cache
+from kiauto.error_filter import ErrorFilters
+from kiauto.project_lock import ProjectLock
+from kiauto import trace
 
 # Default W,H for recording
 REC_W = 1366
@@ -15,6 +23,7 @@ REC_H = 960
 # Positive values are ERC/DRC errors
 NO_SCHEMATIC = 1
 WRONG_ARGUMENTS = 2   # This is what argsparse uses
+# The *_CFG_PRESENT and USER_HOTKEYS_PRESENT codes are no longer used, each run has a private config
 EESCHEMA_CFG_PRESENT = 11
 KICAD_CFG_PRESENT = 3
 NO_PCB = 4
@@ -27,37 +36,82 @@ EESCHEMA_ERROR = 10
 NO_PCBNEW_MODULE = 11
 USER_HOTKEYS_PRESENT = 12
 CORRUPTED_PCB = 13
+BATCH_JOB_FAILED = 14
 # Wait 40 s to pcbnew/eeschema window to be present
 WAIT_START = 40
+# Wait upto 60 s for the ERC/DRC to finish
+WAIT_ERC = 60
+WAIT_DRC = 60
 # Name for testing versions
 NIGHTLY = 'nightly'
 
 KICAD_VERSION_5_99 = 5099000
+# Cache section for the KiCad version
+VERSION_CACHE = 'kicad_version'
 KICAD_SHARE = '/usr/share/kicad/'
 KICAD_NIGHTLY_SHARE = '/usr/share/kicad-nightly/'
 
 
+def _no_pcbnew(logger):
+    logger.error("Failed to import pcbnew Python module."
+                 " Is KiCad installed?"
+                 " Do you need to add it to PYTHONPATH?")
+    exit(NO_PCBNEW_MODULE)
+
+
+@trace.traced('startup')
+def get_kicad_version(logger):
+    """ KiCad version string (GetBuildVersion).
+        Importing pcbnew is slow, so we cache it using the module path and mtime as key. """
+    try:
+        spec = find_spec('pcbnew')
+    except (ImportError, ValueError):
+        spec = None
+    if spec is None or spec.origin is None:
+        _no_pcbnew(logger)
+    # The Python wrapper and the shared object
+    files = [spec.origin]+sorted(glob(os.path.join(os.path.dirname(spec.origin), '_pcbnew*')))
+    try:
+        key = cache.key_for(*[(f, os.stat(f).st_mtime_ns) for f in files])
+    except OSError:
+        key = None
+    if key:
+        data = cache.load_json(VERSION_CACHE, key)
+        if data and 'version' in data:
+            return data['version']
+    try:
+        import pcbnew
+    except ImportError:
+        _no_pcbnew(logger)
+    version = pcbnew.GetBuildVersion()
+    if key:
+        cache.save_json(VERSION_CACHE, key, {'version': version})
+    return version
+
+
+class WaitTimeout(RuntimeError):
+    """ Timed out waiting for KiCad or the X server """
+    pass
+
+
 class Config(object):
     def __init__(self, logger, input_file=None, args=None):
+        # Used for the total time in the JSON summary
+        self.start_time = perf_counter()
         self.export_format = 'pdf'
         if input_file:
             self.input_file = input_file
             self.input_no_ext = os.path.splitext(input_file)[0]
             #
-            # As soon as we init pcbnew the following files are modified:
+            # As soon as we init pcbnew the following files are modified, take a snapshot now.
+            # Other jobs can use the project at the same time, unless we are going to modify it (--save)
+            # Not needed for --scratch, KiCad uses a copy
             #
-            if os.path.isfile(self.input_no_ext+'.pro'):
-                self.start_pro_stat = os.stat(self.input_no_ext+'.pro')
-            else:
-                self.start_pro_stat = None
-            if os.path.isfile(self.input_no_ext+'.kicad_pro'):
-                self.start_kicad_pro_stat = os.stat(self.input_no_ext+'.kicad_pro')
-            else:
-                self.start_kicad_pro_stat = None
-            if os.path.isfile(self.input_no_ext+'.kicad_prl'):
-                self.start_kicad_prl_stat = os.stat(self.input_no_ext+'.kicad_prl')
-            else:
-                self.start_kicad_prl_stat = None
+            self.project_lock = ProjectLock(input_file, exclusive=getattr(args, 'save', False))
+            self.project_lock.acquire()
+            if not getattr(args, 'scratch', False):
+                self.project_lock.protect([self.input_no_ext+ext for ext in ('.pro', '.kicad_pro', '.kicad_prl')],
+                                          keep_modified=True)
         if args:
             # Session debug
             self.use_wm = args.use_wm  # Use a Window Manager, dialogs behaves in a different way
@@ -93,37 +147,24 @@ class Config(object):
             # Path to the Python module
             path.insert(0, '/usr/lib/kicad-nightly/lib/python3/dist-packages')
         # Detect KiCad version
-        try:
-            import pcbnew
-        except ImportError:
-            logger.error("Failed to import pcbnew Python module."
-                         " Is KiCad installed?"
-                         " Do you need to add it to PYTHONPATH?")
-            exit(NO_PCBNEW_MODULE)
-        m = re.match(r'(\d+)\.(\d+)\.(\d+)', pcbnew.GetBuildVersion())
+        m = re.match(r'(\d+)\.(\d+)\.(\d+)', get_kicad_version(logger))
         self.kicad_version_major = int(m.group(1))
         self.kicad_version_minor = int(m.group(2))
         self.kicad_version_patch = int(m.group(3))
         self.kicad_version = self.kicad_version_major*1000000+self.kicad_version_minor*1000+self.kicad_version_patch
         logger.debug('Detected KiCad v{}.{}.{} ({})'.format(self.kicad_version_major, self.kicad_version_minor,
                      self.kicad_version_patch, self.kicad_version))
-        # Config file names
-        self.kicad_conf_path = os.path.join(os.environ['HOME'], '.config/'+self.kicad_conf_dir)
-        # - eeschema config
-        self.conf_eeschema = os.path.join(self.kicad_conf_path, 'eeschema')
-        self.conf_eeschema_bkp = None
-        # - pcbnew config
-        self.conf_pcbnew = os.path.join(self.kicad_conf_path, 'pcbnew')
-        self.conf_pcbnew_bkp = None
-        # - kicad config
-        self.conf_kicad = os.path.join(self.kicad_conf_path, 'kicad_common')
-        self.conf_kicad_bkp = None
+        # The user config, only used to copy the environment vars and libs tables (see file_util.create_config_home)
+        self.user_conf_path = os.environ.get('KICAD_CONFIG_HOME')
+        if not self.user_conf_path:
+            config_home = os.environ.get('XDG_CONFIG_HOME') or os.path.join(os.environ['HOME'], '.config')
+            self.user_conf_path = os.path.join(config_home, self.kicad_conf_dir)
+        # Private config used for this run, environment for KiCad and temporal HOME
+        self.env = None
+        self.config_home = None
         # Config files that migrated to JSON
         # Note that they remain in the old format until saved
         if self.kicad_version >= KICAD_VERSION_5_99:
-            self.conf_eeschema += '.json'
-            self.conf_pcbnew += '.json'
-            self.conf_kicad += '.json'
             self.conf_kicad_json = True
             self.conf_eeschema_json = True
             self.conf_pcbnew_json = True
@@ -135,12 +176,7 @@ class Config(object):
             self.conf_pcbnew_json = False
             self.pro_ext = 'pro'
             self.prl_ext = None
-        # - hotkeys
-        self.conf_hotkeys = os.path.join(self.kicad_conf_path, 'user.hotkeys')
-        self.conf_hotkeys_bkp = None
-        # - sym-lib-table
-        self.user_sym_lib_table = os.path.join(self.kicad_conf_path, 'sym-lib-table')
-        self.user_fp_lib_table = os.path.join(self.kicad_conf_path, 'fp-lib-table')
+        self.set_config_path(self.user_conf_path)
         self.sys_sym_lib_table = [KICAD_SHARE+'template/sym-lib-table']
         self.sys_fp_lib_table = [KICAD_SHARE+'template/fp-lib-table']
         if ng_ver:
@@ -154,11 +190,22 @@ class Config(object):
         else:
             # KiCad 5.1.6
             self.ee_window_title = r'Eeschema.*\.sch'  # "Eeschema - file.sch"
-        # Collected errors and unconnecteds (warnings)
+        # Collected errors and unconnecteds (warnings), kiauto.violations.Violation objects
         self.errs = []
         self.wrns = []
         # Error filters
-        self.err_filters = []
+        self.err_filters = ErrorFilters()
+
+    def set_config_path(self, path):
+        """ Config file names for the KiCad config in `path` """
+        self.kicad_conf_path = path
+        ext = '.json' if self.conf_kicad_json else ''
+        self.conf_eeschema = os.path.join(path, 'eeschema'+ext)
+        self.conf_pcbnew = os.path.join(path, 'pcbnew'+ext)
+        self.conf_kicad = os.path.join(path, 'kicad_common'+ext)
+        self.conf_hotkeys = os.path.join(path, 'user.hotkeys')
+        self.user_sym_lib_table = os.path.join(path, 'sym-lib-table')
+        self.user_fp_lib_table = os.path.join(path, 'fp-lib-table')
 
 
 __author__ = 'Salvador E. Tropea'
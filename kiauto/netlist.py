@@ -0,0 +1,514 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 Salvador E. Tropea
+# Copyright (c) 2020 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+Netlist generation from KiCad 6 schematics without running eeschema.
+
+Loads the .kicad_sch hierarchy, solves the connectivity (wires, junctions,
+labels, sheet pins and power pins) and writes the netlist using the same
+structure eeschema uses (sexp and XML). Anything we can't solve (i.e. buses)
+raises HeadlessError, so the caller can use eeschema instead.
+"""
+import os
+import re
+import time
+from xml.sax.saxutils import (escape, quoteattr)
+
+from kiauto import sexp
+from kiauto.misc import __version__
+from kiauto import log
+logger = log.get_logger(__name__)
+
+# Priority of the net name sources, like eeschema does
+PRIORITY_PIN = 1
+PRIORITY_SHEET_PIN = 2
+PRIORITY_HIER = 3
+PRIORITY_LOCAL = 4
+PRIORITY_POWER = 5
+PRIORITY_GLOBAL = 6
+# Fields that aren't exported as user fields
+STD_FIELDS = {'Reference', 'Value', 'Footprint', 'Datasheet'}
+# KiCad 6 schematic internal units: 100 nm
+IU_PER_MM = 10000
+
+
+class HeadlessError(Exception):
+    """ The schematic needs eeschema """
+    pass
+
+
+def natural_key(s):
+    return [int(c) if c.isdigit() else c for c in re.split(r'(\d+)', s)]
+
+
+def _point(at):
+    """ Coordinates as integers, so we can compare them """
+    return (int(round(float(at[1])*IU_PER_MM)), int(round(float(at[2])*IU_PER_MM)))
+
+
+def _on_segment(p, a, b):
+    """ True if p is inside the a-b segment (not in the extremes) """
+    if p == a or p == b:
+        return False
+    if (b[0]-a[0])*(p[1]-a[1]) != (b[1]-a[1])*(p[0]-a[0]):
+        return False
+    return min(a[0], b[0]) <= p[0] <= max(a[0], b[0]) and min(a[1], b[1]) <= p[1] <= max(a[1], b[1])
+
+
+def _is_bus_name(name):
+    return '{' in name or re.search(r'\[\d+\.\.\d+\]', name) is not None
+
+
+class LibSymbol(object):
+    def __init__(self, data):
+        self.lib_id = data[1]
+        self.lib, _, self.part = self.lib_id.rpartition(':')
+        self.power = sexp.find(data, 'power') is not None
+        self.properties = {p[1]: p[2] for p in sexp.find_all(data, 'property')}
+        # (unit, convert, number, name, type, hidden, x, y)
+        self.pins = []
+        for unit in sexp.find_all(data, 'symbol'):
+            m = re.search(r'_(\d+)_(\d+)$', unit[1])
+            u, c = (int(m.group(1)), int(m.group(2))) if m else (0, 0)
+            for pin in sexp.find_all(unit, 'pin'):
+                at = sexp.find(pin, 'at')
+                self.pins.append((u, c, sexp.value(pin, 'number', ''), sexp.value(pin, 'name', ''), pin[1],
+                                  sexp.has_flag(pin, 'hide'), float(at[1]), float(at[2])))
+
+    def unit_pins(self, unit, convert):
+        return [p for p in self.pins if p[0] in (0, unit) and p[1] in (0, convert)]
+
+
+class Symbol(object):
+    def __init__(self, data, lib_symbols):
+        self.lib_id = sexp.value(data, 'lib_id')
+        if self.lib_id not in lib_symbols:
+            raise HeadlessError('Missing library symbol `{}`'.format(self.lib_id))
+        self.lib_symbol = lib_symbols[self.lib_id]
+        at = sexp.find(data, 'at')
+        self.x = float(at[1])
+        self.y = float(at[2])
+        self.angle = int(float(at[3])) if len(at) > 3 else 0
+        self.mirror = sexp.value(data, 'mirror')
+        self.unit = int(sexp.value(data, 'unit', 1))
+        self.convert = int(sexp.value(data, 'convert', 1))
+        self.uuid = sexp.value(data, 'uuid')
+        self.in_bom = sexp.value(data, 'in_bom', 'yes') == 'yes'
+        self.fields = [(p[1], p[2]) for p in sexp.find_all(data, 'property')]
+        # KiCad 7 style instances: path -> reference
+        self.instances = {}
+        for inst in sexp.find_all(data, 'instances'):
+            for prj in sexp.find_all(inst, 'project'):
+                for path in sexp.find_all(prj, 'path'):
+                    self.instances[path[1]] = (sexp.value(path, 'reference'), int(sexp.value(path, 'unit', self.unit)))
+
+    def field(self, name, default=''):
+        for n, v in self.fields:
+            if n == name:
+                return v
+        return default
+
+    def transform(self, x, y):
+        """ Library coordinates (Y up) to schematic coordinates """
+        y = -y
+        a = self.angle % 360
+        if a == 90:
+            x, y = y, -x
+        elif a == 180:
+            x, y = -x, -y
+        elif a == 270:
+            x, y = -y, x
+        if self.mirror == 'x':
+            y = -y
+        elif self.mirror == 'y':
+            x = -x
+        return self.x+x, self.y+y
+
+
+class SheetFile(object):
+    """ The contents of a .kicad_sch """
+    def __init__(self, file):
+        self.file = file
+        try:
+            data = sexp.load(file)
+        except (OSError, UnicodeDecodeError, sexp.SexpError) as e:
+            raise HeadlessError('Unable to load `{}`: {}'.format(file, e))
+        if not data or data[0] != 'kicad_sch':
+            raise HeadlessError('`{}` is not a KiCad 6 schematic'.format(file))
+        if sexp.find(data, 'bus') or sexp.find(data, 'bus_entry'):
+            raise HeadlessError('Buses not supported')
+        lib_symbols = {}
+        ls = sexp.find(data, 'lib_symbols')
+        if ls:
+            for s in sexp.find_all(ls, 'symbol'):
+                lib_symbols[s[1]] = LibSymbol(s)
+        self.symbols = [Symbol(s, lib_symbols) for s in sexp.find_all(data, 'symbol')]
+        self.wires = [[_point(p) for p in sexp.find(w, 'pts')[1:]] for w in sexp.find_all(data, 'wire')]
+        self.junctions = [_point(sexp.find(j, 'at')) for j in sexp.find_all(data, 'junction')]
+        self.labels = []
+        for kind, priority in (('label', PRIORITY_LOCAL), ('global_label', PRIORITY_GLOBAL),
+                               ('hierarchical_label', PRIORITY_HIER)):
+            for lb in sexp.find_all(data, kind):
+                if _is_bus_name(lb[1]):
+                    raise HeadlessError('Buses not supported')
+                self.labels.append((priority, lb[1], _point(sexp.find(lb, 'at'))))
+        self.sheets = []
+        for s in sexp.find_all(data, 'sheet'):
+            props = sexp.find_all(s, 'property')
+            by_name = {p[1]: p[2] for p in props}
+            name = by_name.get('Sheet name', by_name.get('Sheetname', props[0][2] if props else ''))
+            file = by_name.get('Sheet file', by_name.get('Sheetfile', props[1][2] if len(props) > 1 else ''))
+            pins = [(p[1], _point(sexp.find(p, 'at'))) for p in sexp.find_all(s, 'pin')]
+            self.sheets.append((sexp.value(s, 'uuid'), name, file, pins, [(p[1], p[2]) for p in props[:2]]))
+        self.title_block = sexp.find(data, 'title_block')
+        # KiCad 6: references for all the instances are in the root sheet
+        self.symbol_instances = {}
+        si = sexp.find(data, 'symbol_instances')
+        if si:
+            for path in sexp.find_all(si, 'path'):
+                self.symbol_instances[path[1]] = path
+
+
+class SheetInstance(object):
+    def __init__(self, sheet_file, path, names, number, parent=None, props=None):
+        self.file = sheet_file
+        # UUIDs path, i.e. /00000000-0000-0000-0000-00005ca71704/
+        self.path = path
+        # Names path, i.e. /Power/
+        self.names = names
+        self.number = number
+        self.parent = parent
+        self.depth = 0 if parent is None else parent.depth+1
+        # Name and file properties of the sheet symbol
+        self.props = props or []
+        self.symbols = []
+
+
+class Component(object):
+    def __init__(self, ref, symbol, sheet, value, footprint):
+        self.ref = ref
+        self.symbol = symbol
+        self.lib_symbol = symbol.lib_symbol
+        self.sheet = sheet
+        self.value = value
+        self.footprint = footprint
+        self.datasheet = symbol.field('Datasheet')
+        if self.datasheet == '~':
+            self.datasheet = ''
+        self.fields = [(n, v) for n, v in symbol.fields if n not in STD_FIELDS and not n.startswith('ki_')]
+
+
+class Net(object):
+    def __init__(self, name, nodes):
+        self.name = name
+        # (ref, pin number, pin name)
+        self.nodes = nodes
+
+
+class _UnionFind(object):
+    """ Disjoint sets of connected points """
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, k):
+        parent = self.parent
+        root = k
+        while parent.setdefault(root, root) != root:
+            root = parent[root]
+        while parent[k] != root:
+            parent[k], k = root, parent[k]
+        return root
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            self.parent[ra] = rb
+
+
+class Netlist(object):
+    def __init__(self, file):
+        self.file = os.path.abspath(file)
+        self.dir = os.path.dirname(self.file)
+        self.root = SheetFile(self.file)
+        self.sheets = []
+        self.components = []
+        self.nets = []
+        self._load_hierarchy()
+        self._solve_references()
+        self._solve_nets()
+
+    def _load_hierarchy(self):
+        files = {}
+        root = SheetInstance(self.root, '/', '/', 1)
+        self.sheets.append(root)
+        pending = [root]
+        while pending:
+            parent = pending.pop(0)
+            for uuid, name, file, pins, props in parent.file.sheets:
+                fname = os.path.join(self.dir, file)
+                if fname not in files:
+                    files[fname] = SheetFile(fname)
+                inst = SheetInstance(files[fname], parent.path+uuid+'/', parent.names+name+'/', len(self.sheets)+1,
+                                     parent, props)
+                self.sheets.append(inst)
+                pending.append(inst)
+
+    def _solve_references(self):
+        by_ref = {}
+        for sheet in self.sheets:
+            comps = []
+            for s in sheet.file.symbols:
+                key = sheet.path+s.uuid
+                value = s.field('Value')
+                footprint = s.field('Footprint')
+                ref = s.field('Reference')
+                unit = s.unit
+                inst = self.root.symbol_instances.get(key)
+                if inst is not None:
+                    ref = sexp.value(inst, 'reference', ref)
+                    unit = int(sexp.value(inst, 'unit', unit))
+                    value = sexp.value(inst, 'value', value)
+                    footprint = sexp.value(inst, 'footprint', footprint)
+                elif key in s.instances:
+                    ref, unit = s.instances[key]
+                # The same file can be used by more than one sheet
+                sheet.symbols.append(_SymbolInstance(s, ref, unit))
+                if ref.startswith('#') or ref in by_ref:
+                    # Power symbols and other units of a multi-unit component
+                    continue
+                c = Component(ref, s, sheet, value, footprint)
+                by_ref[ref] = c
+                comps.append(c)
+            comps.sort(key=lambda c: natural_key(c.ref))
+            self.components.extend(comps)
+
+    def _connect_sheet(self, sheet, uf, drivers, pins):
+        """ Joins the points of a sheet, collects the net name drivers (key, priority, depth, name)
+            and the symbol pins (key, ref, number, name) """
+        sf = sheet.file
+        path = sheet.path
+        # Wires and points inside them
+        for w in sf.wires:
+            uf.union((path,)+w[0], (path,)+w[-1])
+        for p in sf.junctions+[lb[2] for lb in sf.labels]:
+            for w in sf.wires:
+                if _on_segment(p, w[0], w[-1]):
+                    uf.union((path,)+p, (path,)+w[0])
+        # Labels
+        for priority, name, p in sf.labels:
+            key = (path,)+p
+            if priority == PRIORITY_GLOBAL:
+                uf.union(key, ('global', name))
+                drivers.append((key, priority, sheet.depth, name))
+            elif priority == PRIORITY_LOCAL:
+                uf.union(key, ('local', path, name))
+                drivers.append((key, priority, sheet.depth, sheet.names+name))
+            else:
+                uf.union(key, ('hier', path, name))
+                drivers.append((key, priority, sheet.depth, sheet.names+name))
+        # Sheet pins connect with the hierarchical labels of the sub-sheet
+        for uuid, name, file, s_pins, props in sf.sheets:
+            for pin_name, p in s_pins:
+                key = (path,)+p
+                uf.union(key, ('hier', path+uuid+'/', pin_name))
+                drivers.append((key, PRIORITY_SHEET_PIN, sheet.depth, sheet.names+pin_name))
+        # Symbol pins
+        for s in sheet.symbols:
+            for _, _, number, name, type, hidden, x, y in s.symbol.lib_symbol.unit_pins(s.unit, s.symbol.convert):
+                key = (path,)+_point(('at',)+s.symbol.transform(x, y))
+                if type == 'power_in' and hidden:
+                    # Invisible power pins are global nets
+                    uf.union(key, ('global', name))
+                    drivers.append((key, PRIORITY_POWER, sheet.depth, name))
+                pins.append((key, s.ref, number, name))
+
+    def _solve_nets(self):
+        uf = _UnionFind()
+        drivers = []
+        pins = []
+        for sheet in self.sheets:
+            self._connect_sheet(sheet, uf, drivers, pins)
+        # Group by net
+        nets = {}
+        for key, ref, number, name in pins:
+            nets.setdefault(uf.find(key), []).append((ref, number, name))
+        best = {}
+        for key, priority, depth, name in drivers:
+            root = uf.find(key)
+            cur = best.get(root)
+            # Global names win, otherwise the driver in the highest sheet, then the priority inside the sheet
+            cand = (0 if priority >= PRIORITY_POWER else depth+1, -priority, name)
+            if cur is None or cand < cur:
+                best[root] = cand
+        for root, nodes in nets.items():
+            real = sorted({n for n in nodes if not n[0].startswith('#')},
+                          key=lambda n: (natural_key(n[0]), natural_key(n[1])))
+            if not real:
+                continue
+            if root in best:
+                name = best[root][2]
+            elif len(nodes) == 1:
+                name = 'unconnected-({}-Pad{})'.format(real[0][0], real[0][1])
+            else:
+                name = min(['Net-({}-Pad{})'.format(n[0], n[1]) for n in real])
+            self.nets.append(Net(name, real))
+        self.nets.sort(key=lambda n: n.name)
+
+    def lib_symbols(self):
+        """ Library symbols used by the components, sorted like eeschema does """
+        used = {}
+        for c in self.components:
+            used[c.lib_symbol.lib_id] = c.lib_symbol
+        return [used[k] for k in sorted(used.keys())]
+
+
+class _SymbolInstance(object):
+    """ A symbol in a particular sheet instance """
+    def __init__(self, symbol, ref, unit):
+        self.symbol = symbol
+        self.ref = ref
+        self.unit = unit
+
+
+class Node(object):
+    """ Generic element, written as XML or s-expression """
+    def __init__(self, name, attrs=None, text=None, children=None):
+        self.name = name
+        self.attrs = attrs or []
+        self.text = text
+        self.children = children or []
+
+    def add(self, name, attrs=None, text=None):
+        n = Node(name, attrs, text)
+        self.children.append(n)
+        return n
+
+    def sexp(self, indent=0):
+        s = '  '*indent+'('+self.name
+        for k, v in self.attrs:
+            s += ' ({} {})'.format(k, sexp.quote(v))
+        if self.text is not None:
+            s += ' '+sexp.quote(self.text)
+        for c in self.children:
+            s += '\n'+c.sexp(indent+1)
+        return s+')'
+
+    def xml(self, indent=0):
+        s = '  '*indent+'<'+self.name
+        for k, v in self.attrs:
+            s += ' {}={}'.format(k, quoteattr(v))
+        if self.text is None and not self.children:
+            return s+'/>'
+        s += '>'
+        if self.text is not None:
+            s += escape(self.text)
+        if self.children:
+            s += '\n'+'\n'.join([c.xml(indent+1) for c in self.children])+'\n'+'  '*indent
+        return s+'</'+self.name+'>'
+
+
+def _lib_uris(netlist):
+    """ Solve the library URIs from the project sym-lib-table """
+    uris = {}
+    table = os.path.join(netlist.dir, 'sym-lib-table')
+    if not os.path.isfile(table):
+        return uris
+    try:
+        data = sexp.load(table)
+    except (OSError, sexp.SexpError):  # pragma: no cover
+        return uris
+    for lib in sexp.find_all(data, 'lib'):
+        uri = sexp.value(lib, 'uri', '')
+        uris[sexp.value(lib, 'name')] = os.path.expandvars(uri.replace('${KIPRJMOD}/', ''))
+    return uris
+
+
+def _title_block(sheet, node):
+    tb = node.add('title_block')
+    data = sheet.file.title_block or []
+    for name in ('title', 'company', 'rev', 'date'):
+        tb.add(name, text=sexp.value(data, name))
+    tb.add('source', text=os.path.basename(sheet.file.file))
+    comments = {c[1]: c[2] for c in sexp.find_all(data, 'comment') if len(c) > 2}
+    for n in range(1, 10):
+        tb.add('comment', [('number', str(n)), ('value', comments.get(str(n), ''))])
+
+
+def build_tree(netlist):
+    """ The netlist as a Node tree """
+    root = Node('export', [('version', 'D')])
+    design = root.add('design')
+    design.add('source', text=os.path.basename(netlist.file))
+    design.add('date', text=time.strftime('%a %d %b %Y %H:%M:%S'))
+    design.add('tool', text='KiAuto '+__version__)
+    for sheet in netlist.sheets:
+        _title_block(sheet, design.add('sheet', [('number', str(sheet.number)), ('name', sheet.names),
+                                                 ('tstamps', sheet.path)]))
+    comps = root.add('components')
+    for c in netlist.components:
+        comp = comps.add('comp', [('ref', c.ref)])
+        comp.add('value', text=c.value)
+        if c.footprint:
+            comp.add('footprint', text=c.footprint)
+        if c.datasheet:
+            comp.add('datasheet', text=c.datasheet)
+        if c.fields:
+            fields = comp.add('fields')
+            for n, v in c.fields:
+                fields.add('field', [('name', n)], v)
+        comp.add('libsource', [('lib', c.lib_symbol.lib), ('part', c.lib_symbol.part),
+                               ('description', c.lib_symbol.properties.get('ki_description', ''))])
+        for n, v in c.sheet.props:
+            comp.add('property', [('name', n), ('value', v)])
+        comp.add('sheetpath', [('names', c.sheet.names), ('tstamps', c.sheet.path)])
+        comp.add('tstamp', text=c.symbol.uuid)
+    libparts = root.add('libparts')
+    libs = set()
+    for ls in netlist.lib_symbols():
+        libs.add(ls.lib)
+        lp = libparts.add('libpart', [('lib', ls.lib), ('part', ls.part)])
+        filters = ls.properties.get('ki_fp_filters', '').split()
+        if filters:
+            fps = lp.add('footprints')
+            for f in filters:
+                fps.add('fp', text=f)
+        fields = lp.add('fields')
+        for n in ('Reference', 'Value', 'Footprint', 'Datasheet'):
+            v = ls.properties.get(n, '')
+            if v and v != '~':
+                fields.add('field', [('name', n)], v)
+        pins = lp.add('pins')
+        done = set()
+        for p in sorted(ls.pins, key=lambda p: natural_key(p[2])):
+            if p[2] in done:
+                continue
+            done.add(p[2])
+            pins.add('pin', [('num', p[2]), ('name', p[3]), ('type', p[4])])
+    libraries = root.add('libraries')
+    uris = _lib_uris(netlist)
+    for lib in sorted(libs):
+        library = libraries.add('library', [('logical', lib)])
+        if lib in uris:
+            library.add('uri', text=uris[lib])
+    nets = root.add('nets')
+    for code, net in enumerate(netlist.nets):
+        n = nets.add('net', [('code', str(code+1)), ('name', net.name)])
+        for ref, number, name in net.nodes:
+            attrs = [('ref', ref), ('pin', number)]
+            if name and name != '~':
+                attrs.append(('pinfunction', name))
+            n.add('node', attrs)
+    return root
+
+
+def write_netlist(tree, file):
+    with open(file, 'wt') as f:
+        f.write(tree.sexp()+'\n')
+
+
+def write_xml(tree, file):
+    with open(file, 'wt') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write(tree.xml()+'\n')
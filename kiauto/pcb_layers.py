@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 Salvador E. Tropea
+# Copyright (c) 2020 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+Layer table of a PCB, read without loading the board.
+
+Only the (layers ...) section is parsed. The table is cached, the entry is
+valid if the size, modification time and hash of the PCB header (the text
+up to the end of the layers section) are the same.
+"""
+import os
+
+from kiauto import sexp
+from kiauto import cache
+from kiauto import log
+logger = log.get_logger(__name__)
+
+CACHE_SECTION = 'layers'
+
+
+def parse_layers(pcb):
+    """ Reads the layers section, returns a list of (id, name, user_name) and the end of the section """
+    section, end = sexp.load_section(pcb, 'layers')
+    layers = []
+    if section is None:
+        return layers, end
+    for e in section[1:]:
+        if isinstance(e, list) and len(e) >= 3 and e[0].isdigit():
+            # KiCad 6: (ID NAME TYPE [USER_NAME]) KiCad 5: (ID NAME TYPE [hide])
+            user = e[3] if len(e) >= 4 and isinstance(e[3], str) and e[3] != 'hide' else e[1]
+            layers.append((int(e[0]), e[1], user))
+    return layers, end
+
+
+def get_layers(pcb):
+    """ Returns a list of (id, name, user_name), using the cache if possible """
+    st = os.stat(pcb)
+    key = cache.key_for(os.path.abspath(pcb))
+    entry = cache.load_json(CACHE_SECTION, key)
+    if (entry and entry.get('size') == st.st_size and entry.get('mtime') == st.st_mtime_ns and
+            entry.get('hash') == cache.hash_file(pcb, entry.get('end', 0))):
+        logger.debug('Using cached layers for '+pcb)
+        return [tuple(la) for la in entry['layers']]
+    layers, end = parse_layers(pcb)
+    if end > 0:
+        cache.save_json(CACHE_SECTION, key, {'size': st.st_size, 'mtime': st.st_mtime_ns, 'end': end,
+                                             'hash': cache.hash_file(pcb, end), 'layers': layers})
+    return layers
+
+
+def load_layers(pcb):
+    """ Layer names indexed by layer ID, '-' for the unused IDs """
+    layers = get_layers(pcb)
+    layer_names = ['-']*(max([la[0] for la in layers]+[49])+1)
+    for id, name, user in layers:
+        layer_names[id] = user
+    return layer_names
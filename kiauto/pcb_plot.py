@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 Salvador E. Tropea
+# Copyright (c) 2020 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+PCB layers export using the pcbnew plot API (PLOT_CONTROLLER).
+
+No pcbnew instance nor X server is needed. When each layer goes to its own
+page the layers are plotted concurrently, each worker process loads the
+board only once. The PDF pages are then joined using pdfunite.
+"""
+import os
+import shutil
+import subprocess
+from multiprocessing import Pool
+
+from kiauto import log
+logger = log.get_logger(__name__)
+
+PLOT_FORMATS = ['pdf', 'svg']
+# The board loaded by each worker
+_board = None
+
+
+class PlotOptions(object):
+    """ The export options, simple values so we can send them to the workers """
+    def __init__(self, cfg, format):
+        self.format = format
+        self.mirror = cfg.mirror
+        self.pads = cfg.pads
+        self.frame = not cfg.no_title
+        self.monochrome = cfg.monochrome
+        self.scaling = cfg.scaling
+
+
+def plot_page(board, layers, options, out_dir, suffix):
+    """ Plots the layers in one page, returns the name of the file """
+    import pcbnew
+    pctl = pcbnew.PLOT_CONTROLLER(board)
+    popt = pctl.GetPlotOptions()
+    popt.SetOutputDirectory(out_dir)
+    popt.SetPlotFrameRef(options.frame)
+    popt.SetMirror(options.mirror)
+    # Same values used by the print dialog: 0 none, 1 small, 2 full
+    popt.SetDrillMarksType(options.pads)
+    if options.scaling:
+        popt.SetAutoScale(False)
+        popt.SetScale(options.scaling)
+    else:
+        popt.SetAutoScale(True)
+    pctl.SetColorMode(not options.monochrome)
+    format = pcbnew.PLOT_FORMAT_SVG if options.format == 'svg' else pcbnew.PLOT_FORMAT_PDF
+    pctl.SetLayer(layers[0])
+    pctl.OpenPlotfile(suffix, format, suffix)
+    # All the layers go to the same page
+    for id in layers:
+        pctl.SetLayer(id)
+        pctl.PlotLayer()
+    file = pctl.GetPlotFileName()
+    pctl.ClosePlot()
+    return file
+
+
+def _init_worker(pcb_file):
+    global _board
+    import pcbnew
+    _board = pcbnew.LoadBoard(pcb_file)
+
+
+def _plot_layer(task):
+    id, suffix, options, out_dir = task
+    return plot_page(_board, [id], options, out_dir, suffix)
+
+
+def _join_pages(files, suffixes, output_file, format):
+    """ Moves the plotted files to the output, returns the list of created files """
+    if len(files) == 1:
+        shutil.move(files[0], output_file)
+        return [output_file]
+    if format == 'pdf':
+        pdfunite = shutil.which('pdfunite')
+        if pdfunite:
+            subprocess.check_call([pdfunite]+files+[output_file])
+            return [output_file]
+        logger.warning('pdfunite not found, using one file for each layer')
+    # One file for each layer, KiCad style: NAME-LAYER.EXT
+    base, ext = os.path.splitext(output_file)
+    created = []
+    for file, suffix in zip(files, suffixes):
+        name = base+'-'+suffix+ext
+        shutil.move(file, name)
+        created.append(name)
+    return created
+
+
+def plot_layers(board, pcb_file, layers, options, output_file, separate, tmp_dir, workers=None):
+    """ Plots the layers (ids) to output_file.
+        board is the loaded pcb_file, the workers load pcb_file.
+        Returns the list of created files. """
+    if not separate:
+        logger.debug('Plotting {} layers in one page'.format(len(layers)))
+        return _join_pages([plot_page(board, layers, options, tmp_dir, 'printed')], None, output_file, options.format)
+    suffixes = [board.GetLayerName(id).replace('.', '_') for id in layers]
+    tasks = [(id, suffix, options, tmp_dir) for id, suffix in zip(layers, suffixes)]
+    workers = min(workers or os.cpu_count() or 1, len(tasks))
+    if workers > 1:
+        logger.debug('Plotting {} layers using {} processes'.format(len(layers), workers))
+        with Pool(workers, _init_worker, (pcb_file,)) as pool:
+            files = pool.map(_plot_layer, tasks)
+    else:
+        files = [plot_page(board, [t[0]], options, tmp_dir, t[1]) for t in tasks]
+    return _join_pages(files, suffixes, output_file, options.format)
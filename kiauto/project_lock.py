@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 Salvador E. Tropea
+# Copyright (c) 2020 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+Project level locks.
+
+KiCad modifies the project files (and sometimes the PCB) even when we just
+read them, so we restore them at exit. When two jobs use the same project
+(i.e. ERC and DRC running in parallel) they must agree: the first job takes
+a snapshot of the files and the last one restores them. Jobs that only read
+the project use a shared lock, so they can run in parallel.
+`pcbnew_do run_drc --save` modifies the PCB, it uses an exclusive lock.
+
+The locks, the state (list of jobs and files) and the snapshots are stored
+in KIAUS_LOCK_DIR, by default a `kiauto-locks-UID` directory in the system
+temporal dir. Files are compared using their SHA1 (not size and mtime) and
+written using a temporal file and a rename, so they are never left half
+written.
+"""
+import atexit
+import fcntl
+import json
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from kiauto import cache
+from kiauto import log
+logger = log.get_logger(__name__)
+
+LOCK_DIR_ENV = 'KIAUS_LOCK_DIR'
+STATE = 'state.json'
+
+
+def lock_dir():
+    d = os.environ.get(LOCK_DIR_ENV)
+    if not d:
+        d = os.path.join(tempfile.gettempdir(), 'kiauto-locks-{}'.format(os.getuid()))
+    os.makedirs(d, exist_ok=True)
+    return d
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Exists, but belongs to another user
+        pass
+    return True
+
+
+def _atomic_copy(src, dst):
+    """ Copy `src` to `dst` (data and times), `dst` is replaced in one step """
+    tmp = dst+'.kiauto-tmp'
+    shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+class ProjectLock(object):
+    def __init__(self, input_file, exclusive=False):
+        # The schematic, PCB and project files share the name, so this identifies the project
+        self.project = os.path.splitext(os.path.realpath(input_file))[0]
+        self.exclusive = exclusive
+        base = os.path.join(lock_dir(), cache.key_for(self.project))
+        self.lock_name = base+'.lock'
+        self.mutex_name = base+'.mutex'
+        self.state_dir = base+'.d'
+        self.lock = None
+        self.joined = False
+
+    def acquire(self):
+        """ Waits until we can use the project """
+        self.lock = open(self.lock_name, 'a')
+        mode = fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH
+        try:
+            fcntl.flock(self.lock, mode | fcntl.LOCK_NB)
+        except OSError:
+            logger.info('Waiting for other jobs using the project `{}`'.format(self.project))
+            fcntl.flock(self.lock, mode)
+        logger.debug('{} lock for `{}` ({})'.format('Exclusive' if self.exclusive else 'Shared', self.project,
+                     self.lock_name))
+        atexit.register(self.release)
+
+    @contextmanager
+    def _state(self):
+        """ The state, only one job can change it at a time """
+        with open(self.mutex_name, 'a') as mutex:
+            fcntl.flock(mutex, fcntl.LOCK_EX)
+            name = os.path.join(self.state_dir, STATE)
+            try:
+                with open(name, 'rt') as f:
+                    state = json.load(f)
+            except (OSError, ValueError):
+                state = {'jobs': [], 'files': {}}
+            yield state
+            if state['jobs']:
+                os.makedirs(self.state_dir, exist_ok=True)
+                with open(name+'.tmp', 'wt') as f:
+                    json.dump(state, f)
+                os.replace(name+'.tmp', name)
+            else:
+                shutil.rmtree(self.state_dir, ignore_errors=True)
+
+    def _join(self, state):
+        if self.joined:
+            return
+        self.joined = True
+        # Jobs that died without releasing the project
+        jobs = [p for p in state['jobs'] if _alive(p)]
+        if not jobs and state['files']:
+            # We can't know if the user changed the files after the crash, keep them as they are
+            logger.warning('Discarding the snapshot left by an interrupted job ({})'.format(', '.join(state['files'])))
+            shutil.rmtree(self.state_dir, ignore_errors=True)
+            state['files'] = {}
+        state['jobs'] = jobs+[os.getpid()]
+
+    def protect(self, files, keep_modified=False):
+        """ Takes a snapshot of the files, unless another job using the project already did it.
+            They are restored by the last job releasing the project.
+            keep_modified: keep the version modified by KiCad as FILE-bak """
+        if self.lock is None:
+            return
+        with self._state() as state:
+            self._join(state)
+            os.makedirs(self.state_dir, exist_ok=True)
+            for file in files:
+                file = os.path.realpath(file)
+                if file in state['files'] or not os.path.isfile(file):
+                    continue
+                snapshot = os.path.join(self.state_dir, '{}.{}'.format(len(state['files']), os.path.basename(file)))
+                _atomic_copy(file, snapshot)
+                state['files'][file] = {'snapshot': snapshot, 'sha1': cache.hash_file(snapshot),
+                                        'keep_modified': keep_modified, 'bak': os.path.isfile(file+'-bak')}
+                logger.debug('Snapshot of `{}` ({})'.format(file, state['files'][file]['sha1']))
+
+    def _restore(self, file, data):
+        bak = file+'-bak'
+        if not os.path.isfile(file):  # pragma: no cover
+            logger.warning('`{}` lost, restoring it'.format(file))
+            _atomic_copy(data['snapshot'], file)
+        elif cache.hash_file(file) != data['sha1']:
+            logger.debug('Restoring `{}`'.format(file))
+            if data['keep_modified']:
+                _atomic_copy(file, bak)
+            _atomic_copy(data['snapshot'], file)
+        # KiCad creates a back-up when saving, remove it if it wasn't there
+        if not data['keep_modified'] and not data['bak'] and os.path.isfile(bak):
+            os.remove(bak)
+
+    def release(self):
+        """ The last job using the project restores the files """
+        if self.lock is None:
+            return
+        atexit.unregister(self.release)
+        if self.joined:
+            with self._state() as state:
+                pid = os.getpid()
+                state['jobs'] = [p for p in state['jobs'] if p != pid and _alive(p)]
+                if not state['jobs']:
+                    for file, data in state['files'].items():
+                        self._restore(file, data)
+        self.lock.close()
+        self.lock = None
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 Salvador E. Tropea
+# Copyright (c) 2020 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+Cache for the results of a run.
+
+The key is a hash of the input file, the project files, the sub-sheets,
+the project libraries tables, the local libraries they list, the command
+line options, the KiCad version and the KiAuto version. The entry contains
+the files created by the run and the exit code. On a hit the files are
+restored and the exit code is replayed, KiCad isn't started. The entries
+are evicted using LRU when the cache is bigger than the configured size.
+"""
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+from glob import glob
+
+from kiauto import cache
+from kiauto import sexp
+from kiauto.misc import __version__
+from kiauto import log
+logger = log.get_logger(__name__)
+
+CACHE_SECTION = 'results'
+# Size in MB
+CACHE_SIZE = 1024
+# Options that doesn't affect the results
+IGNORED_OPTIONS = {'verbose', 'record', 'rec_width', 'rec_height', 'start_x11vnc', 'use_wm', 'wait_key', 'wait_start',
+                   'erc_timeout', 'drc_timeout', 'output_dir', 'schematic', 'kicad_pcb_file', 'cache', 'cache_size',
+                   'force_refill', 'trace', 'profile'}
+SCH_SHEET_FILE = re.compile(r'^F1 "([^"]+)"', re.M)
+LIB_TABLES = ['sym-lib-table', 'fp-lib-table']
+KIPRJMOD = ('${KIPRJMOD}', '$(KIPRJMOD)')
+
+
+def sub_sheets(sch, found):
+    """ Adds the sub-sheets of the schematic to `found` (recursive) """
+    try:
+        if sch.endswith('.kicad_sch'):
+            names = []
+            for sheet in sexp.find_all(sexp.load(sch), 'sheet'):
+                props = {p[1]: p[2] for p in sexp.find_all(sheet, 'property') if len(p) > 2}
+                name = props.get('Sheet file', props.get('Sheetfile'))
+                if name:
+                    names.append(name)
+        else:
+            with open(sch, 'rt') as f:
+                names = SCH_SHEET_FILE.findall(f.read())
+    except (OSError, UnicodeDecodeError, sexp.SexpError) as e:
+        logger.debug('Unable to look for sub-sheets in {}: {}'.format(sch, e))
+        return
+    for name in names:
+        name = os.path.join(os.path.dirname(sch), name)
+        if name not in found and os.path.isfile(name):
+            found.append(name)
+            sub_sheets(name, found)
+
+
+def project_libs(table):
+    """ Files for the libraries listed in a project libs table using paths relative to the project """
+    try:
+        libs = sexp.find_all(sexp.load(table), 'lib')
+    except (OSError, UnicodeDecodeError, sexp.SexpError) as e:
+        logger.debug('Unable to read the libs table {}: {}'.format(table, e))
+        return []
+    files = []
+    for lib in libs:
+        uri = sexp.value(lib, 'uri', '')
+        # Other variables and absolute paths point to global libs
+        if not uri.startswith(KIPRJMOD):
+            continue
+        uri = os.path.normpath(os.path.join(os.path.dirname(table), uri[len(KIPRJMOD[0]):].lstrip('/')))
+        if os.path.isdir(uri):
+            # i.e. a .pretty footprints lib
+            for root, _, names in sorted(os.walk(uri)):
+                files.extend(os.path.join(root, name) for name in sorted(names))
+        elif os.path.isfile(uri):
+            files.append(uri)
+            # KiCad 5 symbol libs have the docs in a separated file
+            if uri.endswith('.lib') and os.path.isfile(uri[:-4]+'.dcm'):
+                files.append(uri[:-4]+'.dcm')
+    return files
+
+
+def project_files(input_file):
+    """ Files that can affect the result of processing input_file """
+    files = [input_file]
+    base = os.path.splitext(input_file)[0]
+    for ext in ['.pro', '.kicad_pro', '.kicad_prl']:
+        if os.path.isfile(base+ext):
+            files.append(base+ext)
+    dir = os.path.dirname(input_file)
+    for name in LIB_TABLES:
+        table = os.path.join(dir, name)
+        if os.path.isfile(table):
+            files.append(table)
+            files.extend(project_libs(table))
+    # The cache and rescue libs
+    files.extend(sorted(glob(os.path.join(dir, '*.lib'))))
+    if input_file.endswith('sch'):
+        sub_sheets(input_file, files)
+    return files
+
+
+def _snapshot_one(file):
+    if not os.path.isfile(file):
+        return None
+    st = os.stat(file)
+    return (st.st_size, st.st_mtime_ns)
+
+
+def _snapshot(dir):
+    files = {}
+    for root, _, names in os.walk(dir):
+        for name in names:
+            path = os.path.join(root, name)
+            st = os.stat(path)
+            files[os.path.relpath(path, dir)] = (st.st_size, st.st_mtime_ns)
+    return files
+
+
+class ResultCache(object):
+    def __init__(self, cfg, args, output_dir, inputs=None, extra=None, max_size=CACHE_SIZE):
+        """ inputs: other files used as input (i.e. filters).
+            extra: outputs created outside output_dir (i.e. the XML for the BoM). """
+        self.dir = cache.cache_dir(CACHE_SECTION)
+        self.output_dir = output_dir
+        self.input_dir = os.path.dirname(os.path.abspath(cfg.input_file))
+        self.extra = [os.path.abspath(f) for f in (extra or [])]
+        self.max_size = max_size*1024*1024
+        self.before = None
+        self.extra_before = None
+        options = sorted((k, v) for k, v in vars(args).items() if k not in IGNORED_OPTIONS)
+        items = [__version__, cfg.kicad_version, os.path.basename(sys.argv[0]), options]
+        for f in project_files(os.path.abspath(cfg.input_file))+[os.path.abspath(f) for f in (inputs or [])]:
+            items.extend([os.path.relpath(f, self.input_dir), cache.hash_file(f)])
+        self.key = cache.key_for(*items)
+        logger.debug('Result cache key: '+self.key)
+
+    def _entry(self):
+        return os.path.join(self.dir, self.key)
+
+    def lookup(self):
+        """ Restores the cached outputs, returns the exit code or None if not cached """
+        if self.dir is None:
+            return None
+        entry = self._entry()
+        try:
+            with open(os.path.join(entry, 'meta.json'), 'rt') as f:
+                meta = json.load(f)
+            os.makedirs(self.output_dir, exist_ok=True)
+            for name in meta['outputs']:
+                dest = os.path.join(self.output_dir, name)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copy2(os.path.join(entry, 'out', name), dest)
+            for n, name in enumerate(meta['extra']):
+                shutil.copy2(os.path.join(entry, 'extra', str(n)), os.path.join(self.input_dir, name))
+            # Mark it as recently used
+            os.utime(os.path.join(entry, 'meta.json'))
+        except (OSError, ValueError, KeyError):
+            # Not cached (or damaged), remember what we have now
+            self.before = _snapshot(self.output_dir) if os.path.isdir(self.output_dir) else {}
+            self.extra_before = {f: _snapshot_one(f) for f in self.extra}
+            return None
+        logger.info('Using cached results ({} files)'.format(len(meta['outputs'])+len(meta['extra'])))
+        return meta['ret']
+
+    def store(self, ret):
+        """ Stores the files created by the run """
+        if self.dir is None or self.before is None:
+            return
+        after = _snapshot(self.output_dir)
+        # Videos aren't results
+        outputs = [name for name, st in after.items() if self.before.get(name) != st and
+                   not name.endswith('_screencast.ogv')]
+        extra = [f for f in self.extra if os.path.isfile(f) and self.extra_before[f] != _snapshot_one(f)]
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            tmp = tempfile.mkdtemp(dir=self.dir, prefix='.tmp-')
+            size = 0
+            for name in outputs:
+                dest = os.path.join(tmp, 'out', name)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copy2(os.path.join(self.output_dir, name), dest)
+                size += after[name][0]
+            os.makedirs(os.path.join(tmp, 'extra'))
+            for n, f in enumerate(extra):
+                shutil.copy2(f, os.path.join(tmp, 'extra', str(n)))
+                size += os.path.getsize(f)
+            meta = {'ret': ret, 'outputs': outputs, 'extra': [os.path.relpath(f, self.input_dir) for f in extra],
+                    'size': size}
+            with open(os.path.join(tmp, 'meta.json'), 'wt') as f:
+                json.dump(meta, f)
+            try:
+                os.rename(tmp, self._entry())
+            except OSError:
+                # Another run stored it first
+                shutil.rmtree(tmp, ignore_errors=True)
+            logger.debug('Stored {} files in the result cache ({} bytes)'.format(len(outputs)+len(extra), size))
+        except OSError as e:
+            logger.warning('Unable to store the results in the cache: {}'.format(e))
+            return
+        self.evict()
+
+    def evict(self):
+        """ Removes the least recently used entries until we are below the size limit """
+        entries = []
+        total = 0
+        for name in os.listdir(self.dir):
+            meta = os.path.join(self.dir, name, 'meta.json')
+            try:
+                with open(meta, 'rt') as f:
+                    size = json.load(f)['size']
+                entries.append((os.path.getmtime(meta), size, name))
+            except (OSError, ValueError, KeyError):
+                continue
+            total += size
+        entries.sort()
+        for _, size, name in entries:
+            if total <= self.max_size:
+                break
+            logger.debug('Evicting {} from the result cache'.format(name))
+            shutil.rmtree(os.path.join(self.dir, name), ignore_errors=True)
+            total -= size
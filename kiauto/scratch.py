@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 Salvador E. Tropea
+# Copyright (c) 2020 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+Scratch workspace (--scratch).
+
+KiCad runs on a copy of the project, so the original files are never
+modified and we don't need to restore them. Only the files KiCad reads are
+staged: the input, the project files, the sub-sheets, the project libs
+tables, the libraries they list inside the project dir, the drawing sheets
+and the cache/rescue libs. They are staged in a temporal directory created
+inside the output dir (so it's usually in the same filesystem as the
+project). Files outside the project dir (i.e. `../common/power.kicad_sch`
+or `${KIPRJMOD}/../libs`) are staged keeping the same relative layout.
+
+Each file is cloned (FICLONE, copy-on-write, no data is copied) when the
+filesystem supports it (i.e. Btrfs and XFS). Otherwise the libraries are
+hard linked and the rest is copied (KiCad can rewrite them in place).
+The outputs that KiCad writes next to the input (i.e. the XML for the BoM or
+the PCB saved by run_drc --save) are copied back by copy_back().
+"""
+import atexit
+import errno
+import fcntl
+import os
+import shutil
+import tempfile
+from glob import glob
+
+from kiauto import log
+from kiauto import trace
+from kiauto.result_cache import project_files
+logger = log.get_logger(__name__)
+
+# From linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# Libraries, KiCad only reads them, we can share the inode
+READ_ONLY_EXT = {'.lib', '.dcm', '.kicad_sym', '.kicad_mod', '.kicad_wks', '.wrl', '.step', '.stp'}
+# Libs created or rewritten by eeschema
+WRITTEN_LIBS = ('-cache.lib', '-rescue.lib')
+# The filesystem (or kernel) can't clone
+NO_CLONE_ERRORS = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.EBADF, errno.ENOSYS}
+CLONE = 'clone'
+LINK = 'link'
+COPY = 'copy'
+
+
+def _clone(src, dst):
+    """ Copy-on-write copy of `src`, returns False if the filesystem can't do it """
+    cloned = True
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError as e:
+            if e.errno not in NO_CLONE_ERRORS:
+                raise
+            cloned = False
+    if not cloned:
+        os.remove(dst)
+        return False
+    shutil.copystat(src, dst)
+    return True
+
+
+def _read_only(name):
+    return os.path.splitext(name)[1] in READ_ONLY_EXT and not name.endswith(WRITTEN_LIBS)
+
+
+class Scratch(object):
+    def __init__(self, input_file, output_dir):
+        self.input_file = os.path.realpath(input_file)
+        self.src_dir = os.path.dirname(self.input_file)
+        self.output_dir = os.path.realpath(output_dir)
+        self.dir = None
+        self.work_dir = None
+        # Once a method fails we don't try it again
+        self.can_clone = True
+        self.can_link = True
+        self.stats = {CLONE: 0, LINK: 0, COPY: 0}
+
+    def _stage_file(self, src, dst, name):
+        if self.can_clone:
+            if _clone(src, dst):
+                self.stats[CLONE] += 1
+                return
+            self.can_clone = False
+            logger.debug('The filesystem can\'t clone files (FICLONE)')
+        if self.can_link and _read_only(name):
+            try:
+                os.link(src, dst)
+                self.stats[LINK] += 1
+                return
+            except OSError:
+                self.can_link = False
+                logger.debug('Unable to create hard links')
+        shutil.copy2(src, dst)
+        self.stats[COPY] += 1
+
+    @trace.traced('project')
+    def stage(self):
+        """ Creates the copy of the project, returns the name of the staged input file """
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.dir = tempfile.mkdtemp(prefix='.kiauto-scratch-', dir=self.output_dir)
+        atexit.register(self.remove)
+        files = self._files()
+        # The relative paths that go outside the project must work in the copy
+        top = os.path.commonpath([self.src_dir]+files)
+        if top != self.src_dir:
+            logger.debug('Files outside the project dir, staging from `{}`'.format(top))
+        top_dir = os.path.join(self.dir, os.path.basename(top))
+        self.work_dir = os.path.join(top_dir, os.path.relpath(self.src_dir, top))
+        for src in files:
+            dest = os.path.join(top_dir, os.path.relpath(src, top))
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            self._stage_file(src, dest, os.path.basename(src))
+        logger.debug('Project staged in `{}` (cloned: {clone}, linked: {link}, copied: {copy})'.
+                     format(self.work_dir, **self.stats))
+        return os.path.join(self.work_dir, os.path.basename(self.input_file))
+
+    def _files(self):
+        """ Files that KiCad reads """
+        files = project_files(self.input_file)
+        dru = os.path.splitext(self.input_file)[0]+'.kicad_dru'
+        if os.path.isfile(dru):
+            files.append(dru)
+        # Drawing sheets
+        files.extend(sorted(glob(os.path.join(self.src_dir, '*.kicad_wks'))))
+        # Remove duplicated entries, keep the order
+        return list(dict.fromkeys(os.path.realpath(f) for f in files))
+
+    def copy_back(self, files):
+        """ Copies the staged `files` (outputs) to the original project """
+        for file in files:
+            rel = os.path.relpath(os.path.realpath(file), os.path.realpath(self.work_dir))
+            if not os.path.isfile(file) or rel.startswith(os.pardir):
+                continue
+            dest = os.path.join(self.src_dir, rel)
+            logger.debug('Copying `{}` back to the project'.format(rel))
+            tmp = dest+'.kiauto-tmp'
+            if not (self.can_clone and _clone(file, tmp)):
+                shutil.copy2(file, tmp)
+            os.replace(tmp, dest)
+
+    def remove(self):
+        if self.dir:
+            atexit.unregister(self.remove)
+            shutil.rmtree(self.dir, ignore_errors=True)
+            self.dir = None
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 Salvador E. Tropea
+# Copyright (c) 2020 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+S-expression reader/writer for the KiCad files.
+
+The reader is a tokenizer based on a regular expression, it makes only one
+pass over the text and builds nested lists. Atoms and strings are returned
+as Python strings (strings are unescaped).
+
+For big files (i.e. a PCB) load_section maps the file in memory and only
+parses the requested section, stopping when it ends.
+"""
+import mmap
+import os
+import re
+
+PATTERN = r'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))'
+TOKEN = re.compile(PATTERN, re.S)
+BTOKEN = re.compile(PATTERN.encode(), re.S)
+ESCAPE = re.compile(r'\\(.)', re.S)
+ESCAPES = {'n': '\n', 't': '\t', 'r': '\r'}
+
+
+class SexpError(Exception):
+    pass
+
+
+def _unescape(s):
+    if '\\' not in s:
+        return s
+    return ESCAPE.sub(lambda m: ESCAPES.get(m.group(1), m.group(1)), s)
+
+
+def _decode(b):
+    return b.decode('utf-8')
+
+
+def parse(text):
+    """ Returns the first s-expression in text as nested lists """
+    return _parse(text, 0, TOKEN, str)[0]
+
+
+def _parse(text, pos, token, conv):
+    """ Parses the s-expression starting at pos, returns it and the offset of its end.
+        Works for str and bytes-like objects, conv converts the matched text to str. """
+    stack = []
+    cur = None
+    end = len(text)
+    while pos < end:
+        m = token.match(text, pos)
+        if m is None:
+            if text[pos:].strip():
+                raise SexpError('Syntax error at offset {}'.format(pos))
+            break
+        pos = m.end()
+        if m.group(1):
+            new = []
+            if cur is not None:
+                cur.append(new)
+                stack.append(cur)
+            cur = new
+        elif m.group(2):
+            if cur is None:
+                raise SexpError('Unbalanced `)` at offset {}'.format(pos))
+            if not stack:
+                return cur, pos
+            cur = stack.pop()
+        elif m.group(3) is not None:
+            if cur is None:
+                raise SexpError('String outside a list at offset {}'.format(pos))
+            cur.append(_unescape(conv(m.group(3))))
+        else:
+            if cur is None:
+                raise SexpError('Atom outside a list at offset {}'.format(pos))
+            cur.append(conv(m.group(4)))
+    raise SexpError('Unexpected end of file')
+
+
+def load(file):
+    with open(file, 'rt', encoding='utf-8') as f:
+        return parse(f.read())
+
+
+def find_section(buf, name):
+    """ Offset of the first (name ...) list inside the top level list of buf (bytes-like).
+        Returns -1 if not found. Only the text before the section is tokenized. """
+    target = name.encode()
+    depth = 0
+    # Offset of a list that is waiting for its name
+    head = -1
+    for m in BTOKEN.finditer(buf):
+        if m.group(1):
+            depth += 1
+            head = m.start(1) if depth == 2 else -1
+        elif m.group(2):
+            depth -= 1
+            head = -1
+            if depth <= 0:
+                break
+        else:
+            if head >= 0 and m.group(4) == target:
+                return head
+            head = -1
+    return -1
+
+
+def load_section(file, name):
+    """ Parses the first (name ...) list inside the top level list of the file.
+        Returns the list and the offset where it ends, (None, -1) if not found. """
+    with open(file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None, -1
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            start = find_section(buf, name)
+            if start < 0:
+                return None, -1
+            return _parse(buf, start, BTOKEN, _decode)
+
+
+# Helpers to navigate the lists
+
+def find(node, name):
+    """ First child list named `name` """
+    for e in node:
+        if isinstance(e, list) and e and e[0] == name:
+            return e
+    return None
+
+
+def find_all(node, name):
+    """ All the child lists named `name` """
+    return [e for e in node if isinstance(e, list) and e and e[0] == name]
+
+
+def value(node, name, default=None):
+    """ Value of the (name VALUE) child """
+    e = find(node, name)
+    if e is None or len(e) < 2:
+        return default
+    return e[1]
+
+
+def has_flag(node, name):
+    """ Atoms like `hide` or lists like (hide yes) """
+    for e in node[1:]:
+        if e == name:
+            return True
+        if isinstance(e, list) and e and e[0] == name:
+            return len(e) == 1 or e[1] == 'yes'
+    return False
+
+
+# Writer
+
+def quote(s):
+    return '"'+str(s).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')+'"'
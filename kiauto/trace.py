@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 Salvador E. Tropea
+# Copyright (c) 2020 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+Timed spans exported as a Chrome trace (chrome://tracing or https://ui.perfetto.dev).
+
+Disabled by default, then the `traced` decorator just calls the function.
+start() enables the recording and the events are written at exit. It can
+also run cProfile for the whole Python side. The spans can also be sent to
+a sink (see kiauto.metrics).
+"""
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from kiauto import log
+logger = log.get_logger(__name__)
+
+# Recorded events, None when disabled
+_events = None
+_start = 0
+# Object with span() and event() methods, gets the spans
+_sink = None
+# Spans are recorded
+_active = False
+
+
+def now():
+    """ Timestamp in microseconds """
+    return int(time.perf_counter()*1000000)
+
+
+def enabled():
+    return _active
+
+
+def set_sink(sink):
+    global _sink
+    global _active
+    _sink = sink
+    _active = True
+
+
+def _arg(v):
+    return v if isinstance(v, (int, float, bool)) else str(v)
+
+
+def complete(name, cat, start, **args):
+    """ Adds a span that started at `start` (see now()) and ends now """
+    if not _active:
+        return
+    dur = now()-start
+    if _sink is not None:
+        _sink.span(name, cat, dur, args)
+    if _events is None:
+        return
+    ev = {'name': name, 'cat': cat, 'ph': 'X', 'ts': start, 'dur': dur, 'pid': os.getpid(), 'tid': threading.get_ident()}
+    if args:
+        ev['args'] = {k: _arg(v) for k, v in args.items()}
+    _events.append(ev)
+
+
+def instant(name, cat, **args):
+    """ Adds a point in time event (i.e. a retry) """
+    if not _active:
+        return
+    if _sink is not None:
+        _sink.event(name, cat, args)
+    if _events is None:
+        return
+    ev = {'name': name, 'cat': cat, 'ph': 'i', 's': 't', 'ts': now(), 'pid': os.getpid(), 'tid': threading.get_ident()}
+    if args:
+        ev['args'] = {k: _arg(v) for k, v in args.items()}
+    _events.append(ev)
+
+
+@contextmanager
+def span(name, cat, **args):
+    if not _active:
+        yield
+        return
+    start = now()
+    try:
+        yield
+    finally:
+        complete(name, cat, start, **args)
+
+
+def traced(cat, name=None):
+    """ Decorator to record a span for each call.
+        The simple arguments (strings, numbers and lists) are included, and the exception if the call fails. """
+    def decorator(f):
+        label = name or f.__name__
+
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if not _active:
+                return f(*args, **kwargs)
+            start = now()
+            extra = {}
+            simple = [a for a in args if isinstance(a, (str, int, float, list))]
+            if simple:
+                extra['args'] = simple
+            try:
+                return f(*args, **kwargs)
+            except BaseException as e:
+                extra['error'] = e.__class__.__name__
+                raise
+            finally:
+                complete(label, cat, start, **extra)
+        return wrapper
+    return decorator
+
+
+def _write(file, profiler, profile_file):
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile_file)
+    if file is None:
+        return
+    complete(os.path.basename(sys.argv[0]), 'run', _start, argv=' '.join(sys.argv[1:]))
+    try:
+        with open(file, 'wt') as f:
+            json.dump({'traceEvents': _events, 'displayTimeUnit': 'ms'}, f)
+    except OSError as e:
+        logger.error('Unable to write the trace: {}'.format(e))
+
+
+def start(file, profile_file=None):
+    """ Starts recording the spans, they are written to file at exit.
+        If profile_file is specified we also run cProfile. """
+    global _events
+    global _start
+    global _active
+    if file is None and profile_file is None:
+        return
+    if file:
+        _events = []
+        _start = now()
+        _active = True
+    profiler = None
+    if profile_file:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    # Registered first, so it runs after the clean-up functions
+    atexit.register(_write, file, profiler, profile_file)
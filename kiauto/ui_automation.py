@@ -17,21 +17,54 @@ Based on splitflap/electronics/scripts/export_util.py by Scott Bezek
 """
 import os
 from subprocess import (Popen, CalledProcessError, TimeoutExpired, call, check_output, STDOUT, DEVNULL, PIPE)
-import tempfile
 import time
 import shutil
 import signal
 from contextlib import contextmanager
-# python3-xvfbwrapper
-from xvfbwrapper import Xvfb
+# python3-psutil
+import psutil
 
 from kiauto import log
+from kiauto.misc import WaitTimeout
+from kiauto.display_pool import leased_display
+from kiauto import x11_backend
+from kiauto import trace
 logger = log.get_logger(__name__)
 
 
+# Maximum time between checks, used when we don't get X events
+DELAY = 0.5
+# A process using less than 5% of a CPU for 1 s is considered idle
+IDLE_CPU = 0.05
+IDLE_TIME = 1.0
+IDLE_SAMPLE = 0.1
+
+
+def poll_x(timeout, id=None):
+    """ Iterates until the timeout expires, waiting for changes in the X server between iterations.
+        If we don't have an X connection (xdotool backend) it just sleeps DELAY seconds. """
+    deadline = time.time()+timeout
+    while True:
+        yield
+        remaining = deadline-time.time()
+        if remaining <= 0:
+            return
+        x11_backend.wait_event(min(DELAY, remaining), id)
+
+
 class PopenContext(Popen):
 
+    def __init__(self, *args, **kwargs):
+        self.trace_start = trace.now()
+        super().__init__(*args, **kwargs)
+
     def __exit__(self, type, value, traceback):
+        with trace.span('teardown', 'process', pid=self.pid):
+            self._close(type)
+        # The whole life of the process
+        trace.complete(os.path.basename(self.args[0]), 'process', self.trace_start, pid=self.pid)
+
+    def _close(self, type):
         logger.debug("Closing pipe with %d", self.pid)
         # Note: currently we don't communicate with the child so these cases are never used.
         # I keep them in case they are needed, but excluded from the coverage.
@@ -61,17 +94,26 @@ class PopenContext(Popen):
             pass
         if retry:  # pragma: no cover
             logger.debug("Killing %d", self.pid)
+            trace.instant('SIGKILL', 'process', pid=self.pid, process=os.path.basename(self.args[0]))
             # We shouldn't get here. Kill the process and wait upto 10 seconds
             os.killpg(os.getpgid(self.pid), signal.SIGKILL)
             # self.kill()
             self.wait(10)
 
 
-def wait_xserver():
-    timeout = 10
-    DELAY = 0.5
+@trace.traced('wait')
+def wait_xserver(timeout=10):
     logger.debug('Waiting for virtual X server ...')
     logger.debug('Current DISPLAY is '+os.environ['DISPLAY'])
+    try:
+        # Connecting is cheap, so we can retry often
+        for i in range(int(timeout/0.05)):
+            if x11_backend.check_server():
+                return
+            time.sleep(0.05)
+        raise WaitTimeout('Timed out waiting for virtual X server')
+    except x11_backend.Unsupported:
+        pass
     if shutil.which('setxkbmap'):
         cmd = ['setxkbmap', '-query']
     elif shutil.which('setxkbmap'):  # pragma: no cover
@@ -88,13 +130,21 @@ def wait_xserver():
             return
         logger.debug('   Retry')
         time.sleep(DELAY)
-    raise RuntimeError('Timed out waiting for virtual X server')
+    raise WaitTimeout('Timed out waiting for virtual X server')
 
 
+@trace.traced('wait')
 def wait_wm():
     timeout = 10
-    DELAY = 0.5
     logger.debug('Waiting for Window Manager ...')
+    try:
+        # The WM publishes _NET_SUPPORTING_WM_CHECK in the root window, we get a PropertyNotify
+        for _ in poll_x(timeout):
+            if x11_backend.wm_running():
+                return
+        raise WaitTimeout('Timed out waiting for WM server')
+    except x11_backend.Unsupported:  # pragma: no cover
+        pass
     if shutil.which('wmctrl'):
         cmd = ['wmctrl', '-m']
     else:  # pragma: no cover
@@ -108,7 +158,7 @@ def wait_wm():
             return
         logger.debug('   Retry')
         time.sleep(DELAY)
-    raise RuntimeError('Timed out waiting for WM server')
+    raise WaitTimeout('Timed out waiting for WM server')
 
 
 @contextmanager
@@ -174,57 +224,75 @@ def recorded_xvfb(cfg):
     except KeyError:
         old_display = None
         pass
-    with Xvfb(width=cfg.rec_width, height=cfg.rec_height, colordepth=cfg.colordepth):
-        wait_xserver()
-        with start_x11vnc(cfg.start_x11vnc, old_display):
-            with start_wm(cfg.use_wm):
-                with start_record(cfg.record, cfg.video_dir, cfg.video_name):
-                    yield
-
-
+    try:
+        with leased_display(cfg, wait_xserver, xdotool) as display:
+            if display:
+                # A ready to use display from the pool, including the WM if needed
+                with start_x11vnc(cfg.start_x11vnc, old_display):
+                    with start_record(cfg.record, cfg.video_dir, cfg.video_name):
+                        yield
+                return
+            # python3-xvfbwrapper, imported here because it takes time to load
+            from xvfbwrapper import Xvfb
+            with trace.span('Xvfb', 'process'), Xvfb(width=cfg.rec_width, height=cfg.rec_height, colordepth=cfg.colordepth):
+                wait_xserver()
+                with start_x11vnc(cfg.start_x11vnc, old_display):
+                    with start_wm(cfg.use_wm):
+                        with start_record(cfg.record, cfg.video_dir, cfg.video_name):
+                            try:
+                                yield
+                            finally:
+                                # The Xlib connection must be closed before the X server
+                                x11_backend.close()
+    finally:
+        x11_backend.close()
+
+
+@trace.traced('xdotool')
 def xdotool(command):
+    try:
+        return x11_backend.xdotool_xlib(command)
+    except x11_backend.Unsupported:
+        pass
     return check_output(['xdotool'] + command, stderr=DEVNULL)
     # return check_output(['xdotool'] + command)
 
 
+@trace.traced('clipboard')
 def clipboard_store(string):
-    # I don't know how to use Popen/run to make it run with pipes without
-    # either blocking or losing the messages.
-    # Using files works really well.
     logger.debug('Clipboard store "'+string+'"')
-    # Write the text to a file
-    fd_in, temp_in = tempfile.mkstemp(text=True)
-    os.write(fd_in, string.encode())
-    os.close(fd_in)
-    # Capture output
-    fd_out, temp_out = tempfile.mkstemp(text=True)
-    process = Popen(['xclip', '-selection', 'clipboard', temp_in], stdout=fd_out, stderr=STDOUT)
-    ret_code = process.wait()
-    os.remove(temp_in)
-    os.lseek(fd_out, 0, os.SEEK_SET)
-    ret_text = os.read(fd_out, 1000)
-    os.close(fd_out)
-    os.remove(temp_out)
-    ret_text = ret_text.decode()
-    if ret_text:  # pragma: no cover
-        logger.error('Failed to store string in clipboard')
-        logger.error(ret_text)
-        raise
-    if ret_code:  # pragma: no cover
+    owner = x11_backend.get_clipboard()
+    if owner is not None:
+        owner.store(string)
+        return
+    # xclip forks a daemon that keeps the selection, it inherits stdout/stderr,
+    # so we can't read them without blocking. Just send the text and check the exit code.
+    process = Popen(['xclip', '-selection', 'clipboard'], stdin=PIPE, stdout=DEVNULL, stderr=DEVNULL)
+    process.communicate(string.encode())
+    if process.returncode:  # pragma: no cover
         logger.error('Failed to store string in clipboard')
-        logger.error('xclip returned %d' % ret_code)
+        logger.error('xclip returned %d' % process.returncode)
         raise
 
 
+@trace.traced('clipboard')
 def clipboard_retrieve():
-    p = Popen(['xclip', '-o', '-selection', 'clipboard'], stdout=PIPE, stderr=STDOUT)
-    output = ''
-    for line in p.stdout:
-        output += line.decode()
+    output = check_output(['xclip', '-o', '-selection', 'clipboard'], stderr=STDOUT).decode()
     logger.debug('Clipboard retrieve "'+output+'"')
     return output
 
 
+@trace.traced('clipboard')
+def paste_clipboard(keys):
+    """ Sends the keys used to paste the clipboard and waits until the application gets the text """
+    owner = x11_backend.get_clipboard()
+    served = owner.served if owner is not None else 0
+    xdotool(['key']+keys)
+    if owner is None or not owner.wait_served(served, 1):
+        # xclip: we don't know when the application got the text
+        time.sleep(1)
+
+
 def debug_window(id=None):  # pragma: no cover
     if log.get_level() < 2:
         return
@@ -239,23 +307,22 @@ def debug_window(id=None):  # pragma: no cover
             call(['xprop', '-id', id])
 
 
+@trace.traced('wait')
 def wait_focused(id, timeout=10):
-    DELAY = 0.5
     logger.debug('Waiting for %s window to get focus...', id)
-    for i in range(int(timeout/DELAY)):
+    for _ in poll_x(timeout, id):
         cur_id = xdotool(['getwindowfocus']).rstrip()
         logger.debug('Currently focused id: %s', cur_id)
         if cur_id == id:
             return
-        time.sleep(DELAY)
     debug_window(cur_id)  # pragma: no cover
-    raise RuntimeError('Timed out waiting for %s window to get focus' % id)
+    raise WaitTimeout('Timed out waiting for %s window to get focus' % id)
 
 
+@trace.traced('wait')
 def wait_not_focused(id, timeout=10):
-    DELAY = 0.5
     logger.debug('Waiting for %s window to lose focus...', id)
-    for i in range(int(timeout/DELAY)):
+    for _ in poll_x(timeout, id):
         try:
             cur_id = xdotool(['getwindowfocus']).rstrip()
         except CalledProcessError:
@@ -264,19 +331,19 @@ def wait_not_focused(id, timeout=10):
         logger.debug('Currently focused id: %s', cur_id)
         if cur_id != id:
             return
-        time.sleep(DELAY)
     debug_window(cur_id)  # pragma: no cover
-    raise RuntimeError('Timed out waiting for %s window to lose focus' % id)
+    raise WaitTimeout('Timed out waiting for %s window to lose focus' % id)
 
 
+@trace.traced('wait')
 def wait_for_window(name, window_regex, timeout=10, focus=True, skip_id=0, others=None):
-    DELAY = 0.5
     logger.info('Waiting for "%s" ...', name)
     if skip_id:
         logger.debug('Will skip %s', skip_id)
     xdotool_command = ['search', '--onlyvisible', '--name', window_regex]
 
-    for i in range(int(timeout/DELAY)):
+    # New windows are reported by MapNotify events in the root window
+    for _ in poll_x(timeout):
         try:
             window_id = xdotool(xdotool_command).splitlines()
             logger.debug('Found %s window (%d)', name, len(window_id))
@@ -304,11 +371,51 @@ def wait_for_window(name, window_regex, timeout=10, focus=True, skip_id=0, other
                     raise ValueError(other)
                 except CalledProcessError:
                     pass
-        time.sleep(DELAY)
     debug_window()  # pragma: no cover
-    raise RuntimeError('Timed out waiting for %s window' % name)
+    raise WaitTimeout('Timed out waiting for %s window' % name)
+
+
+def _cpu_time(process):
+    total = 0
+    # KiCad nightly uses a shell script to start the real binary
+    for p in [process]+process.children(recursive=True):
+        try:
+            times = p.cpu_times()
+        except psutil.NoSuchProcess:  # pragma: no cover
+            continue
+        total += times.user+times.system
+    return total
+
+
+@trace.traced('wait')
+def wait_process_idle(pid, name, timeout):
+    """ Waits until the process (and its children) stops using the CPU.
+        Used when KiCad doesn't give any visible indication of a finished task. """
+    logger.info('Waiting for %s to finish ...', name)
+    process = psutil.Process(pid)
+    start = last_time = time.time()
+    last_cpu = _cpu_time(process)
+    idle_since = None
+    while True:
+        time.sleep(IDLE_SAMPLE)
+        now = time.time()
+        cpu = _cpu_time(process)
+        usage = (cpu-last_cpu)/(now-last_time)
+        last_cpu = cpu
+        last_time = now
+        if usage < IDLE_CPU:
+            if idle_since is None:
+                idle_since = now
+            elif now-idle_since >= IDLE_TIME:
+                logger.debug('%s finished after %.1f s', name, idle_since-start)
+                return
+        else:
+            idle_since = None
+        if now-start > timeout:
+            raise WaitTimeout('Timed out waiting for %s to finish' % name)
 
 
+@trace.traced('wait')
 def wait_point(cfg):
     if cfg.wait_for_key:
         input('Press a key')
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 Salvador E. Tropea
+# Copyright (c) 2020 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+DRC and ERC report parser.
+
+The report is read line by line and the violations are yielded as soon as
+they are complete, so the parser itself uses a fixed amount of memory.
+Each violation is a small object with the code, the message and the lines
+that follow it (positions and items). Its text (str()) is what we used to
+keep in cfg.errs/cfg.wrns: `(CODE) MESSAGE` plus the extra lines.
+
+write_json() exports the violations as NDJSON, one per line, and a summary (REPORT.summary.json).
+"""
+import json
+import os
+import re
+from itertools import chain
+from sys import intern
+from time import perf_counter
+
+from kiauto.misc import (KICAD_VERSION_5_99, __version__)
+from kiauto import log
+logger = log.get_logger(__name__)
+
+DRC = 'drc'
+ERC = 'erc'
+ERROR = 'error'
+WARNING = 'warning'
+CODE_6 = re.compile(r'^\[(\S+)\]: (.*)')
+CODE_5 = re.compile(r'^ErrType\((\d+)\): (.*)')
+DRC_ERRORS = re.compile(r'^\*\* Found ([0-9]+) DRC (errors|violations) \*\*$')
+DRC_UNCONNECTED = re.compile(r'^\*\* Found ([0-9]+) unconnected pads \*\*$')
+DRC_END = '** End of Report **'
+ERC_SUMMARY = re.compile(r'^ \*\* ERC messages: ([0-9]+) +Errors ([0-9]+) +Warnings ([0-9]+)+$')
+# @(X UNITS, Y UNITS): ITEM
+POSITION = re.compile(r'^\s*@\(\s*(-?[\d.]+) *(\w*), *(-?[\d.]+) *\w*\): (.*)$')
+TO_MM = {'mm': 1, 'in': 25.4, 'mils': 0.0254}
+
+
+class Violation(object):
+    __slots__ = ('code', 'message', 'severity', 'details', 'filter')
+
+    def __init__(self, code, message, severity, details=''):
+        # Few different codes, share them
+        self.code = intern(code)
+        self.message = message
+        self.severity = severity
+        # Lines after the message, as found in the report (one string, smaller than a list)
+        self.details = details
+        # The ErrorFilter that matched it
+        self.filter = None
+
+    def __str__(self):
+        text = '({}) {}'.format(self.code, self.message)
+        if self.details:
+            return text+'\n'+self.details
+        return text
+
+    @property
+    def lines(self):
+        return self.details.split('\n') if self.details else []
+
+    @property
+    def positions(self):
+        """ Coordinates of the items, in mm """
+        res = []
+        for ln in self.lines:
+            m = POSITION.match(ln)
+            if m:
+                scale = TO_MM.get(m.group(2), 1)
+                res.append((float(m.group(1))*scale, float(m.group(3))*scale))
+        return res
+
+    @property
+    def items(self):
+        """ Description of the items involved """
+        return [m.group(4) for m in map(POSITION.match, self.lines) if m]
+
+    def as_dict(self):
+        d = {'code': self.code, 'severity': self.severity, 'message': self.message, 'positions': self.positions,
+             'items': self.items, 'filtered': self.filter is not None}
+        if self.filter is not None:
+            d['filter'] = {'line': self.filter.line, 'regex': self.filter.regex}
+        return d
+
+
+class Report(object):
+    """ Parser for a DRC or ERC report, parse() yields the violations.
+        The totals found in the report are available after parsing. """
+    def __init__(self, kind, kicad_version):
+        self.kind = kind
+        self.code_re = CODE_6 if kicad_version >= KICAD_VERSION_5_99 else CODE_5
+        # DRC totals
+        self.drc_errors = None
+        self.unconnected_pads = None
+        # ERC totals
+        self.summary = None
+        self.erc_errors = None
+        self.erc_warnings = None
+
+    def parse(self, f):
+        """ Yields the violations found in the `f` file object """
+        if self.kind == DRC:
+            return self._parse_drc(f)
+        return self._parse_erc(f)
+
+    def _parse_drc(self, f):
+        severity = None
+        cur = None
+        lines = None
+        for line in f:
+            line = line.rstrip('\r\n')
+            if line.startswith('** '):
+                m_err = DRC_ERRORS.match(line)
+                m_unc = m_err is None and DRC_UNCONNECTED.match(line)
+                if m_err or m_unc or line == DRC_END:
+                    # New section, the lines that follow aren't part of the last violation
+                    if cur is not None:
+                        cur.details = '\n'.join(lines)
+                        yield cur
+                        cur = None
+                    if m_err:
+                        self.drc_errors = int(m_err.group(1))
+                        severity = ERROR
+                        continue
+                    if m_unc:
+                        self.unconnected_pads = int(m_unc.group(1))
+                        severity = WARNING
+                        continue
+                    break
+            if severity is None:
+                continue
+            m = self.code_re.match(line)
+            if m:
+                if cur is not None:
+                    cur.details = '\n'.join(lines)
+                    yield cur
+                cur = Violation(m.group(1), m.group(2), severity)
+                lines = []
+            elif len(line) > 4 and cur is not None:
+                lines.append(line)
+        if cur is not None:
+            cur.details = '\n'.join(lines)
+            yield cur
+
+    def _parse_erc(self, f):
+        cur = None
+        lines = None
+        last = ''
+        for line in f:
+            line = line.rstrip('\r\n')
+            if line:
+                last = line
+            m = self.code_re.match(line)
+            if m:
+                if cur is not None:
+                    cur.details = '\n'.join(lines)
+                    yield cur
+                cur = Violation(m.group(1), m.group(2), ERROR if 'Severity: error' in line else WARNING)
+                lines = []
+                continue
+            if cur is not None:
+                if line.startswith('    '):
+                    lines.append(line)
+                    continue
+                cur.details = '\n'.join(lines)
+                yield cur
+                cur = None
+        if cur is not None:
+            cur.details = '\n'.join(lines)
+            yield cur
+        self.summary = last
+        m = ERC_SUMMARY.match(last)
+        if m:
+            self.erc_errors = int(m.group(2))
+            self.erc_warnings = int(m.group(3))
+
+
+def write_json(cfg, kind, counts, timings):
+    """ Writes the violations in cfg.errs/cfg.wrns to REPORT.ndjson and a summary to REPORT.summary.json.
+        REPORT is the report name without extension. Note that REPORT.json is used by the JSON BoM. """
+    base = os.path.splitext(cfg.output_file)[0]
+    ndjson = base+'.ndjson'
+    logger.debug('Writing the violations to '+ndjson)
+    with open(ndjson, 'wt') as f:
+        for v in chain(cfg.errs, cfg.wrns):
+            f.write(json.dumps(v.as_dict())+'\n')
+    timings['total'] = perf_counter()-cfg.start_time
+    version = '{}.{}.{}'.format(cfg.kicad_version_major, cfg.kicad_version_minor, cfg.kicad_version_patch)
+    filters = [{'line': f.line, 'code': f.code, 'regex': f.regex, 'hits': f.hits} for f in cfg.err_filters.filters]
+    summary = {'kiauto': __version__, 'type': kind, 'input': os.path.abspath(cfg.input_file), 'report': cfg.output_file,
+               'violations': ndjson, 'kicad_version': version, 'counts': counts, 'timings': timings, 'filters': filters}
+    with open(base+'.summary.json', 'wt') as f:
+        json.dump(summary, f, indent=2)
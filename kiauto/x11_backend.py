@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 Salvador E. Tropea
+# Copyright (c) 2020 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+In-process implementation of the xdotool commands used by KiAuto.
+
+Uses python-xlib and one persistent connection to the X server: XTEST for
+the keys, XGetInputFocus for the focused window and the window tree for the
+searches. Commands we don't implement raise Unsupported and the caller runs
+the real xdotool. It also owns the CLIPBOARD selection, replacing xclip.
+The KIAUS_X11_BACKEND environment variable selects the backend: auto
+(default, use Xlib if available), xlib or xdotool.
+"""
+import os
+import re
+from importlib.util import find_spec
+import time
+import select
+import threading
+from subprocess import CalledProcessError
+
+from kiauto import log
+logger = log.get_logger(__name__)
+
+# python3-xlib, loaded on first use (see _load_xlib)
+has_xlib = find_spec('Xlib') is not None
+
+# Environment variable used to select the backend
+BACKEND_ENV = 'KIAUS_X11_BACKEND'
+# Delay between keystrokes, the xdotool default
+KEY_DELAY = 0.012
+# How much we wait for windowfocus --sync
+FOCUS_TIMEOUT = 2
+# xdotool aliases for the modifiers
+MODIFIERS = {'alt': 'Alt_L', 'ctrl': 'Control_L', 'control': 'Control_L', 'shift': 'Shift_L', 'super': 'Super_L',
+             'meta': 'Meta_L'}
+
+
+class Unsupported(Exception):
+    """ The command must be executed using xdotool """
+    pass
+
+
+class X11Backend(object):
+    def __init__(self, display_name):
+        self.display_name = display_name
+        self.d = display.Display(display_name)
+        if not self.d.has_extension('XTEST'):  # pragma: no cover
+            self.d.close()
+            raise DisplayError(display_name)
+        self.root = self.d.screen().root
+        self.WM_STATE = self.d.intern_atom('WM_STATE')
+        self.NET_WM_NAME = self.d.intern_atom('_NET_WM_NAME')
+        self.UTF8_STRING = self.d.intern_atom('UTF8_STRING')
+        self.NET_SUPPORTING_WM_CHECK = self.d.intern_atom('_NET_SUPPORTING_WM_CHECK')
+        # Windows created, mapped, destroyed, etc. and changes in the root properties
+        self.root.change_attributes(event_mask=X.SubstructureNotifyMask | X.PropertyChangeMask)
+        self.watched = set()
+
+    def close(self):
+        self.d.close()
+
+    # Events
+
+    def watch(self, id):
+        """ Get the focus changes for this window """
+        if id in self.watched:
+            return
+        w = self.d.create_resource_object('window', id)
+        # The window could be already destroyed, we don't care
+        w.change_attributes(event_mask=X.FocusChangeMask | X.StructureNotifyMask, onerror=CatchError())
+        self.watched.add(id)
+
+    def wait_event(self, timeout, id=None):
+        """ Waits until the X server reports a change or the timeout expires """
+        if id is not None:
+            self.watch(id)
+        self.d.flush()
+        if not self.d.pending_events():
+            select.select([self.d], [], [], timeout)
+        got = False
+        while self.d.pending_events():
+            self.d.next_event()
+            got = True
+        return got
+
+    def wm_running(self):
+        """ Like `wmctrl -m`: the WM publishes a valid _NET_SUPPORTING_WM_CHECK window """
+        prop = self.root.get_full_property(self.NET_SUPPORTING_WM_CHECK, Xatom.WINDOW)
+        if prop is None or not len(prop.value):
+            return False
+        try:
+            self.d.create_resource_object('window', prop.value[0]).get_attributes()
+        except XError:
+            return False
+        return True
+
+    # Keyboard
+
+    def _keysym(self, name):
+        keysym = XK.string_to_keysym(MODIFIERS.get(name.lower(), name))
+        if keysym == X.NoSymbol:
+            raise Unsupported()
+        keycode = self.d.keysym_to_keycode(keysym)
+        if not keycode:
+            # xdotool remaps a spare keycode for these
+            raise Unsupported()
+        if self.d.keycode_to_keysym(keycode, 0) != keysym:
+            # Upper case letters and other shifted symbols
+            return [self.d.keysym_to_keycode(XK.XK_Shift_L), keycode]
+        return [keycode]
+
+    def _keycodes(self, seq):
+        keycodes = []
+        for name in seq.split('+'):
+            for keycode in self._keysym(name):
+                if keycode not in keycodes:
+                    keycodes.append(keycode)
+        return keycodes
+
+    def _send(self, keycodes, press):
+        event = X.KeyPress if press else X.KeyRelease
+        for keycode in keycodes:
+            xtest.fake_input(self.d, event, keycode)
+        self.d.sync()
+        time.sleep(KEY_DELAY/2)
+
+    def key(self, args):
+        # Solve all the names before sending anything, so a fallback doesn't repeat keys
+        seqs = [self._keycodes(seq) for seq in args if seq]
+        for keycodes in seqs:
+            self._send(keycodes, True)
+            self._send(reversed(keycodes), False)
+
+    def keyup(self, args):
+        for seq in args:
+            self._send(reversed(self._keycodes(seq)), False)
+
+    # Windows
+
+    def _has_wm_state(self, w):
+        try:
+            return w.get_full_property(self.WM_STATE, X.AnyPropertyType) is not None
+        except XError:
+            return False
+
+    def get_focus(self):
+        """ Like xdo_get_focused_window_sane: the client window containing the input focus """
+        focus = self.d.get_input_focus().focus
+        if isinstance(focus, int):
+            # None or PointerRoot, xdotool fails here
+            return None
+        w = focus
+        while w and w.id != self.root.id:
+            if self._has_wm_state(w):
+                return w.id
+            try:
+                w = w.query_tree().parent
+            except XError:  # pragma: no cover
+                break
+        return focus.id
+
+    def _name(self, w):
+        for atom, type in ((self.NET_WM_NAME, self.UTF8_STRING), (Xatom.WM_NAME, X.AnyPropertyType)):
+            prop = w.get_full_property(atom, type)
+            if prop and prop.value:
+                value = prop.value
+                return value.decode(errors='replace') if isinstance(value, bytes) else value
+        return ''
+
+    def search(self, regex):
+        """ search --onlyvisible --name, in the same order used by xdotool """
+        found = []
+        self._search(self.root, re.compile(regex, re.I), found)
+        return found
+
+    def _search(self, w, pattern, found):
+        """ Like _xdo_find_matching_windows: checks all the children, then the children of each child """
+        try:
+            children = w.query_tree().children
+        except XError:
+            # The window was destroyed
+            return
+        for c in children:
+            try:
+                if c.get_attributes().map_state == X.IsViewable and pattern.search(self._name(c)):
+                    found.append(c.id)
+            except XError:
+                continue
+        for c in children:
+            self._search(c, pattern, found)
+
+    def focus(self, id, sync=False):
+        w = self.d.create_resource_object('window', id)
+        w.set_input_focus(X.RevertToParent, X.CurrentTime)
+        self.d.sync()
+        if sync:
+            for _ in range(int(FOCUS_TIMEOUT/0.01)):
+                if self.get_focus() == id:
+                    break
+                time.sleep(0.01)
+
+    def kill(self, id):
+        self.d.create_resource_object('window', id).kill_client()
+        self.d.sync()
+
+    def run(self, command):
+        """ Emulates `xdotool command`: returns the same output or raises the same exception """
+        cmd = command[0]
+        if cmd == 'key':
+            self.key(command[1:])
+            return b''
+        if cmd == 'keyup':
+            self.keyup(command[1:])
+            return b''
+        if cmd == 'getwindowfocus' and len(command) == 1:
+            id = self.get_focus()
+            if id is None:
+                raise CalledProcessError(1, ['xdotool']+command)
+            return '{}\n'.format(id).encode()
+        if cmd == 'windowfocus' and len(command) == 3 and command[1] == '--sync':
+            self.focus(int(command[2]), True)
+            return b''
+        if cmd == 'windowkill' and len(command) == 2:
+            self.kill(int(command[1]))
+            return b''
+        if cmd == 'search' and command[1:3] == ['--onlyvisible', '--name'] and len(command) in (4, 5):
+            ids = self.search(command[3])
+            if not ids:
+                raise CalledProcessError(1, ['xdotool']+command)
+            if len(command) == 5:
+                if command[4] != 'windowfocus':
+                    raise Unsupported()
+                self.focus(ids[0])
+                return b''
+            return ''.join(['{}\n'.format(id) for id in ids]).encode()
+        raise Unsupported()
+
+
+class ClipboardOwner(object):
+    """ Owns the CLIPBOARD selection and answers the requests from a thread.
+        Uses its own connection, only the thread talks to the X server. """
+    def __init__(self, display_name):
+        self.display_name = display_name
+        self.d = display.Display(display_name)
+        self.window = self.d.screen().root.create_window(0, 0, 1, 1, 0, X.CopyFromParent)
+        self.CLIPBOARD = self.d.intern_atom('CLIPBOARD')
+        self.TARGETS = self.d.intern_atom('TARGETS')
+        self.UTF8_STRING = self.d.intern_atom('UTF8_STRING')
+        self.TEXT = self.d.intern_atom('TEXT')
+        self.cond = threading.Condition()
+        self.text = b''
+        # Number of times we delivered the text
+        self.served = 0
+        # Ownership requests and the last one we got
+        self.requested = 0
+        self.acquired = 0
+        self.running = True
+        self.wake_r, self.wake_w = os.pipe()
+        self.thread = threading.Thread(target=self._run, name='clipboard', daemon=True)
+        self.thread.start()
+
+    def store(self, text):
+        with self.cond:
+            self.text = text.encode()
+            self.requested += 1
+            request = self.requested
+        os.write(self.wake_w, b'.')
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.acquired >= request, 2):
+                raise RuntimeError('Unable to get the clipboard ownership')
+
+    def wait_served(self, served, timeout):
+        """ Waits until the text is delivered after `served` requests """
+        with self.cond:
+            return self.cond.wait_for(lambda: self.served > served, timeout)
+
+    def _acquire(self):
+        with self.cond:
+            request = self.requested
+        self.window.set_selection_owner(self.CLIPBOARD, X.CurrentTime)
+        owner = self.d.get_selection_owner(self.CLIPBOARD)
+        if getattr(owner, 'id', owner) != self.window.id:  # pragma: no cover
+            logger.error('Failed to get the clipboard ownership')
+            return
+        with self.cond:
+            self.acquired = request
+            self.cond.notify_all()
+
+    def _answer(self, e):
+        prop = e.property if e.property != X.NONE else e.target
+        with self.cond:
+            text = self.text
+        served = False
+        if e.target == self.TARGETS:
+            e.requestor.change_property(prop, Xatom.ATOM, 32, [self.TARGETS, self.UTF8_STRING, self.TEXT, Xatom.STRING],
+                                        onerror=CatchError())
+        elif e.target in (self.UTF8_STRING, self.TEXT, Xatom.STRING):
+            type = self.UTF8_STRING if e.target == self.TEXT else e.target
+            e.requestor.change_property(prop, type, 8, text, onerror=CatchError())
+            served = True
+        else:
+            prop = X.NONE
+        ev = event.SelectionNotify(time=e.time, requestor=e.requestor, selection=e.selection, target=e.target,
+                                   property=prop)
+        e.requestor.send_event(ev, onerror=CatchError())
+        self.d.flush()
+        if served:
+            logger.debug('Clipboard content delivered')
+            with self.cond:
+                self.served += 1
+                self.cond.notify_all()
+
+    def _run(self):
+        try:
+            while self.running:
+                ready = select.select([self.d, self.wake_r], [], [], 1)[0]
+                if self.wake_r in ready:
+                    os.read(self.wake_r, 64)
+                    if self.running:
+                        self._acquire()
+                while self.d.pending_events():
+                    e = self.d.next_event()
+                    if e.type == X.SelectionRequest:
+                        self._answer(e)
+                    elif e.type == X.SelectionClear:
+                        logger.debug('Lost the clipboard ownership')
+        except (ConnectionClosedError, XError) as e:  # pragma: no cover
+            logger.debug('Clipboard owner finished ({})'.format(e))
+
+    def close(self):
+        self.running = False
+        os.write(self.wake_w, b'.')
+        self.thread.join(2)
+        self.d.close()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+
+_backend = None
+_clipboard = None
+_warned = False
+_xlib_loaded = False
+
+
+def _load_xlib():
+    """ Imports python-xlib, it takes time and isn't needed when we don't start KiCad """
+    global X, XK, Xatom, display, XError, ConnectionClosedError, DisplayError, CatchError, xtest, event
+    global has_xlib, _xlib_loaded
+    if _xlib_loaded:
+        return has_xlib
+    _xlib_loaded = True
+    try:
+        from Xlib import X, XK, Xatom, display
+        from Xlib.error import (XError, ConnectionClosedError, DisplayError, CatchError)
+        from Xlib.ext import xtest
+        from Xlib.protocol import event
+    except ImportError:  # pragma: no cover
+        has_xlib = False
+    return has_xlib
+
+
+def get_backend():
+    """ The connection for the current DISPLAY, or None if we must use xdotool """
+    global _backend
+    global _warned
+    name = os.environ.get('DISPLAY')
+    if _backend is not None:
+        if _backend.display_name == name:
+            return _backend
+        close()
+    selected = os.environ.get(BACKEND_ENV, 'auto')
+    if selected == 'xdotool' or not name:
+        return None
+    if not _load_xlib():  # pragma: no cover
+        if selected == 'xlib' and not _warned:
+            logger.warning('python3-xlib not installed, using xdotool')
+            _warned = True
+        return None
+    try:
+        _backend = X11Backend(name)
+    except (DisplayError, ConnectionClosedError, OSError) as e:  # pragma: no cover
+        logger.debug('Unable to connect to {} using Xlib ({}), using xdotool'.format(name, e))
+        return None
+    logger.debug('Using the Xlib backend for '+name)
+    return _backend
+
+
+def get_clipboard():
+    """ The clipboard owner for the current DISPLAY, or None if we must use xclip """
+    global _clipboard
+    if get_backend() is None:
+        return None
+    if _clipboard is None:
+        try:
+            _clipboard = ClipboardOwner(os.environ['DISPLAY'])
+        except (DisplayError, ConnectionClosedError, OSError) as e:  # pragma: no cover
+            logger.debug('Unable to create the clipboard owner ({}), using xclip'.format(e))
+            return None
+    return _clipboard
+
+
+def close():
+    """ Must be called before the X server goes away """
+    global _backend
+    global _clipboard
+    if _clipboard is not None:
+        try:
+            _clipboard.close()
+        except (XError, ConnectionClosedError, OSError):  # pragma: no cover
+            pass
+        _clipboard = None
+    if _backend is not None:
+        try:
+            _backend.close()
+        except (XError, ConnectionClosedError, OSError):  # pragma: no cover
+            pass
+        _backend = None
+
+
+def check_server():
+    """ True if we can connect to the current DISPLAY, raises Unsupported if Xlib isn't used """
+    if os.environ.get(BACKEND_ENV, 'auto') == 'xdotool' or not _load_xlib():
+        raise Unsupported()
+    try:
+        display.Display(os.environ['DISPLAY']).close()
+    except (DisplayError, ConnectionClosedError, OSError):
+        return False
+    return True
+
+
+def xdotool_xlib(command):
+    """ Runs the command in-process, raises Unsupported if xdotool is needed """
+    backend = get_backend()
+    if backend is None:
+        raise Unsupported()
+    try:
+        return backend.run(command)
+    except ConnectionClosedError:  # pragma: no cover
+        logger.debug('Lost the Xlib connection, using xdotool')
+        close()
+        raise Unsupported()
+
+
+def wait_event(timeout, id=None):
+    """ Waits for a change in the windows (or just sleeps if we don't use Xlib) """
+    backend = get_backend()
+    if backend is not None:
+        try:
+            backend.wait_event(timeout, None if id is None else int(id))
+            return
+        except ConnectionClosedError:  # pragma: no cover
+            close()
+    time.sleep(timeout)
+
+
+def wm_running():
+    """ True if a window manager is running, raises Unsupported if Xlib isn't used """
+    backend = get_backend()
+    if backend is None:
+        raise Unsupported()
+    return backend.wm_running()
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 Salvador E. Tropea
+# Copyright (c) 2020 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+Reuse of the zone fills (KiCad 6 Python API).
+
+Filling the zones is the slowest part of the Python DRC. We compute a
+fingerprint of what affects the fill: the zones (outline, priority and
+settings), the footprint zones and rule areas (i.e. keepouts), the tracks,
+vias, pads and drawings on the zone layers, the board edges, the project
+rules and the KiCad version. After filling, the
+filled polygons are stored in the cache using the fingerprint as key. When
+the fingerprint matches the polygons are copied to the zones, no fill.
+"""
+import hashlib
+import os
+
+from kiauto import cache
+from kiauto import log
+logger = log.get_logger(__name__)
+
+CACHE_SECTION = 'zone_fills'
+# Number of boards we remember
+CACHE_ENTRIES = 16
+ZONE_GETTERS = ['GetPriority', 'GetAssignedPriority', 'GetNetCode', 'GetLayerSet', 'GetLocalClearance', 'GetMinThickness',
+                'GetPadConnection', 'GetThermalReliefGap', 'GetThermalReliefSpokeWidth', 'GetIsRuleArea',
+                'GetDoNotAllowCopperPour', 'GetFillMode', 'GetHatchThickness', 'GetHatchGap', 'GetHatchOrientation',
+                'GetIslandRemovalMode', 'GetMinIslandArea', 'GetCornerSmoothingType', 'GetCornerRadius']
+TRACK_GETTERS = ['GetStart', 'GetEnd', 'GetMid', 'GetWidth', 'GetLayer', 'GetNetCode', 'GetDrillValue', 'TopLayer',
+                 'BottomLayer']
+PAD_GETTERS = ['GetPosition', 'GetSize', 'GetShape', 'GetOrientation', 'GetOffset', 'GetDelta', 'GetDrillSize',
+               'GetDrillShape', 'GetLayerSet', 'GetAttribute', 'GetNetCode', 'GetLocalClearance', 'GetZoneConnection',
+               'GetThermalGap', 'GetThermalSpokeWidth', 'GetRoundRectRadiusRatio', 'GetChamferRectRatio',
+               'GetChamferPositions', 'GetRemoveUnconnected', 'GetKeepTopBottom']
+DRAWING_GETTERS = ['GetLayer', 'GetShape', 'GetStart', 'GetEnd', 'GetWidth', 'GetAngle', 'GetText', 'GetTextPos',
+                   'GetTextAngle', 'GetTextSize', 'GetTextThickness', 'IsVisible']
+FOOTPRINT_GETTERS = ['GetLocalClearance', 'GetZoneConnection']
+
+
+def _val(v):
+    """ A plain Python value for the API result (SWIG objects repr includes the address) """
+    if v is None or isinstance(v, (int, float, str, bool)):
+        return v
+    if hasattr(v, 'x') and hasattr(v, 'y'):
+        return (v.x, v.y)
+    if hasattr(v, 'FmtHex'):
+        return v.FmtHex()
+    if hasattr(v, 'AsDegrees'):
+        return v.AsDegrees()
+    return str(v)
+
+
+def _props(obj, getters):
+    return [_val(getattr(obj, g)()) for g in getters if hasattr(obj, g)]
+
+
+def _bbox(obj):
+    b = obj.GetBoundingBox()
+    return (b.GetX(), b.GetY(), b.GetWidth(), b.GetHeight())
+
+
+def _chain(chain):
+    coords = []
+    for n in range(chain.PointCount()):
+        p = chain.CPoint(n)
+        coords.extend((p.x, p.y))
+    return coords
+
+
+def poly_data(poly):
+    """ The SHAPE_POLY_SET as a list of [outline, [holes]], each one a list of coordinates """
+    return [[_chain(poly.COutline(i)), [_chain(poly.CHole(i, h)) for h in range(poly.HoleCount(i))]]
+            for i in range(poly.OutlineCount())]
+
+
+def make_poly(data):
+    """ The SHAPE_POLY_SET for the data returned by poly_data """
+    import pcbnew
+    poly = pcbnew.SHAPE_POLY_SET()
+    for i, (outline, holes) in enumerate(data):
+        poly.NewOutline()
+        for n in range(0, len(outline), 2):
+            poly.Append(outline[n], outline[n+1])
+        for h, hole in enumerate(holes):
+            poly.NewHole()
+            for n in range(0, len(hole), 2):
+                poly.Append(hole[n], hole[n+1], i, h)
+    return poly
+
+
+def _on_layers(item, layers):
+    return any(item.IsOnLayer(id) for id in layers)
+
+
+def fingerprint(board, extra=()):
+    """ Hash of the board items that can affect the zone fills """
+    import pcbnew
+    h = hashlib.sha1()
+
+    def add(*items):
+        h.update(repr(items).encode())
+
+    add(*extra)
+    layers = set()
+    for z in board.Zones():
+        layers.update(z.GetLayerSet().Seq())
+        add('zone', z.m_Uuid.AsString(), _props(z, ZONE_GETTERS), poly_data(z.Outline()))
+    # Copper layers plus the board outline
+    layers.add(pcbnew.Edge_Cuts)
+    for t in board.GetTracks():
+        if _on_layers(t, layers):
+            add(t.GetClass(), _props(t, TRACK_GETTERS))
+    for d in board.GetDrawings():
+        if d.GetLayer() in layers:
+            add(d.GetClass(), _bbox(d), _props(d, DRAWING_GETTERS))
+    for m in board.GetFootprints():
+        add('footprint', _props(m, FOOTPRINT_GETTERS))
+        # i.e. keepouts
+        for z in m.Zones():
+            add('footprint_zone', z.m_Uuid.AsString(), _props(z, ZONE_GETTERS), poly_data(z.Outline()))
+        for p in m.Pads():
+            if _on_layers(p, layers):
+                add('pad', _bbox(p), _props(p, PAD_GETTERS))
+        for d in [m.Reference(), m.Value()]+list(m.GraphicalItems()):
+            if d.GetLayer() in layers:
+                add(d.GetClass(), _bbox(d), _props(d, DRAWING_GETTERS))
+    return h.hexdigest()
+
+
+class ZoneFills(object):
+    def __init__(self, board, pcb_file, kicad_version):
+        self.board = board
+        self.zones = list(board.Zones())
+        self.key = None
+        if not self.zones or cache.cache_dir(CACHE_SECTION) is None:
+            return
+        # The clearances and custom rules are in the project
+        base = os.path.splitext(os.path.abspath(pcb_file))[0]
+        extra = [kicad_version]+[cache.hash_file(base+ext) for ext in ['.kicad_pro', '.kicad_dru'] if os.path.isfile(base+ext)]
+        self.key = fingerprint(board, extra)
+        logger.debug('Zones fingerprint: '+self.key)
+
+    def restore(self):
+        """ Copies the cached fills to the zones, returns False if we must fill them """
+        if self.key is None:
+            return False
+        data = cache.load_json(CACHE_SECTION, self.key, compress=True)
+        if data is None:
+            return False
+        fills = []
+        for z in self.zones:
+            layers = data.get(z.m_Uuid.AsString())
+            if layers is None:
+                return False
+            fills.append((z, layers))
+        for z, layers in fills:
+            for layer, polys in layers.items():
+                z.SetFilledPolysList(int(layer), make_poly(polys))
+            z.SetIsFilled(True)
+            z.SetNeedRefill(False)
+        return True
+
+    def store(self):
+        """ Stores the current fills """
+        if self.key is None:
+            return
+        data = {}
+        for z in self.zones:
+            data[z.m_Uuid.AsString()] = {str(layer): poly_data(z.GetFilledPolysList(layer)) for layer in z.GetLayerSet().Seq()}
+        cache.save_json(CACHE_SECTION, self.key, data, compress=True, max_entries=CACHE_ENTRIES)
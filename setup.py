@@ -17,8 +17,9 @@ setup(name='kiauto',
       url=__url__,
       # Packages are marked using __init__.py
       packages=find_packages(),
-      scripts=['src/eeschema_do', 'src/pcbnew_do'],
+      scripts=['src/eeschema_do', 'src/pcbnew_do', 'src/kiauto_display_pool', 'src/kiauto_batch'],
       install_requires=['xvfbwrapper', 'psutil'],
+      extras_require={'xlib': ['python-xlib']},
       classifiers=['Development Status :: 4 - Beta',
                    'Environment :: Console',
                    'Intended Audience :: Developers',
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 Salvador E. Tropea
+# Copyright (c) 2020 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+Tests for kiauto_batch
+
+For debug information use:
+pytest-3 --log-cli-level debug
+
+"""
+
+import os
+import sys
+import json
+from hashlib import sha1
+# Look for the 'utils' module from where the script is running
+script_dir = os.path.dirname(os.path.abspath(__file__))
+prev_dir = os.path.dirname(script_dir)
+sys.path.insert(0, prev_dir)
+# Utils import
+from utils import context
+sys.path.insert(0, os.path.dirname(prev_dir))
+from kiauto.misc import (WRONG_ARGUMENTS, BATCH_JOB_FAILED)
+
+PROG = 'kiauto_batch'
+
+
+def create_manifest(ctx, jobs):
+    manifest = ctx.get_out_path('manifest.json')
+    with open(manifest, 'wt') as f:
+        json.dump(jobs, f)
+    return manifest
+
+
+def hash_files(files):
+    res = {}
+    for file in files:
+        if os.path.isfile(file):
+            with open(file, 'rb') as f:
+                res[file] = sha1(f.read()).hexdigest()
+    return res
+
+
+def test_batch_ok():
+    """ Schematic and PCB jobs running concurrently, they share the project files """
+    prj = 'good-project'
+    ctx = context.TestContext('Batch_Ok', prj)
+    sch = os.path.splitext(ctx.board_file)[0]+ctx.sch_ext
+    project_files = [ctx.board_file, sch]+[os.path.splitext(ctx.board_file)[0]+ext for ext in (ctx.pro_ext, '.kicad_prl')]
+    original = hash_files(project_files)
+    manifest = create_manifest(ctx, [{'input': sch, 'command': 'netlist', 'name': 'net'},
+                                     {'input': sch, 'command': 'run_erc', 'name': 'erc'},
+                                     {'input': ctx.board_file, 'command': 'run_drc', 'name': 'drc'},
+                                     {'input': ctx.board_file, 'command': 'export', 'name': 'pdf', 'layers': ['F.Cu']}])
+    cmd = [PROG, '-v', '-j', '4', '--display_pool', '--summary', ctx.get_out_path('summary.json')]
+    ctx.run(cmd, filename=manifest)
+    ctx.expect_out_file(os.path.join('net', prj+'.net'))
+    ctx.expect_out_file(os.path.join('erc', prj+'.erc'))
+    ctx.expect_out_file(os.path.join('drc', 'drc_result.rpt'))
+    ctx.expect_out_file(os.path.join('pdf', 'printed.pdf'))
+    with open(ctx.get_out_path('summary.json')) as f:
+        summary = json.load(f)
+    assert [j['ret_code'] for j in summary['jobs']] == [0, 0, 0, 0]
+    assert ctx.search_out(r'4 jobs, 0 failed') is not None
+    # The last job restored the project files
+    assert hash_files(project_files) == original
+    ctx.clean_up()
+
+
+def test_batch_fail():
+    """ A failing job """
+    prj = 'fail-project'
+    ctx = context.TestContext('Batch_Fail', prj)
+    manifest = create_manifest(ctx, [{'input': ctx.board_file, 'command': 'run_drc', 'name': 'drc'}])
+    cmd = [PROG]
+    ctx.run(cmd, BATCH_JOB_FAILED, filename=manifest)
+    assert ctx.search_out(r'1 jobs, 1 failed') is not None
+    ctx.clean_up()
+
+
+def test_batch_wrong_manifest():
+    ctx = context.TestContext('Batch_Wrong_Manifest', 'good-project')
+    manifest = create_manifest(ctx, [{'input': 'bogus.txt', 'command': 'run_drc'}])
+    cmd = [PROG]
+    ctx.run(cmd, WRONG_ARGUMENTS, filename=manifest)
+    assert ctx.search_err(r'Malformed manifest') is not None
+    ctx.clean_up()
+
+
+def test_batch_job_error():
+    """ A job we can't start is reported as failed, the summary is still written """
+    ctx = context.TestContext('Batch_Job_Error', 'good-project')
+    # A file where the job wants its output dir
+    ctx.create_dummy_out_file('blocker')
+    manifest = create_manifest(ctx, [{'input': ctx.board_file, 'command': 'run_drc', 'name': 'drc',
+                                      'output_dir': os.path.join('blocker', 'drc')}])
+    cmd = [PROG, '--summary', ctx.get_out_path('summary.json')]
+    ctx.run(cmd, BATCH_JOB_FAILED, filename=manifest)
+    assert ctx.search_err(r'Unable to run `drc`') is not None
+    assert ctx.search_out(r'1 jobs, 1 failed') is not None
+    with open(ctx.get_out_path('summary.json')) as f:
+        summary = json.load(f)
+    assert summary['jobs'][0]['ret_code'] == BATCH_JOB_FAILED
+    ctx.clean_up()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 Salvador E. Tropea
+# Copyright (c) 2020 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+End-to-end benchmarks
+
+Runs each command N times against the test projects, using the same
+mechanism used by the tests (TestContext.run). For each case we get the wall
+time, the time spent in each phase (from --trace) and the peak RSS of the
+process tree (KiCad). The results are stored in JSON format and can be
+compared against a baseline:
+
+tests/bench/e2e.py -o baseline.json
+(upgrade)
+tests/bench/e2e.py -o new.json --baseline baseline.json
+
+The exit code is 1 when a case is slower (or uses more memory) than allowed.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+from statistics import median
+from time import perf_counter
+# Look for the 'utils' module from where the script is running
+script_dir = os.path.dirname(os.path.abspath(__file__))
+prev_dir = os.path.dirname(script_dir)
+sys.path.insert(0, prev_dir)
+# Utils import
+from utils import context
+sys.path.insert(0, os.path.dirname(prev_dir))
+from kiauto.misc import __version__
+
+PCB = 0
+SCH = 1
+OLD_SCH = 2
+# name, tool, project, kind, command, extra arguments
+CASES = [('eeschema_netlist', 'eeschema_do', 'good-project', SCH, ['netlist'], None),
+         ('eeschema_run_erc', 'eeschema_do', 'good-project', SCH, ['run_erc'], None),
+         ('eeschema_export_pdf', 'eeschema_do', 'good-project', SCH, ['export', '--file_format', 'pdf', '--all_pages'],
+          None),
+         ('eeschema_run_erc_kicad4', 'eeschema_do', 'kicad4-project', OLD_SCH, ['run_erc'], None),
+         ('pcbnew_export', 'pcbnew_do', 'good-project', PCB, ['export'], ['F.Cu', 'F.SilkS', 'Edge.Cuts']),
+         ('pcbnew_run_drc', 'pcbnew_do', 'good-project', PCB, ['run_drc'], None),
+         # Measure the refill, not the zone fill cache
+         ('pcbnew_run_drc_refill', 'pcbnew_do', 'zone-refill', PCB, ['run_drc', '--force_refill'], None),
+         ('pcbnew_export_kicad4', 'pcbnew_do', 'kicad4-project', PCB, ['export'], ['F.Cu', 'Edge.Cuts'])]
+# Spans used for the phases breakdown
+PHASE_CATEGORIES = {'startup', 'wait', 'command', 'process'}
+TRACE = 'bench_trace.json'
+
+
+def read_phases(file):
+    """ Time spent in each phase (seconds), from the trace """
+    phases = {}
+    try:
+        with open(file, 'rt') as f:
+            events = json.load(f)['traceEvents']
+    except (OSError, ValueError, KeyError):
+        return phases
+    for e in events:
+        if e.get('ph') == 'X' and e.get('cat') in PHASE_CATEGORIES:
+            phases[e['name']] = phases.get(e['name'], 0)+e['dur']/1000000
+    return phases
+
+
+def run_case(case, runs):
+    name, tool, prj, kind, command, extra = case
+    if kind == PCB:
+        ctx = context.TestContext('Bench_'+name, prj)
+    else:
+        ctx = context.TestContextSCH('Bench_'+name, prj, kind == OLD_SCH)
+    walls = []
+    rss = []
+    phases = {}
+    trace = ctx.get_out_path(TRACE)
+    for _ in range(runs):
+        if prj == 'zone-refill':
+            # The DRC test needs the outdated zones
+            shutil.copy2(ctx.board_file+'.ok', ctx.board_file)
+        start = perf_counter()
+        ctx.run([tool, '--trace', trace]+command, extra=extra, ignore_ret=True)
+        walls.append(perf_counter()-start)
+        # Linux reports KiB
+        rss.append(ctx.rusage.ru_maxrss)
+        for phase, t in read_phases(trace).items():
+            phases.setdefault(phase, []).append(t)
+    ctx.clean_up()
+    return {'wall': walls, 'wall_median': median(walls), 'wall_min': min(walls), 'max_rss_kb': max(rss),
+            'kicad': ctx.kicad_version, 'phases': {phase: median(t) for phase, t in sorted(phases.items())}}
+
+
+def compare(results, baseline, threshold, min_delta, rss_threshold):
+    """ Prints the comparison, returns the names of the cases that regressed """
+    regressed = []
+    print('{:<26} {:>10} {:>10} {:>8} {:>10} {:>10}'.format('Case', 'Base [s]', 'New [s]', 'Change', 'Base RSS', 'New RSS'))
+    for name, new in results['cases'].items():
+        old = baseline['cases'].get(name)
+        if old is None:
+            print('{:<26} {:>10} {:>10.2f}'.format(name, '-', new['wall_median']))
+            continue
+        delta = new['wall_median']-old['wall_median']
+        slower = delta > max(old['wall_median']*threshold, min_delta)
+        bigger = new['max_rss_kb'] > old['max_rss_kb']*(1+rss_threshold)
+        print('{:<26} {:>10.2f} {:>10.2f} {:>+7.1f}% {:>10} {:>10}{}'.format(
+              name, old['wall_median'], new['wall_median'], delta/old['wall_median']*100, old['max_rss_kb'],
+              new['max_rss_kb'], ' REGRESSION' if slower or bigger else ''))
+        if slower or bigger:
+            regressed.append(name)
+            # Which phases are responsible?
+            for phase, t in new['phases'].items():
+                t_old = old['phases'].get(phase)
+                if t_old is not None and t-t_old > max(t_old*threshold, min_delta):
+                    print('    {:<22} {:>10.2f} {:>10.2f}'.format(phase, t_old, t))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='KiAuto end-to-end benchmarks')
+    parser.add_argument('--runs', '-n', help='Runs for each case [%(default)s]', type=int, default=3)
+    parser.add_argument('--output', '-o', help='JSON file for the results [%(default)s]', default='bench_results.json')
+    parser.add_argument('--baseline', '-b', help='Results to compare against')
+    parser.add_argument('--threshold', '-t', help='Allowed slow down (fraction) [%(default)s]', type=float, default=0.1)
+    parser.add_argument('--min_delta', help='Differences below it are ignored (seconds) [%(default)s]', type=float,
+                        default=0.5)
+    parser.add_argument('--rss_threshold', help='Allowed RSS increase (fraction) [%(default)s]', type=float, default=0.2)
+    parser.add_argument('--coverage', help='Run using python3-coverage, as the tests do', action='store_true')
+    parser.add_argument('cases', nargs='*', help='Cases to run [all]: '+', '.join(c[0] for c in CASES))
+    args = parser.parse_args()
+    context.USE_COVERAGE = args.coverage
+    cases = [c for c in CASES if not args.cases or c[0] in args.cases]
+    results = {'kiauto': __version__, 'runs': args.runs, 'cases': {}}
+    for case in cases:
+        print('Running '+case[0], flush=True)
+        results['cases'][case[0]] = run_case(case, args.runs)
+    with open(args.output, 'wt') as f:
+        json.dump(results, f, indent=2)
+    if not args.baseline:
+        for name, r in results['cases'].items():
+            print('{:<26} {:>8.2f} s {:>10} KiB'.format(name, r['wall_median'], r['max_rss_kb']))
+        return 0
+    with open(args.baseline, 'rt') as f:
+        baseline = json.load(f)
+    regressed = compare(results, baseline, args.threshold, args.min_delta, args.rss_threshold)
+    if regressed:
+        print('Regressions: '+', '.join(regressed))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
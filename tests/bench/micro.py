@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 Salvador E. Tropea
+# Copyright (c) 2020 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+Micro-benchmarks for the report parsers
+
+Measures the pure Python parts that process the results: parse_drc,
+eeschema_parse_erc, load_filters, apply_filters and load_layers. The inputs
+are synthetic (see synthetic.py), so no KiCad or X server is needed.
+The results of each case are also checked, a wrong count is reported.
+
+tests/bench/micro.py -o baseline.json
+(change)
+tests/bench/micro.py -o new.json --baseline baseline.json
+
+The exit code is 1 when a case fails or is slower than allowed.
+"""
+import argparse
+import importlib.machinery
+import json
+import logging
+import os
+import sys
+import tempfile
+from statistics import median
+from time import perf_counter
+from types import SimpleNamespace
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+TOP = os.path.dirname(os.path.dirname(script_dir))
+sys.path.insert(0, TOP)
+sys.path.insert(0, script_dir)
+import synthetic
+from synthetic import (KICAD5, KICAD6)
+from kiauto.misc import (__version__, KICAD_VERSION_5_99)
+from kiauto import cache
+from kiauto.file_util import (load_filters, apply_filters)
+from kiauto.pcb_layers import load_layers
+from kiauto.error_filter import ErrorFilters
+KICAD_VERSIONS = {KICAD5: 5001006, KICAD6: KICAD_VERSION_5_99}
+
+
+def load_script(name):
+    """ The scripts aren't modules, load them by name (main() isn't called) """
+    return importlib.machinery.SourceFileLoader(name, os.path.join(TOP, 'src', name)).load_module()
+
+
+def new_cfg(kicad, output_file=None):
+    """ The members of Config used by the parsers """
+    return SimpleNamespace(kicad_version=KICAD_VERSIONS[kicad], output_file=output_file, errs=[], wrns=[],
+                           err_filters=ErrorFilters(), warnings_as_errors=False)
+
+
+class Case(object):
+    def __init__(self, name, setup, run, check):
+        self.name = name
+        # setup(tmp_dir) returns the argument for run, run(arg) returns the value passed to check
+        self.setup = setup
+        self.run = run
+        # check(result) returns an error message or None
+        self.check = check
+
+
+def expect(what, got, wanted):
+    return None if got == wanted else '{} is {}, expected {}'.format(what, got, wanted)
+
+
+def parse_drc_case(kicad, a):
+    def setup(tmp):
+        name = os.path.join(tmp, 'drc_{}.rpt'.format(kicad))
+        with open(name, 'wt') as f:
+            f.write(synthetic.drc_report(kicad, a.violations, a.violations//10))
+        return name
+
+    def run(name):
+        cfg = new_cfg(kicad, name)
+        res = a.pcbnew_do.parse_drc(cfg)
+        return res, len(cfg.errs), len(cfg.wrns)
+
+    def check(r):
+        return expect('DRC errors/unconnected (reported, parsed)', r, ((a.violations, a.violations//10), a.violations,
+                      a.violations//10))
+    return Case('parse_drc_kicad{}'.format(kicad), setup, run, check)
+
+
+def parse_erc_case(kicad, a):
+    errors = a.violations//2
+    warnings = a.violations-errors
+
+    def setup(tmp):
+        name = os.path.join(tmp, 'erc_{}.rpt'.format(kicad))
+        with open(name, 'wt') as f:
+            f.write(synthetic.erc_report(kicad, errors, warnings))
+        return name
+
+    def run(name):
+        cfg = new_cfg(kicad, name)
+        res = a.eeschema_do.eeschema_parse_erc(cfg)
+        return res, len(cfg.errs), len(cfg.wrns)
+
+    def check(r):
+        return expect('ERC errors/warnings (reported, parsed)', r, ((errors, warnings), errors, warnings))
+    return Case('parse_erc_kicad{}'.format(kicad), setup, run, check)
+
+
+def load_filters_case(a):
+    def setup(tmp):
+        name = os.path.join(tmp, 'bench.filter')
+        with open(name, 'wt') as f:
+            f.write(synthetic.filters(KICAD6, a.filters))
+        return name
+
+    def run(name):
+        cfg = new_cfg(KICAD6)
+        load_filters(cfg, name)
+        return len(cfg.err_filters)
+
+    def check(r):
+        return expect('Loaded filters', r, a.filters)
+    return Case('load_filters', setup, run, check)
+
+
+def apply_filters_case(kicad, a):
+    def setup(tmp):
+        cfg = new_cfg(kicad)
+        name = os.path.join(tmp, 'apply_{}.rpt'.format(kicad))
+        with open(name, 'wt') as f:
+            f.write(synthetic.drc_report(kicad, a.violations, a.violations//10))
+        cfg.output_file = name
+        a.pcbnew_do.parse_drc(cfg)
+        name = os.path.join(tmp, 'apply_{}.filter'.format(kicad))
+        with open(name, 'wt') as f:
+            f.write(synthetic.filters(kicad, a.filters))
+        load_filters(cfg, name)
+        return cfg
+
+    def run(base):
+        # apply_filters marks the violations
+        for v in base.errs+base.wrns:
+            v.filter = None
+        skipped = apply_filters(base, 'DRC error/s', 'unconnected pad/s')
+        return skipped, sum(1 for e in base.errs if e.filter), sum(1 for w in base.wrns if w.filter)
+
+    def check(r):
+        # Something must be filtered, and the removed entries must match the returned counts
+        skipped, errs, wrns = r
+        if not skipped[0]:
+            return 'No DRC error filtered'
+        return expect('Filtered errors/unconnected', (errs, wrns), skipped)
+    return Case('apply_filters_kicad{}'.format(kicad), setup, run, check)
+
+
+def load_layers_case(kicad, cached, a):
+    inner = 4
+
+    def setup(tmp):
+        name = os.path.join(tmp, 'bench_{}.kicad_pcb'.format(kicad))
+        with open(name, 'wt') as f:
+            f.write(synthetic.pcb(kicad, inner, a.pcb_items))
+        if cached:
+            os.environ[cache.CACHE_ENV] = os.path.join(tmp, 'cache')
+            # Fill the cache
+            load_layers(name)
+        return name
+
+    def run(name):
+        if not cached:
+            os.environ[cache.CACHE_ENV] = ''
+        return load_layers(name)
+
+    def check(r):
+        names = [n for n in r if n != '-']
+        return expect('Used layers', len(names), inner+20) or expect('Layer 1', r[1],
+                                                                     'Inner1.Cu' if kicad == KICAD6 else 'In1.Cu')
+    return Case('load_layers_kicad{}{}'.format(kicad, '_cached' if cached else ''), setup, run, check)
+
+
+def get_cases(a):
+    cases = []
+    for kicad in [KICAD5, KICAD6]:
+        cases.append(parse_drc_case(kicad, a))
+        cases.append(parse_erc_case(kicad, a))
+    cases.append(load_filters_case(a))
+    for kicad in [KICAD5, KICAD6]:
+        cases.append(apply_filters_case(kicad, a))
+    for kicad in [KICAD5, KICAD6]:
+        cases.append(load_layers_case(kicad, False, a))
+    cases.append(load_layers_case(KICAD6, True, a))
+    return cases
+
+
+def run_case(case, repeat, tmp):
+    arg = case.setup(tmp)
+    times = []
+    error = None
+    for _ in range(repeat):
+        start = perf_counter()
+        res = case.run(arg)
+        times.append(perf_counter()-start)
+        error = error or case.check(res)
+    return {'time': times, 'time_median': median(times), 'time_min': min(times), 'error': error}
+
+
+def compare(results, baseline, threshold):
+    """ Prints the comparison, returns the names of the cases that regressed """
+    regressed = []
+    print('{:<28} {:>10} {:>10} {:>8}'.format('Case', 'Base [ms]', 'New [ms]', 'Change'))
+    for name, new in results['cases'].items():
+        old = baseline['cases'].get(name)
+        if old is None:
+            print('{:<28} {:>10} {:>10.2f}'.format(name, '-', new['time_min']*1000))
+            continue
+        # The minimum is less affected by the noise
+        delta = new['time_min']-old['time_min']
+        slower = delta > old['time_min']*threshold
+        print('{:<28} {:>10.2f} {:>10.2f} {:>+7.1f}%{}'.format(name, old['time_min']*1000, new['time_min']*1000,
+              delta/old['time_min']*100, ' REGRESSION' if slower else ''))
+        if slower:
+            regressed.append(name)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='KiAuto report parsers micro-benchmarks')
+    parser.add_argument('--repeat', '-n', help='Runs for each case [%(default)s]', type=int, default=5)
+    parser.add_argument('--violations', help='Violations in the reports [%(default)s]', type=int, default=20000)
+    parser.add_argument('--filters', help='Filters in the filter file [%(default)s]', type=int, default=500)
+    parser.add_argument('--pcb_items', help='Lines after the layers table of the PCB [%(default)s]', type=int,
+                        default=200000)
+    parser.add_argument('--output', '-o', help='JSON file for the results')
+    parser.add_argument('--baseline', '-b', help='Results to compare against')
+    parser.add_argument('--threshold', '-t', help='Allowed slow down (fraction) [%(default)s]', type=float, default=0.2)
+    parser.add_argument('cases', nargs='*', help='Cases to run [all]')
+    a = parser.parse_args()
+    a.pcbnew_do = load_script('pcbnew_do')
+    a.eeschema_do = load_script('eeschema_do')
+    # Measure the parsers, not the terminal
+    logging.disable(logging.WARNING)
+    cases = [c for c in get_cases(a) if not a.cases or c.name in a.cases]
+    results = {'kiauto': __version__, 'repeat': a.repeat, 'violations': a.violations, 'filters': a.filters, 'cases': {}}
+    failed = []
+    old_cache = os.environ.get(cache.CACHE_ENV)
+    with tempfile.TemporaryDirectory(prefix='kiauto-micro-') as tmp:
+        for case in cases:
+            r = results['cases'][case.name] = run_case(case, a.repeat, tmp)
+            if r['error']:
+                failed.append(case.name)
+    if old_cache is None:
+        os.environ.pop(cache.CACHE_ENV, None)
+    else:
+        os.environ[cache.CACHE_ENV] = old_cache
+    if a.output:
+        with open(a.output, 'wt') as f:
+            json.dump(results, f, indent=2)
+    for name in failed:
+        print('{}: {}'.format(name, results['cases'][name]['error']))
+    regressed = []
+    if a.baseline:
+        with open(a.baseline, 'rt') as f:
+            baseline = json.load(f)
+        regressed = compare(results, baseline, a.threshold)
+    else:
+        print('{:<28} {:>10} {:>12}'.format('Case', 'Min [ms]', 'Median [ms]'))
+        for name, r in results['cases'].items():
+            print('{:<28} {:>10.2f} {:>12.2f}'.format(name, r['time_min']*1000, r['time_median']*1000))
+    if regressed:
+        print('Regressions: '+', '.join(regressed))
+    return 1 if failed or regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 Salvador E. Tropea
+# Copyright (c) 2020 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+Startup benchmark
+
+Measures the fixed cost of each invocation:
+- `eeschema_do --version` (imports only)
+- `eeschema_do --cache netlist` when the result is in the cache (imports, KiCad version and cache lookup)
+
+Use --tree to compare against another checkout (i.e. a `git worktree` of an older version):
+tests/bench/startup.py --tree /tmp/kiauto-old --tree .
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from statistics import median
+from time import perf_counter
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+TOP = os.path.dirname(os.path.dirname(script_dir))
+PROJECT = 'good-project'
+
+
+def run_times(cmd, runs, env):
+    """ Wall time for each run of cmd """
+    times = []
+    for _ in range(runs):
+        start = perf_counter()
+        ret = subprocess.call(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=env)
+        times.append(perf_counter()-start)
+        if ret:
+            return None
+    return times
+
+
+def bench_tree(tree, runs, kicad_dir):
+    """ Results for the scripts found in tree """
+    eeschema_do = os.path.join(os.path.abspath(tree), 'src', 'eeschema_do')
+    results = [('--version', run_times([sys.executable, eeschema_do, '--version'], runs, None))]
+    with tempfile.TemporaryDirectory(prefix='kiauto-bench-') as tmp:
+        prj = os.path.join(tmp, PROJECT)
+        shutil.copytree(os.path.join(TOP, 'tests', kicad_dir, PROJECT), prj)
+        sch = os.path.join(prj, PROJECT+('.kicad_sch' if kicad_dir == 'kicad6' else '.sch'))
+        env = dict(os.environ)
+        env['KIAUS_CACHE_DIR'] = os.path.join(tmp, 'cache')
+        cmd = [sys.executable, eeschema_do, '--cache', 'netlist', sch, os.path.join(tmp, 'out')]
+        # Fill the caches (result and KiCad version)
+        if run_times(cmd, 1, env) is None:
+            results.append(('cached netlist', None))
+        else:
+            results.append(('cached netlist', run_times(cmd, runs, env)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='KiAuto startup benchmark')
+    parser.add_argument('--runs', '-n', help='Runs for each command [%(default)s]', type=int, default=10)
+    parser.add_argument('--tree', '-t', help='KiAuto tree to measure (can be repeated) [top of this tree]',
+                        action='append')
+    parser.add_argument('--kicad', help='Fixtures to use [%(default)s]', choices=['kicad5', 'kicad6'], default='kicad6')
+    args = parser.parse_args()
+    print('{:<30} {:<16} {:>10} {:>10}'.format('Tree', 'Command', 'Min [ms]', 'Median [ms]'))
+    for tree in args.tree or [TOP]:
+        for name, times in bench_tree(tree, args.runs, args.kicad):
+            if times is None:
+                print('{:<30} {:<16} {:>10}'.format(tree[-30:], name, 'failed'))
+            else:
+                print('{:<30} {:<16} {:>10.1f} {:>10.1f}'.format(tree[-30:], name, min(times)*1000, median(times)*1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2020 Salvador E. Tropea
+# Copyright (c) 2020 Instituto Nacional de Tecnologïa Industrial
+# License: Apache 2.0
+# Project: KiAuto (formerly kicad-automation-scripts)
+"""
+Synthetic inputs for the report parsers
+
+Generates DRC and ERC reports (KiCad 5 `ErrType(n)` and KiCad 6 `[code]`
+formats), error filter files and PCBs with a big body after the layers
+table. The output is deterministic for a given seed.
+"""
+import random
+
+KICAD5 = 5
+KICAD6 = 6
+DRC_CODES = {KICAD5: ['2', '3', '5', '13', '45', '46'],
+             KICAD6: ['clearance', 'courtyards_overlap', 'track_dangling', 'silk_over_copper', 'hole_clearance',
+                      'copper_edge_clearance']}
+UNCONNECTED_CODE = {KICAD5: '2', KICAD6: 'unconnected_items'}
+ERC_CODES = {KICAD5: ['2', '3', '4', '5', '6'],
+             KICAD6: ['pin_not_driven', 'pin_to_pin', 'power_pin_not_driven', 'label_dangling', 'pin_not_connected']}
+REF_PREFIXES = ['R', 'C', 'U', 'D', 'Q', 'J']
+NETS = ['GND', 'VCC', '+3V3', '/SDA', '/SCL', 'Net-(R1-Pad2)']
+
+
+def _ref(rnd):
+    return '{}{}'.format(rnd.choice(REF_PREFIXES), rnd.randint(1, 500))
+
+
+def _code(kicad, code):
+    return 'ErrType({})'.format(code) if kicad == KICAD5 else '[{}]'.format(code)
+
+
+def _pos(rnd, kicad):
+    fmt = '{:.3f}' if kicad == KICAD5 else '{:.4f}'
+    return '@(' + fmt.format(rnd.uniform(0, 300)) + ' mm, ' + fmt.format(rnd.uniform(0, 200)) + ' mm)'
+
+
+def _drc_item(rnd, kicad, code, severity):
+    lines = ['{}: Clearance violation (netclass \'Default\' clearance 0.2000 mm; actual {:.4f} mm)'.
+             format(_code(kicad, code), rnd.uniform(0, 0.2))]
+    if kicad == KICAD6:
+        lines.append("    Rule: netclass 'Default'; Severity: "+severity)
+    pad = rnd.randint(1, 20)
+    lines.append('    {}: Pad {} [{}] of {} on F.Cu'.format(_pos(rnd, kicad), pad, rnd.choice(NETS), _ref(rnd)))
+    lines.append('    {}: Track [{}] on F.Cu, length {:.4f} mm'.format(_pos(rnd, kicad), rnd.choice(NETS),
+                                                                       rnd.uniform(0.1, 50)))
+    return lines
+
+
+def drc_report(kicad, errors, unconnected, seed=0):
+    """ A DRC report with `errors` violations and `unconnected` unconnected pads """
+    rnd = random.Random(seed)
+    lines = ['** Drc report for /tmp/bench.kicad_pcb **', '** Created on 2020-12-01 10:00:00 **', '']
+    lines.append('** Found {} DRC {} **'.format(errors, 'errors' if kicad == KICAD5 else 'violations'))
+    for _ in range(errors):
+        lines.extend(_drc_item(rnd, kicad, rnd.choice(DRC_CODES[kicad]), 'error'))
+    lines.append('')
+    lines.append('** Found {} unconnected pads **'.format(unconnected))
+    for _ in range(unconnected):
+        lines.extend(_drc_item(rnd, kicad, UNCONNECTED_CODE[kicad], 'warning'))
+    lines.append('')
+    if kicad == KICAD6:
+        lines.extend(['** Found 0 Footprint errors **', ''])
+    lines.append('** End of Report **')
+    return '\n'.join(lines)+'\n'
+
+
+def erc_report(kicad, errors, warnings, seed=0):
+    """ An ERC report with `errors` errors and `warnings` warnings, spread in a few sheets """
+    rnd = random.Random(seed)
+    lines = ['ERC report (Tue 01 Dec 2020 10:00:00 AM UTC, Encoding UTF8 )', '']
+    # The severity is reported in the same line as the code, this is what the parser expects
+    items = ['error']*errors+['warning']*warnings
+    rnd.shuffle(items)
+    sheet = 0
+    for n, severity in enumerate(items):
+        if n % 1000 == 0:
+            lines.extend(['', '***** Sheet /sheet{}/'.format(sheet)])
+            sheet += 1
+        lines.append('{}: Pin connected to other pins, but not driven by any pin; Severity: {}'.
+                     format(_code(kicad, rnd.choice(ERC_CODES[kicad])), severity))
+        lines.append('    {}: Symbol {} Pin {} [Input, Line]'.format(_pos(rnd, kicad), _ref(rnd), rnd.randint(1, 20)))
+    lines.append('')
+    lines.append(' ** ERC messages: {}  Errors {}  Warnings {}'.format(errors+warnings, errors, warnings))
+    return '\n'.join(lines)+'\n'
+
+
+def filters(kicad, count, drc=True, seed=0):
+    """ A filter file with `count` filters, about half of them match the references used in the reports """
+    rnd = random.Random(seed)
+    codes = (DRC_CODES[kicad]+[UNCONNECTED_CODE[kicad]]) if drc else ERC_CODES[kicad]
+    lines = ['# Synthetic filters', '']
+    for n in range(count):
+        if n % 2:
+            regex = r'of {}\b'.format(_ref(rnd)) if drc else r'Symbol {} '.format(_ref(rnd))
+        else:
+            regex = r'Footprint NOT{}'.format(n)
+        if n % 50 == 0:
+            lines.append('# Group {}'.format(n//50))
+        lines.append('{},{}'.format(rnd.choice(codes), regex))
+    return '\n'.join(lines)+'\n'
+
+
+def pcb(kicad, inner=4, body_items=20000):
+    """ A .kicad_pcb with `inner` inner layers and `body_items` lines after the layers table """
+    quote = (lambda s: '"'+s+'"') if kicad == KICAD6 else (lambda s: s)
+    lines = ['(kicad_pcb (version {}) (generator pcbnew)'.format(20211014 if kicad == KICAD6 else 20171130), '',
+             '  (general', '    (thickness 1.6)', '  )', '', '  (paper "A4")', '  (layers']
+    lines.append('    (0 {} signal)'.format(quote('F.Cu')))
+    for n in range(1, inner+1):
+        user = ' "Inner{}.Cu"'.format(n) if kicad == KICAD6 else ''
+        lines.append('    ({} {} signal{})'.format(n, quote('In{}.Cu'.format(n)), user))
+    lines.append('    (31 {} signal)'.format(quote('B.Cu')))
+    for n, name in enumerate(['B.Adhes', 'F.Adhes', 'B.Paste', 'F.Paste', 'B.SilkS', 'F.SilkS', 'B.Mask', 'F.Mask',
+                              'Dwgs.User', 'Cmts.User', 'Eco1.User', 'Eco2.User', 'Edge.Cuts', 'Margin', 'B.CrtYd',
+                              'F.CrtYd', 'B.Fab', 'F.Fab']):
+        lines.append('    ({} {} user)'.format(32+n, quote(name)))
+    lines.append('  )')
+    lines.append('')
+    for n in range(body_items):
+        lines.append('  (segment (start {0}.1 50) (end {0}.2 60) (width 0.25) (layer "F.Cu") (net {1}))'.format(n, n % 40))
+    lines.append(')')
+    return '\n'.join(lines)+'\n'
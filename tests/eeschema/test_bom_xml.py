@@ -13,11 +13,15 @@ pytest-3 --log-cli-level debug
 
 import os
 import sys
+import json
 # Look for the 'utils' module from where the script is running
 script_dir = os.path.dirname(os.path.abspath(__file__))
-sys.path.insert(0, os.path.dirname(script_dir))
+prev_dir = os.path.dirname(script_dir)
+sys.path.insert(0, prev_dir)
 # Utils import
 from utils import context
+sys.path.insert(0, os.path.dirname(prev_dir))
+from kiauto.misc import WRONG_ARGUMENTS
 
 PROG = 'eeschema_do'
 
@@ -33,3 +37,62 @@ def test_bom_xml():
                              r'P1 ,1,"CONN_01X02","Connector_JST:JST_JWPF_B02B-JWPF-SK-R_1x02_P2.00mm_Vertical"',
                              r'R1 ,1,"R","Resistor_SMD:R_0402_1005Metric"'])
     ctx.clean_up()
+
+
+def test_bom_xml_no_headless():
+    """ Force the use of eeschema for KiCad 6 """
+    prj = 'good-project'
+    bom = prj+'.csv'
+    ctx = context.TestContextSCH('BoM_XML_No_Headless', prj)
+    cmd = [PROG, '-v', '--no_headless', 'bom_xml']
+    ctx.run(cmd)
+    ctx.expect_out_file(bom)
+    assert ctx.search_err(r'Headless `bom_xml` created') is None
+    ctx.search_in_file(bom, [r'C1 C2 ,2,"C","Capacitor_SMD:C_0402_1005Metric"',
+                             r'R1 ,1,"R","Resistor_SMD:R_0402_1005Metric"'])
+    ctx.clean_up()
+
+
+def test_bom_xml_scratch():
+    """ eeschema runs on a copy of the project, the XML is copied back """
+    prj = 'good-project'
+    bom = prj+'.csv'
+    ctx = context.TestContextSCH('BoM_XML_Scratch', prj)
+    xml = os.path.splitext(ctx.board_file)[0]+'.xml'
+    if os.path.isfile(xml):
+        os.remove(xml)
+    cmd = [PROG, '-vv', '--scratch', 'bom_xml']
+    ctx.run(cmd)
+    ctx.expect_out_file(bom)
+    assert ctx.search_err('Project staged in') is not None
+    assert os.path.isfile(xml)
+    os.remove(xml)
+    ctx.clean_up()
+
+
+def test_bom_xml_formats():
+    """ CSV and JSON from the same XML, grouped only by value """
+    prj = 'good-project'
+    bom = prj+'.csv'
+    bom_json = prj+'.json'
+    ctx = context.TestContextSCH('BoM_XML_Formats', prj)
+    cmd = [PROG, 'bom_xml', '--bom_formats', 'csv,json', '--bom_group_by', 'Value']
+    ctx.run(cmd)
+    ctx.expect_out_file(bom)
+    ctx.expect_out_file(bom_json)
+    ctx.search_in_file(bom, [r'C1 C2 ,2,"C","Capacitor_SMD:C_0402_1005Metric"'])
+    with open(ctx.get_out_path(bom_json)) as f:
+        data = json.load(f)
+    assert data[0]['references'] == ['C1', 'C2']
+    assert data[0]['quantity'] == 2
+    assert data[0]['value'] == 'C'
+    ctx.clean_up()
+
+
+def test_bom_xml_wrong_format():
+    prj = 'good-project'
+    ctx = context.TestContextSCH('BoM_XML_Wrong_Format', prj)
+    cmd = [PROG, 'bom_xml', '--bom_formats', 'xls']
+    ctx.run(cmd, WRONG_ARGUMENTS)
+    assert ctx.search_err(r'Unknown BoM format `xls`')
+    ctx.clean_up()
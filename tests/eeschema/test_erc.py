@@ -13,6 +13,7 @@ pytest-3 --log-cli-level debug
 
 import os
 import sys
+import json
 import logging
 # Look for the 'utils' module from where the script is running
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -156,6 +157,27 @@ def test_erc_filter_1():
     ctx.clean_up()
 
 
+def test_erc_filter_json():
+    """ Test the --json option, using filters. """
+    prj = 'fail-project'
+    ctx = context.TestContextSCH('ERC_Filter_JSON', prj)
+    cmd = [PROG, '-v', 'run_erc', '--json', '-f', ctx.get_prodir_filename('fail.filter')]
+    ctx.run(cmd)
+    ctx.expect_out_file(prj+'.ndjson')
+    ctx.expect_out_file(prj+'.summary.json')
+    with open(ctx.get_out_path(prj+'.ndjson'), 'rt') as f:
+        violations = [json.loads(ln) for ln in f]
+    assert len(violations) == 3
+    assert all(v['filtered'] for v in violations)
+    assert len([v for v in violations if v['severity'] == 'error']) == 1
+    with open(ctx.get_out_path(prj+'.summary.json'), 'rt') as f:
+        summary = json.load(f)
+    assert summary['type'] == 'erc'
+    assert summary['counts'] == {'errors': 0, 'warnings': 0, 'filtered_errors': 1, 'filtered_warnings': 2}
+    assert sum(f['hits'] for f in summary['filters']) == 3
+    ctx.clean_up()
+
+
 def test_erc_filter_bad_name():
     """ Wrong filter name. """
     prj = 'fail-project'
@@ -13,15 +13,26 @@ pytest-3 --log-cli-level debug
 
 import os
 import sys
+import json
 # Look for the 'utils' module from where the script is running
 script_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, os.path.dirname(script_dir))
 # Utils import
 from utils import context
+sys.path.insert(0, os.path.dirname(os.path.dirname(script_dir)))
+from kiauto.metrics import METRICS_ENV
+from kiauto import sexp
 
 PROG = 'eeschema_do'
 
 
+def get_nets(file):
+    """ {name: set of (ref, pin)} for the nets in a netlist """
+    nets = sexp.find(sexp.load(file), 'nets')
+    return {sexp.value(n, 'name'): {(sexp.value(nd, 'ref'), sexp.value(nd, 'pin')) for nd in sexp.find_all(n, 'node')}
+            for n in sexp.find_all(nets, 'net')}
+
+
 def test_netlist():
     """ 1) Test netlist creation.
         2) Output file already exists. """
@@ -37,3 +48,71 @@ def test_netlist():
                              r'\(node \(ref "?R1"?\) \(pin "?2"?\)( \(pinfunction "2"\))?\)',
                              r'\(export \(version "?D"?\)'])
     ctx.clean_up()
+
+
+def test_netlist_headless():
+    """ KiCad 6 netlists are created without eeschema, unless --no_headless """
+    prj = 'good-project'
+    net = prj+'.net'
+    ctx = context.TestContextSCH('Netlist_Headless', prj)
+    if ctx.kicad_version < context.KICAD_VERSION_5_99:
+        ctx.clean_up()
+        return
+    cmd = [PROG, '-v', 'netlist']
+    ctx.run(cmd)
+    ctx.expect_out_file(net)
+    assert ctx.search_err(r'Headless `netlist` created')
+    ctx.search_in_file(net, [r'\(net \(code "\d+"\) \(name "GND"\)',
+                             r'\(net \(code "\d+"\) \(name "/VCC"\)',
+                             r'\(node \(ref "R1"\) \(pin "2"\) \(pinfunction "2"\)\)',
+                             r'\(export \(version "D"\)'])
+    headless_nets = get_nets(ctx.get_out_path(net))
+    # Now using eeschema
+    cmd = [PROG, '-v', '--no_headless', 'netlist']
+    ctx.run(cmd)
+    ctx.expect_out_file(net)
+    assert ctx.search_err(r'Headless `netlist` created') is None
+    ctx.search_in_file(net, [r'\(node \(ref "R1"\) \(pin "2"\) \(pinfunction "2"\)\)'])
+    # Same nets, names included
+    assert get_nets(ctx.get_out_path(net)) == headless_nets
+    ctx.clean_up()
+
+
+def test_netlist_trace():
+    """ --trace and --profile """
+    prj = 'good-project'
+    ctx = context.TestContextSCH('Netlist_Trace', prj)
+    trace = ctx.get_out_path('trace.json')
+    profile = ctx.get_out_path('run.prof')
+    cmd = [PROG, '--trace', trace, '--profile', profile, 'netlist']
+    ctx.run(cmd)
+    ctx.expect_out_file(prj+'.net')
+    ctx.expect_out_file('run.prof')
+    with open(trace, 'rt') as f:
+        events = json.load(f)['traceEvents']
+    names = {e['name'] for e in events}
+    assert 'eeschema_do' in names
+    assert 'memorize_project' in names
+    assert ('run_headless' if ctx.kicad_version >= context.KICAD_VERSION_5_99 else 'wait_eeschema_start') in names
+    assert all(e['ph'] in ('X', 'i') for e in events)
+    ctx.clean_up()
+
+
+def test_netlist_metrics():
+    """ Two runs sharing the metrics file """
+    prj = 'good-project'
+    ctx = context.TestContextSCH('Netlist_Metrics', prj)
+    prom = 'kiauto.prom'
+    os.environ[METRICS_ENV] = ctx.get_out_path(prom)
+    try:
+        cmd = [PROG, 'netlist']
+        ctx.run(cmd)
+        ctx.run(cmd)
+    finally:
+        del os.environ[METRICS_ENV]
+    ctx.expect_out_file(prom)
+    ctx.search_in_file(prom, [r'^# TYPE kiauto_job_duration_seconds histogram$',
+                              r'^kiauto_job_duration_seconds_count\{script="eeschema_do",command="netlist",'
+                              r'kicad_version="[\d\.]+",result="ok"\} 2$',
+                              r'^kiauto_phase_duration_seconds_bucket\{.*phase="memorize_project".*le="\+Inf"\} 2$'])
+    ctx.clean_up()
@@ -13,6 +13,7 @@ pytest-3 --log-cli-level debug
 
 import os
 import sys
+import json
 import logging
 # Look for the 'utils' module from where the script is running
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -21,54 +22,42 @@ sys.path.insert(0, prev_dir)
 # Utils import
 from utils import context
 sys.path.insert(0, os.path.dirname(prev_dir))
-from kiauto.misc import (EESCHEMA_CFG_PRESENT, KICAD_CFG_PRESENT, NO_SCHEMATIC, WRONG_SCH_NAME, EESCHEMA_ERROR,
-                         WRONG_ARGUMENTS)
+from kiauto.misc import (NO_SCHEMATIC, WRONG_SCH_NAME, EESCHEMA_ERROR, WRONG_ARGUMENTS, REC_W, REC_H)
+from kiauto.display_pool import (DisplayPool, POOL_ENV)
+from kiauto.x11_backend import BACKEND_ENV
+from kiauto.cache import CACHE_ENV
 
 PROG = 'eeschema_do'
 BOGUS_SCH = 'bogus.sch'
 
 
-def test_eeschema_config_backup():
-    """ Here we test the extreme situation that a previous run left a config
-        back-up and the user must take action. """
+def test_eeschema_private_config():
+    """ The user config isn't touched, a stale back-up from old versions is ignored """
     prj = 'good-project'
-    ctx = context.TestContextSCH('Eeschema_config_bkp', prj)
-    # Create a fake back-up
-    if not os.path.isdir(ctx.kicad_cfg_dir):
-        logging.debug('Creating KiCad config dir')
-        os.makedirs(ctx.kicad_cfg_dir, exist_ok=True)
+    ctx = context.TestContextSCH('Eeschema_private_config', prj)
+    os.makedirs(ctx.kicad_cfg_dir, exist_ok=True)
+    created = not os.path.isfile(ctx.eeschema_conf)
+    if created:
+        logging.debug('Creating a dummy Eeschema config')
+        with open(ctx.eeschema_conf, 'wt') as f:
+            f.write('Dummy user config\n')
+    with open(ctx.eeschema_conf, 'rt') as f:
+        user_config = f.read()
     old_config_file = ctx.eeschema_conf + '.pre_script'
-    logging.debug('Eeschema old config: '+old_config_file)
     with open(old_config_file, 'wt') as f:
         f.write('Dummy back-up\n')
     # Run the command
-    cmd = [PROG, 'run_erc']
-    ctx.run(cmd, EESCHEMA_CFG_PRESENT)
-    os.remove(old_config_file)
-    m = ctx.search_err('Eeschema config back-up found')
-    assert m is not None
-    ctx.clean_up()
-
-
-def test_kicad_common_config_backup():
-    """ Here we test the extreme situation that a previous run left a config
-        back-up and the user must take action. """
-    prj = 'good-project'
-    ctx = context.TestContextSCH('Eeschema_common_config_bkp', prj)
-    # Create a fake back-up
-    if not os.path.isdir(ctx.kicad_cfg_dir):
-        logging.debug('Creating KiCad config dir')
-        os.makedirs(ctx.kicad_cfg_dir, exist_ok=True)
-    old_config_file = ctx.kicad_conf + '.pre_script'
-    logging.debug('KiCad common old config: '+old_config_file)
-    with open(old_config_file, 'wt') as f:
-        f.write('Dummy back-up\n')
-    # Run the command
-    cmd = [PROG, 'run_erc']
-    ctx.run(cmd, KICAD_CFG_PRESENT)
-    os.remove(old_config_file)
-    m = ctx.search_err('KiCad common config back-up found')
-    assert m is not None
+    try:
+        cmd = [PROG, '-vv', 'run_erc']
+        ctx.run(cmd)
+        with open(ctx.eeschema_conf, 'rt') as f:
+            assert f.read() == user_config
+        assert os.path.isfile(old_config_file)
+    finally:
+        os.remove(old_config_file)
+        if created:
+            os.remove(ctx.eeschema_conf)
+    assert ctx.search_err('Using a private KiCad config') is not None
     ctx.clean_up()
 
 
@@ -116,3 +105,129 @@ def test_sch_wrong_command():
     cmd = [PROG, 'bogus']
     ctx.run(cmd, WRONG_ARGUMENTS)
     ctx.clean_up()
+
+
+def test_display_pool():
+    """ Use a display from a pool of X servers """
+    prj = 'good-project'
+    ctx = context.TestContextSCH('SCH_Display_Pool', prj)
+    pool = DisplayPool(ctx.get_out_path('pool'), 1, REC_W, REC_H)
+    pool.start()
+    os.environ[POOL_ENV] = pool.pool_dir
+    try:
+        cmd = [PROG, '-vv', '--no_headless', 'netlist']
+        ctx.run(cmd)
+    finally:
+        del os.environ[POOL_ENV]
+        pool.stop()
+    ctx.expect_out_file(prj+'.net')
+    assert ctx.search_err(r'Leased display :\d+ from the pool') is not None
+    ctx.clean_up()
+
+
+def test_session():
+    """ Run various commands using the same eeschema instance """
+    prj = 'good-project'
+    ctx = context.TestContextSCH('SCH_Session', prj)
+    cmd = [PROG, '-vv', '--no_headless', 'session', 'export:pdf,export:svg,netlist,bom_xml,run_erc']
+    ctx.run(cmd)
+    ctx.expect_out_file(prj+'.pdf')
+    ctx.expect_out_file(prj+'.svg')
+    ctx.expect_out_file(prj+'.net')
+    ctx.expect_out_file(prj+'.csv')
+    ctx.expect_out_file(prj+'.erc')
+    assert ctx.search_err(r'Select the svg format') is not None
+    ctx.clean_up()
+
+
+def test_session_erc_json_and_bom_json():
+    """ The ERC summary and the JSON BoM use different names """
+    prj = 'good-project'
+    ctx = context.TestContextSCH('SCH_Session_JSON', prj)
+    cmd = [PROG, 'session', 'run_erc,bom_xml', '--json', '--bom_formats', 'csv,json']
+    ctx.run(cmd)
+    ctx.expect_out_file(prj+'.erc')
+    ctx.expect_out_file(prj+'.ndjson')
+    ctx.expect_out_file(prj+'.summary.json')
+    ctx.expect_out_file(prj+'.csv')
+    ctx.expect_out_file(prj+'.json')
+    with open(ctx.get_out_path(prj+'.summary.json'), 'rt') as f:
+        assert json.load(f)['type'] == 'erc'
+    with open(ctx.get_out_path(prj+'.json'), 'rt') as f:
+        # The BoM is a list of groups
+        assert isinstance(json.load(f), list)
+    ctx.clean_up()
+
+
+def test_session_wrong_command():
+    """ Unknown command in the session list """
+    ctx = context.TestContextSCH('SCH_Session_Wrong', 'good-project')
+    cmd = [PROG, 'session', 'export:pdf,bogus']
+    ctx.run(cmd, WRONG_ARGUMENTS)
+    assert ctx.search_err(r'Unknown session command `bogus`') is not None
+    ctx.clean_up()
+
+
+def run_netlist_with_backend(name, backend):
+    prj = 'good-project'
+    ctx = context.TestContextSCH(name, prj)
+    os.environ[BACKEND_ENV] = backend
+    try:
+        cmd = [PROG, '-vv', '--no_headless', 'netlist']
+        ctx.run(cmd)
+    finally:
+        del os.environ[BACKEND_ENV]
+    ctx.expect_out_file(prj+'.net')
+    return ctx
+
+
+def test_x11_backend_xlib():
+    """ xdotool commands executed in-process """
+    ctx = run_netlist_with_backend('SCH_X11_Backend_Xlib', 'xlib')
+    assert ctx.search_err(r'Using the Xlib backend for :\d+') is not None
+    ctx.clean_up()
+
+
+def test_x11_backend_xdotool():
+    """ Force the use of the xdotool subprocesses """
+    ctx = run_netlist_with_backend('SCH_X11_Backend_xdotool', 'xdotool')
+    assert ctx.search_err(r'Using the Xlib backend') is None
+    ctx.clean_up()
+
+
+def test_result_cache():
+    """ The second run restores the outputs from the cache """
+    prj = 'good-project'
+    ctx = context.TestContextSCH('SCH_Result_Cache', prj)
+    pdf = prj+'.pdf'
+    os.environ[CACHE_ENV] = ctx.get_out_path('cache')
+    try:
+        cmd = [PROG, '-v', '--cache', 'export']
+        ctx.run(cmd)
+        ctx.expect_out_file(pdf)
+        assert ctx.search_err(r'Using cached results') is None
+        os.remove(ctx.get_out_path(pdf))
+        ctx.run(cmd)
+        ctx.expect_out_file(pdf)
+        assert ctx.search_err(r'Using cached results') is not None
+    finally:
+        del os.environ[CACHE_ENV]
+    ctx.clean_up()
+
+
+def test_result_cache_erc():
+    """ The violations are also listed when using the cached ERC report """
+    prj = 'fail-project'
+    ctx = context.TestContextSCH('SCH_Result_Cache_ERC', prj)
+    os.environ[CACHE_ENV] = ctx.get_out_path('cache')
+    try:
+        ctx.run([PROG, '-v', '--cache', 'run_erc'], 255)
+        ctx.run([PROG, '-v', '--cache', 'run_erc'], 255)
+        assert ctx.search_err(r'Using cached results') is not None
+        m = ctx.search_err(r'(\d+) ERC errors')
+        assert m is not None and m.group(1) == '1'
+        m = ctx.search_err(r'(\d+) ERC warnings')
+        assert m is not None and m.group(1) == '2'
+    finally:
+        del os.environ[CACHE_ENV]
+    ctx.clean_up()
@@ -23,6 +23,7 @@ sys.path.insert(0, prev_dir)
 from utils import context
 sys.path.insert(0, os.path.dirname(prev_dir))
 from kiauto.misc import Config
+from kiauto.cache import CACHE_ENV
 
 PROG = 'pcbnew_do'
 REPORT = 'drc_result.rpt'
@@ -131,3 +132,51 @@ def test_drc_no_save():
     ctx.expect_out_file(REPORT)
     assert os.path.getsize(ctx.board_file) == size
     ctx.clean_up()
+
+
+def test_drc_scratch():
+    """ KiCad runs on a copy of the project, only the saved PCB is copied back """
+    ctx = context.TestContext('DRC_Scratch', 'zone-refill')
+    shutil.copy2(ctx.board_file+'.ok', ctx.board_file)
+    mtime = os.path.getmtime(ctx.board_file)
+    pro_mtime = ctx.get_pro_mtime()
+    ctx.run([PROG, '-vv', '--scratch', 'run_drc'])
+    ctx.expect_out_file(REPORT)
+    assert ctx.search_err('Project staged in') is not None
+    assert os.path.getmtime(ctx.board_file) == mtime
+    assert ctx.get_pro_mtime() == pro_mtime
+    assert not os.path.isfile(ctx.board_file+'-bak')
+    # The staged project is removed
+    assert not [f for f in os.listdir(ctx.output_dir) if f.startswith('.kiauto-scratch-')]
+    # Now save it
+    ctx.run([PROG, '--scratch', 'run_drc', '--save'])
+    assert os.path.getmtime(ctx.board_file) != mtime
+    assert os.path.isfile(ctx.board_file+'-bak')
+    shutil.copy2(ctx.board_file+'.ok', ctx.board_file)
+    os.remove(ctx.board_file+'-bak')
+    ctx.clean_up()
+
+
+def test_drc_reuse_fill():
+    """ The second DRC reuses the zone fill, --force_refill fills them again """
+    ctx = context.TestContext('DRC_Reuse_Fill', 'zone-refill')
+    if ctx.kicad_version < context.KICAD_VERSION_5_99:
+        # Only the Python DRC fills the zones
+        ctx.clean_up()
+        return
+    shutil.copy2(ctx.board_file+'.ok', ctx.board_file)
+    cache = ctx.get_out_path('cache')
+    os.environ[CACHE_ENV] = cache
+    try:
+        cmd = [PROG, '-v', 'run_drc']
+        ctx.run(cmd)
+        assert ctx.search_err('Zones refilled') is not None
+        assert len(os.listdir(os.path.join(cache, 'zone_fills'))) == 1
+        ctx.run(cmd)
+        ctx.expect_out_file(REPORT)
+        assert ctx.search_err('Zone fill reused') is not None
+        ctx.run(cmd+['--force_refill'])
+        assert ctx.search_err('Zones refilled') is not None
+    finally:
+        del os.environ[CACHE_ENV]
+    ctx.clean_up()
@@ -21,33 +21,39 @@ sys.path.insert(0, prev_dir)
 # Utils import
 from utils import context
 sys.path.insert(0, os.path.dirname(prev_dir))
-from kiauto.misc import (PCBNEW_CFG_PRESENT, NO_PCB, WRONG_PCB_NAME, WRONG_ARGUMENTS, CORRUPTED_PCB)
+from kiauto.misc import (NO_PCB, WRONG_PCB_NAME, WRONG_ARGUMENTS, CORRUPTED_PCB)
 
 PROG = 'pcbnew_do'
 BOGUS_PCB = 'bogus.kicad_pcb'
 
 
-def test_pcbnew_config_backup():
-    """ Here we test the extreme situation that a previous run left a config
-        back-up and the user must take action. """
+def test_pcbnew_private_config():
+    """ The user config isn't touched, a stale back-up from old versions is ignored """
     prj = 'good-project'
-    ctx = context.TestContext('PCBnew_config_bkp', prj)
-    # Create a fake back-up
-    if not os.path.isdir(ctx.kicad_cfg_dir):
-        logging.debug('Creating KiCad config dir')
-        os.makedirs(ctx.kicad_cfg_dir, exist_ok=True)
+    ctx = context.TestContext('PCBnew_private_config', prj)
+    os.makedirs(ctx.kicad_cfg_dir, exist_ok=True)
+    created = not os.path.isfile(ctx.pcbnew_conf)
+    if created:
+        logging.debug('Creating a dummy PCBnew config')
+        with open(ctx.pcbnew_conf, 'wt') as f:
+            f.write('Dummy user config\n')
+    with open(ctx.pcbnew_conf, 'rt') as f:
+        user_config = f.read()
     old_config_file = ctx.pcbnew_conf + '.pre_script'
-    logging.debug('PCBnew old config: '+old_config_file)
     with open(old_config_file, 'wt') as f:
         f.write('Dummy back-up\n')
     # Run the command
     try:
-        cmd = [PROG, 'run_drc']
-        ctx.run(cmd, PCBNEW_CFG_PRESENT)
+        cmd = [PROG, '-vv', 'export']
+        ctx.run(cmd, extra=['F.Cu'])
+        with open(ctx.pcbnew_conf, 'rt') as f:
+            assert f.read() == user_config
+        assert os.path.isfile(old_config_file)
     finally:
         os.remove(old_config_file)
-    m = ctx.search_err('PCBnew config back-up found')
-    assert m is not None
+        if created:
+            os.remove(ctx.pcbnew_conf)
+    assert ctx.search_err('Using a private KiCad config') is not None
     ctx.clean_up()
 
 
@@ -14,6 +14,7 @@ pytest-3 --log-cli-level debug
 import os
 import sys
 import logging
+import re
 # Look for the 'utils' module from where the script is running
 script_dir = os.path.dirname(os.path.abspath(__file__))
 prev_dir = os.path.dirname(script_dir)
@@ -22,6 +23,7 @@ sys.path.insert(0, prev_dir)
 from utils import context
 sys.path.insert(0, os.path.dirname(prev_dir))
 from kiauto.misc import (WRONG_LAYER_NAME, WRONG_ARGUMENTS, Config)
+from kiauto.cache import CACHE_ENV
 
 
 PROG = 'pcbnew_do'
@@ -62,6 +64,23 @@ def test_print_pcb_layers():
     ctx.clean_up()
 
 
+def test_print_pcb_layers_cached():
+    """ The second --list uses the cached layer table """
+    ctx = context.TestContext('Print_Layers_Cached', 'good-project')
+    cache = ctx.get_out_path('cache')
+    os.environ[CACHE_ENV] = cache
+    try:
+        cmd = [PROG, 'export', '--list']
+        ctx.run(cmd)
+        ctx.compare_txt(CMD_OUT, 'good_pcb_layers.txt')
+        assert len(os.listdir(os.path.join(cache, 'layers'))) == 1
+        ctx.run(cmd)
+        ctx.compare_txt(CMD_OUT, 'good_pcb_layers.txt')
+    finally:
+        del os.environ[CACHE_ENV]
+    ctx.clean_up()
+
+
 def test_print_pcb_good_dwg_dism():
     ctx = context.TestContext('Print_Good_with_Dwg_Dism', 'good-project')
     pdf = 'good_pcb_with_dwg.pdf'
@@ -176,3 +195,38 @@ def test_print_pcb_good_dwg_2():
         assert ctx.search_err(r"KiCad 5 doesn't support setting mirror")
     ctx.compare_pdf(pdf)
     ctx.clean_up()
+
+
+def test_print_pcb_headless():
+    """ Plot API, one page for each layer """
+    ctx = context.TestContext('Print_Headless', 'good-project')
+    pdf = 'good_pcb_headless.pdf'
+    cmd = [PROG, '-v', 'export', '--headless', '--separate', '--mirror', '--no-title', '--output_name', pdf]
+    layers = ['F.Cu', 'F.SilkS', 'Dwgs.User', 'Edge.Cuts']
+    ctx.run(cmd, extra=layers)
+    ctx.expect_out_file(pdf)
+    assert ctx.search_err(r'Created .*good_pcb_headless.pdf')
+    with open(ctx.get_out_path(pdf), 'rb') as f:
+        pages = re.findall(rb'/Type\s*/Page[^s]', f.read())
+    assert len(pages) == len(layers)
+    ctx.clean_up()
+
+
+def test_print_pcb_headless_svg():
+    """ Plot API, all the layers in one SVG """
+    ctx = context.TestContext('Print_Headless_SVG', 'good-project')
+    svg = 'good_pcb_headless.svg'
+    cmd = [PROG, 'export', '--headless', '--output_name', svg]
+    layers = ['F.Cu', 'F.SilkS', 'Edge.Cuts']
+    ctx.run(cmd, extra=layers)
+    ctx.expect_out_file(svg)
+    ctx.clean_up()
+
+
+def test_print_pcb_headless_wrong_format():
+    ctx = context.TestContext('Print_Headless_Wrong', 'good-project')
+    cmd = [PROG, 'export', '--headless', '--output_name', 'printed.ps']
+    layers = ['F.Cu']
+    ctx.run(cmd, WRONG_ARGUMENTS, extra=layers)
+    assert ctx.search_err(r'The plot API can create: pdf, svg')
+    ctx.clean_up()
@@ -16,6 +16,8 @@ sys.path.insert(0, os.path.dirname(os.path.dirname(script_dir)))
 from kiauto.ui_automation import recorded_xvfb, PopenContext
 
 COVERAGE_SCRIPT = 'python3-coverage'
+# The benchmarks disable it
+USE_COVERAGE = True
 KICAD_PCB_EXT = '.kicad_pcb'
 
 MODE_SCH = 1
@@ -28,6 +30,12 @@ def usable_cmd(cmd):
     return ' '.join(cmd)
 
 
+def get_test_dir():
+    """ The --test_dir option, pytest.config isn't available when used from the benchmarks """
+    config = getattr(pytest, 'config', None)
+    return config.getoption('test_dir') if config is not None else None
+
+
 class TestContext(object):
     pty_data = None
 
@@ -72,11 +80,13 @@ class TestContext(object):
         # The actual board file that will be loaded
         self._get_board_name()
         # The actual output dir for this run
-        self._set_up_output_dir(pytest.config.getoption('test_dir'))
+        self._set_up_output_dir(get_test_dir())
         # stdout and stderr from the run
         self.out = None
         self.err = None
         self.proc = None
+        # Resources used by the last run (including KiCad)
+        self.rusage = None
 
     def _get_board_cfg_dir(self):
         this_dir = os.path.dirname(os.path.realpath(__file__))
@@ -157,7 +167,8 @@ class TestContext(object):
         logging.debug('Running '+self.test_name)
         # Change the command to be local and add the board and output arguments
         cmd[0] = os.path.abspath(os.path.dirname(os.path.abspath(__file__))+'/../../src/'+cmd[0])
-        cmd = [COVERAGE_SCRIPT, 'run', '-a']+cmd
+        if USE_COVERAGE:
+            cmd = [COVERAGE_SCRIPT, 'run', '-a']+cmd
         cmd.append(filename if filename else self.board_file)
         cmd.append(self.output_dir)
         if extra is not None:
@@ -180,7 +191,10 @@ class TestContext(object):
                 f_err = os.open(err_filename, os.O_RDWR | os.O_CREAT)
                 # Run the process
                 process = subprocess.Popen(cmd, stdout=f_out, stderr=f_err)
-                ret_code = process.wait()
+                # wait4 gives the resources used by the whole tree (i.e. KiCad peak RSS)
+                _, status, self.rusage = os.wait4(process.pid, 0)
+                ret_code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+                process.returncode = ret_code
             logging.debug('ret_code '+str(ret_code))
             if not ((ret_code == 9 or ret_code == 10) and exp_ret != 9 and exp_ret != 10):
                 break